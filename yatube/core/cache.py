@@ -0,0 +1,139 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.core.cache import cache
+from django.db import close_old_connections, transaction
+
+from . import stats
+
+logger = logging.getLogger(__name__)
+
+# Сколько после конца свежести значение ещё отдаётся, пока его
+# пересчитывает кто-то один.
+STALE_TIMEOUT = 60 * 10
+# Блокировка пересчёта снимается сама, если пересчитывавший упал.
+LOCK_TIMEOUT = 30
+# Сколько ждать чужого пересчёта при промахе, прежде чем считать самим.
+WAIT_TIMEOUT = 3
+WAIT_INTERVAL = 0.05
+
+_executor = None
+
+
+def generation_key(scope):
+    return f'generation:{scope}'
+
+
+def now_generation():
+    # Поколения начинаются с текущего времени: если ключ вытеснят из кэша,
+    # новое значение всё равно окажется больше любого выданного раньше.
+    return int(time.time() * 1000)
+
+
+def get_generations(*scopes):
+    """Текущие номера поколений для областей scopes."""
+    keys = [generation_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, now_generation(), None)
+            found[key] = cache.get(key, now_generation())
+    return [found[key] for key in keys]
+
+
+def generation_token(*scopes):
+    """Строка для ключа кэша, меняющаяся при записи в любую из областей."""
+    return '.'.join(str(value) for value in get_generations(*scopes))
+
+
+def bump_generations(*scopes):
+    """Сдвигает поколения, делая устаревшими все ключи с ними.
+
+    Сдвиг делается сразу, чтобы своя транзакция не читала старое, и ещё
+    раз после коммита: другие запросы до коммита видят в базе старые
+    данные и могли закэшировать их под новым поколением.
+    """
+    bump_now(scopes)
+    transaction.on_commit(partial(bump_now, scopes))
+
+
+def bump_now(scopes):
+    keys = [generation_key(scope) for scope in set(scopes)]
+    found = cache.get_many(keys)
+    current = now_generation()
+    cache.set_many(
+        {key: max(current, found.get(key, 0) + 1) for key in keys}, None)
+
+
+def lock_key(key):
+    return f'lock:{key}'
+
+
+def get_or_compute(key, compute, timeout, stale_timeout=STALE_TIMEOUT,
+                   background=False):
+    """Значение compute() из кэша; пересчёт один на ключ для всех процессов.
+
+    Свежее значение отдаётся как есть. Когда прошло timeout секунд,
+    значение ещё stale_timeout секунд отдаётся устаревшим, а пересчитывает
+    его только взявший блокировку: сам запрос или, с background, фоновый
+    поток. При промахе остальные ждут результат того, кто считает, а не
+    идут в базу все разом.
+    """
+    entry = cache.get(key)
+    if entry is not None:
+        value, fresh_until = entry
+        if time.time() < fresh_until:
+            return value
+        if cache.add(lock_key(key), 1, LOCK_TIMEOUT):
+            if not background:
+                return recompute(key, compute, timeout, stale_timeout)
+            refresh_in_background(key, compute, timeout, stale_timeout)
+        stats.incr('cache.swr.stale')
+        return value
+    if cache.add(lock_key(key), 1, LOCK_TIMEOUT):
+        return recompute(key, compute, timeout, stale_timeout)
+    deadline = time.monotonic() + WAIT_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(WAIT_INTERVAL)
+        entry = cache.get(key)
+        if entry is not None:
+            stats.incr('cache.swr.waits')
+            return entry[0]
+    # Считавший не успел или упал: считаем сами, не трогая его блокировку.
+    return recompute(key, compute, timeout, stale_timeout, locked=False)
+
+
+def recompute(key, compute, timeout, stale_timeout, locked=True):
+    try:
+        value = compute()
+        cache.set(
+            key, (value, time.time() + timeout), timeout + stale_timeout)
+        stats.incr('cache.swr.recomputes')
+        return value
+    finally:
+        if locked:
+            cache.delete(lock_key(key))
+
+
+def refresh(key, compute, timeout, stale_timeout):
+    try:
+        recompute(key, compute, timeout, stale_timeout)
+    except Exception:
+        logger.exception('Не удалось пересчитать %s', key)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix='cache-refresh')
+    return _executor
+
+
+def refresh_in_background(key, compute, timeout, stale_timeout):
+    return get_executor().submit(
+        refresh, key, compute, timeout, stale_timeout)
@@ -0,0 +1,45 @@
+import hashlib
+
+from django.utils.cache import get_conditional_response
+from django.utils.http import quote_etag
+
+from .cache import get_generations
+from .page_cache import remember_scopes
+from .purge import HEADER
+
+
+class CacheValidators:
+    """ETag страницы по поколениям её областей кэша.
+
+    Считается до тяжёлых запросов и рендера: если клиент прислал
+    совпадающий ETag, view сразу отвечает 304. Last-Modified не
+    отдаётся: с точностью до секунды он пропустил бы правку, сделанную
+    в ту же секунду, что и прошлый ответ. Области кэша и
+    ключи из add_keys уходят в заголовке Surrogate-Key, по которым
+    core.purge сбрасывает страницу во внешнем кэше.
+    """
+
+    def __init__(self, request, *scopes):
+        self.request = request
+        self.keys = set(scopes)
+        generations = get_generations(*scopes)
+        self.token = '.'.join(str(value) for value in generations)
+        remember_scopes(request, scopes, self.token)
+        # Страница зависит только от адреса с курсором: всё, что зависит
+        # от пользователя, подгружается фрагментами (posts.views.fragment_*).
+        source = ':'.join((request.get_full_path(), self.token))
+        self.etag = quote_etag(hashlib.md5(source.encode()).hexdigest())
+
+    def add_keys(self, *keys):
+        self.keys.update(keys)
+
+    def not_modified(self):
+        response = get_conditional_response(self.request, etag=self.etag)
+        if response is not None:
+            self.apply(response)
+        return response
+
+    def apply(self, response):
+        response['ETag'] = self.etag
+        response[HEADER] = ' '.join(sorted(self.keys))
+        return response
@@ -0,0 +1,37 @@
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+
+from core import stats
+
+
+class Command(BaseCommand):
+    help = (
+        'Показывает попадания и промахи кэша по уровням, кэша запросов '
+        'и пересчёты'
+    )
+
+    def handle(self, *args, **options):
+        if hasattr(cache, 'collected_stats'):
+            counters = cache.collected_stats()
+        else:
+            counters = stats.snapshot()
+        for name, value in sorted(counters.items()):
+            self.stdout.write(f'{name}: {value}')
+        for tier in ('l1', 'l2'):
+            hits = counters.get(f'cache.{tier}.hits', 0)
+            total = hits + counters.get(f'cache.{tier}.misses', 0)
+            if total:
+                self.stdout.write(
+                    f'{tier.upper()}: доля попаданий {hits / total:.1%}')
+        hits = counters.get('query_cache.hits', 0)
+        total = hits + counters.get('query_cache.misses', 0)
+        if total:
+            self.stdout.write(
+                f'Кэш запросов: доля попаданий {hits / total:.1%}')
+        recomputes = counters.get('cache.swr.recomputes', 0)
+        stale = counters.get('cache.swr.stale', 0)
+        if recomputes or stale:
+            self.stdout.write(
+                f'Пересчётов: {recomputes}, отдано устаревшим: {stale}, '
+                f'дождались чужого пересчёта: '
+                f'{counters.get("cache.swr.waits", 0)}')
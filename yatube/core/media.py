@@ -0,0 +1,157 @@
+import mimetypes
+import os
+import posixpath
+import re
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import (
+    FileResponse, Http404, HttpResponse, StreamingHttpResponse,
+)
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views.decorators.http import require_safe
+
+CHUNK_SIZE = 64 * 1024
+RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+# Имя файла — хэш содержимого или параметров (sorl, хранилище по хэшу):
+# по такому адресу всегда лежат одни и те же байты.
+HASHED_NAME = re.compile(r'(^|/)[0-9a-f]{32,64}\.\w+$')
+IMMUTABLE = 'public, max-age=31536000, immutable'
+MUTABLE = 'public, max-age=86400'
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header, size):
+    """Диапазон (start, end) из заголовка Range или None для всего файла.
+
+    Поддерживается один диапазон; несколько диапазонов и ошибки синтаксиса
+    по RFC 7233 можно игнорировать и отдать файл целиком.
+    """
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if not first:
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable
+    return start, end
+
+
+def read_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            data = file.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+
+
+def validators(name, stat):
+    """Сильный ETag и Last-Modified файла."""
+    match = HASHED_NAME.search(name)
+    if match:
+        tag = os.path.splitext(name.rsplit('/', 1)[-1])[0]
+    else:
+        tag = f'{stat.st_mtime_ns:x}-{stat.st_size:x}'
+    return quote_etag(tag), int(stat.st_mtime)
+
+
+def offload(response, name, path):
+    """Передаёт отдачу файла веб-серверу, если он это умеет."""
+    mode = settings.MEDIA_ACCEL
+    if mode == 'x-accel-redirect':
+        response['X-Accel-Redirect'] = settings.MEDIA_ACCEL_PREFIX + name
+    elif mode == 'x-sendfile':
+        response['X-Sendfile'] = path
+    else:
+        return False
+    return True
+
+
+@require_safe
+def serve(request, path):
+    """Отдаёт файлы из MEDIA_ROOT в продакшене.
+
+    Если настроен MEDIA_ACCEL, Django отвечает только заголовками, а байты
+    (вместе с Range) отдаёт nginx или Apache. Иначе Range обрабатывается
+    здесь, чтобы видео и большие картинки можно было докачивать.
+    """
+    name = posixpath.normpath(path).lstrip('/')
+    if not name.startswith(settings.MEDIA_SERVE_PREFIXES):
+        raise Http404
+    try:
+        full_path = safe_join(settings.MEDIA_ROOT, name)
+        stat = os.stat(full_path)
+    except (OSError, ValueError, SuspiciousFileOperation):
+        raise Http404
+    if not os.path.isfile(full_path):
+        raise Http404
+    etag, last_modified = validators(name, stat)
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(last_modified),
+        'Cache-Control': (
+            IMMUTABLE if HASHED_NAME.search(name) else MUTABLE),
+        'Accept-Ranges': 'bytes',
+    }
+    response = get_conditional_response(
+        request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = build_response(request, name, full_path, stat, etag)
+    for header, value in headers.items():
+        response[header] = value
+    return response
+
+
+def build_response(request, name, full_path, stat, etag):
+    content_type, encoding = mimetypes.guess_type(full_path)
+    content_type = content_type or 'application/octet-stream'
+    response = HttpResponse(content_type=content_type)
+    if offload(response, name, full_path):
+        return response
+    size = stat.st_size
+    byte_range = None
+    header = request.META.get('HTTP_RANGE')
+    if_range = request.META.get('HTTP_IF_RANGE')
+    if header and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range(header, size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+    if byte_range is None:
+        if request.method == 'HEAD':
+            response['Content-Length'] = size
+            return response
+        response = FileResponse(
+            open(full_path, 'rb'), content_type=content_type)
+        if encoding:
+            response['Content-Encoding'] = encoding
+        return response
+    start, end = byte_range
+    length = end - start + 1
+    if request.method == 'HEAD':
+        response = HttpResponse(content_type=content_type, status=206)
+    else:
+        response = StreamingHttpResponse(
+            read_range(full_path, start, length),
+            content_type=content_type, status=206)
+    response['Content-Range'] = f'bytes {start}-{end}/{size}'
+    response['Content-Length'] = length
+    return response
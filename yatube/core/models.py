@@ -0,0 +1,24 @@
+from django.db import models
+
+
+class StoredFile(models.Model):
+    """Файл хранилища по хэшу содержимого и число ссылок на него."""
+    name = models.CharField(
+        max_length=255,
+        primary_key=True,
+        verbose_name='Имя файла')
+    size = models.PositiveIntegerField(
+        verbose_name='Размер')
+    references = models.PositiveIntegerField(
+        default=0,
+        verbose_name='Количество ссылок')
+    created = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name='Дата загрузки')
+
+    class Meta:
+        verbose_name = 'Файл'
+        verbose_name_plural = 'Файлы'
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,97 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, has_vary_header
+from django.utils.http import parse_http_date_safe
+
+from .cache import generation_token
+
+
+def page_key(request):
+    url = request.build_absolute_uri()
+    return 'page:' + hashlib.md5(url.encode()).hexdigest()
+
+
+def remember_scopes(request, scopes, token):
+    """Отмечает, от каких областей кэша зависит страница."""
+    request.page_cache_scopes = list(scopes)
+    request.page_cache_token = token
+
+
+class AnonymousPageCacheMiddleware:
+    """Готовые страницы, общие для всех посетителей, по адресу с
+    параметрами.
+
+    Запись живёт, пока не сдвинулось поколение одной из областей кэша,
+    которые view отметил через CacheValidators: правка поста,
+    комментария или группы делает устаревшими только зависящие от них
+    страницы. Страница, при рендере которой читали сессию (Vary: Cookie),
+    личная и не кэшируется, как и ответы с cookie или CSRF-токеном;
+    персональное на общих страницах подгружается фрагментами.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self.cacheable_request(request):
+            return self.get_response(request)
+        key = page_key(request)
+        response = self.cached_response(request, key)
+        if response is None:
+            response = self.get_response(request)
+            if self.cacheable_response(request, response):
+                self.store(request, key, response)
+        return response
+
+    def cacheable_request(self, request):
+        if request.method not in ('GET', 'HEAD'):
+            return False
+        return 'messages' not in request.COOKIES
+
+    def cacheable_response(self, request, response):
+        match = request.resolver_match
+        cache_control = response.get('Cache-Control', '')
+        return (
+            request.method == 'GET'
+            and match is not None
+            and match.view_name in settings.PAGE_CACHE_VIEWS
+            and response.status_code == 200
+            and not response.streaming
+            and not response.cookies
+            and not has_vary_header(response, 'Cookie')
+            and not request.META.get('CSRF_COOKIE_USED')
+            and 'private' not in cache_control
+            and 'no-store' not in cache_control
+        )
+
+    def store(self, request, key, response):
+        entry = (
+            getattr(request, 'page_cache_scopes', []),
+            getattr(request, 'page_cache_token', ''),
+            response.status_code,
+            list(response.items()),
+            response.content,
+        )
+        cache.set(key, entry, settings.PAGE_CACHE_TIMEOUT)
+
+    def cached_response(self, request, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        scopes, token, status, headers, content = entry
+        if scopes and generation_token(*scopes) != token:
+            return None
+        response = HttpResponse(content, status=status)
+        for header, value in headers:
+            response[header] = value
+        last_modified = response.get('Last-Modified')
+        return get_conditional_response(
+            request,
+            etag=response.get('ETag'),
+            last_modified=last_modified and parse_http_date_safe(
+                last_modified),
+            response=response,
+        )
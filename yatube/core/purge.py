@@ -0,0 +1,93 @@
+import logging
+import queue
+import threading
+import time
+from functools import partial
+
+import requests
+from django.conf import settings
+from django.db import transaction
+
+from .utils import batches
+
+logger = logging.getLogger(__name__)
+
+# Заголовок с ключами и в ответах, и в запросах на сброс.
+HEADER = 'Surrogate-Key'
+# Сколько ждать ключей от соседних записей, прежде чем отправить пачку.
+BATCH_DELAY = 0.1
+
+
+def send(keys):
+    try:
+        response = requests.request(
+            settings.PURGE_METHOD,
+            settings.PURGE_URL,
+            headers={HEADER: ' '.join(keys)},
+            timeout=settings.PURGE_TIMEOUT,
+        )
+        response.raise_for_status()
+    except requests.RequestException:
+        logger.exception('Не удалось сбросить ключи %s', ' '.join(keys))
+
+
+class PurgeDispatcher:
+    """Отправляет во внешний кэш запросы на сброс по суррогатным ключам.
+
+    Ключи копятся в очереди, фоновый поток собирает всё, что пришло за
+    BATCH_DELAY, и шлёт пачками по PURGE_BATCH_SIZE ключей: сохранение
+    поста не ждёт прокси, а правка десятка строк — это один запрос.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def submit(self, keys):
+        self.start()
+        self.queue.put(keys)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(
+                    target=self.run, name='purge', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            keys = set(self.queue.get())
+            taken = 1
+            deadline = time.monotonic() + BATCH_DELAY
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    keys.update(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+                taken += 1
+            try:
+                for batch in batches(sorted(keys), settings.PURGE_BATCH_SIZE):
+                    send(batch)
+            finally:
+                for _ in range(taken):
+                    self.queue.task_done()
+
+    def wait(self):
+        """Ждёт, пока уйдут все поставленные в очередь ключи."""
+        self.queue.join()
+
+
+dispatcher = PurgeDispatcher()
+
+
+def purge(*keys):
+    """Сбрасывает во внешнем кэше страницы с ключами keys после коммита.
+
+    Без PURGE_URL ничего не делает: страницы живут до конца своего TTL.
+    """
+    if settings.PURGE_URL and keys:
+        transaction.on_commit(partial(dispatcher.submit, set(keys)))
@@ -0,0 +1,68 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .purge import HEADER
+
+
+class PurgeHandler(BaseHTTPRequestHandler):
+    def handle_purge(self):
+        keys = self.headers.get(HEADER, '').split()
+        self.server.receiver.record(self.command, keys)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_PURGE = do_BAN = do_POST = handle_purge
+
+    def log_message(self, format, *args):
+        pass
+
+
+class PurgeReceiver:
+    """Заменитель прокси для тестов: принимает запросы на сброс на
+    свободном порту localhost и запоминает пришедшие ключи.
+
+        with PurgeReceiver() as receiver, override_settings(
+                PURGE_URL=receiver.url):
+            ...
+        receiver.requests  # [('PURGE', ['index', 'post:1']), ...]
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PurgeHandler)
+        self.server.receiver = self
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f'http://{host}:{port}/'
+
+    @property
+    def keys(self):
+        with self.lock:
+            return {key for _, keys in self.requests for key in keys}
+
+    def record(self, method, keys):
+        with self.lock:
+            self.requests.append((method, keys))
+
+    def start(self):
+        # Короткий опрос, чтобы stop() не ждал по полсекунды.
+        self.thread = threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,183 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.db.models.lookups import Exact
+from django.db.models.query import ModelIterable
+from django.db.models.signals import post_delete, post_save
+
+from . import stats
+from .cache import bump_generations, generation_token
+
+# Таблицы моделей, о записи в которые кэш узнаёт по сигналам.
+_watched = set()
+_classes = {}
+
+
+def table_scope(table):
+    return f'table:{table}'
+
+
+def row_scopes(table, pk):
+    return (f'rows:{table}', f'row:{table}:{pk}')
+
+
+def rows_changed(model, *pks):
+    """Сбрасывает запросы, которые могли видеть строки pks модели.
+
+    Для записей в обход save() и delete(): queryset.update() и т.п.
+    """
+    table = model._meta.db_table
+    bump_generations(
+        table_scope(table),
+        *(f'row:{table}:{pk}' for pk in pks)
+    )
+
+
+def table_changed(model):
+    """Сбрасывает все запросы к таблице модели, в том числе по pk."""
+    table = model._meta.db_table
+    bump_generations(table_scope(table), f'rows:{table}')
+
+
+def instance_changed(sender, instance, raw=False, update_fields=None,
+                     **kwargs):
+    # Вход на сайт сохраняет только last_login, его запросы не выводят.
+    if raw or update_fields == frozenset({'last_login'}):
+        return
+    rows_changed(sender, instance.pk)
+
+
+def watch(*models):
+    """Разрешает кэшировать запросы к моделям, подписываясь на их
+    post_save и post_delete."""
+    for model in models:
+        _watched.add(model._meta.db_table)
+        for signal in (post_save, post_delete):
+            signal.connect(
+                instance_changed, sender=model,
+                dispatch_uid=f'query_cache:{model._meta.label}')
+
+
+def cached(queryset):
+    """Копия queryset, результаты которой берутся из кэша.
+
+    Ключ — SQL с параметрами. Запрос по первичному ключу устаревает
+    только с изменением своей строки, остальные — с любой записью в
+    их таблицы; связанные через select_related строки отслеживаются
+    по одной. Запросы, задевающие таблицы без watch(), выполняются
+    как обычно.
+
+        get_object_or_404(cached(Group.objects), slug=slug)
+    """
+    queryset = queryset.all()
+    base = type(queryset)
+    if base not in _classes:
+        _classes[base] = type(
+            f'Cached{base.__name__}', (CachedQuerySetMixin, base), {})
+    queryset.__class__ = _classes[base]
+    return queryset
+
+
+class CachedQuerySetMixin:
+    def _fetch_all(self):
+        if (
+            self._result_cache is None
+            and self._iterable_class is ModelIterable
+        ):
+            self._result_cache = fetch(self)
+        super()._fetch_all()
+
+
+def fetch(queryset):
+    query = queryset.query
+    try:
+        sql, params = query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return []
+    tables = {join.table_name for join in query.alias_map.values()}
+    if (
+        not tables <= _watched
+        or query.select_related is True
+        or query.select_for_update
+    ):
+        return list(ModelIterable(queryset))
+    source = f'{queryset.db}\n{sql}\n{params!r}'
+    key = 'query:' + hashlib.md5(source.encode()).hexdigest()
+    entry = cache.get(key)
+    if entry is not None:
+        rows, scopes, token = entry
+        if generation_token(*scopes) == token:
+            stats.incr('query_cache.hits')
+            return rows
+    stats.incr('query_cache.misses')
+    # Любая запись в задетые таблицы сдвигает их поколение. Если это
+    # случилось, пока шёл запрос, строки могли устареть ещё до того, как
+    # прочитан token: такие строки не кладём в кэш.
+    guard = [table_scope(name) for name in sorted(tables)]
+    before = generation_token(*guard)
+    rows = list(ModelIterable(queryset))
+    scopes = dependencies(queryset, tables, rows)
+    token = generation_token(*scopes)
+    if generation_token(*guard) == before:
+        cache.set(key, (rows, scopes, token), settings.QUERY_CACHE_TIMEOUT)
+    return rows
+
+
+def pk_lookup(query, model):
+    """Значение первичного ключа, если запрос ищет строку только по нему."""
+    children = query.where.children
+    if query.where.negated or len(children) != 1:
+        return None
+    lookup = children[0]
+    if (
+        isinstance(lookup, Exact)
+        and getattr(lookup.lhs, 'target', None) is model._meta.pk
+        and not hasattr(lookup.rhs, 'resolve_expression')
+    ):
+        return lookup.rhs
+    return None
+
+
+def dependencies(queryset, tables, rows):
+    """Области кэша, с изменением которых результат устаревает."""
+    model = queryset.model
+    table = model._meta.db_table
+    pk = pk_lookup(queryset.query, model)
+    scopes = set()
+    if pk is not None:
+        scopes.update(row_scopes(table, pk))
+    else:
+        scopes.add(table_scope(table))
+    related = queryset.query.select_related
+    joined = {table}
+    if isinstance(related, dict):
+        joined |= related_tables(model, related)
+        for row in rows:
+            related_rows(row, related, scopes)
+    # Таблицы из условий фильтра: строки заранее неизвестны.
+    scopes.update(table_scope(name) for name in tables - joined)
+    return sorted(scopes)
+
+
+def related_tables(model, related):
+    tables = set()
+    for name, nested in related.items():
+        related_model = model._meta.get_field(name).related_model
+        tables.add(related_model._meta.db_table)
+        tables |= related_tables(related_model, nested)
+    return tables
+
+
+def related_rows(instance, related, scopes):
+    for name, nested in related.items():
+        related_model = instance._meta.get_field(name).related_model
+        related_table = related_model._meta.db_table
+        value = instance._state.fields_cache.get(name)
+        if value is None:
+            # Связанной строки нет: её появление увидит только таблица.
+            scopes.add(table_scope(related_table))
+            continue
+        scopes.update(row_scopes(related_table, value.pk))
+        related_rows(value, nested, scopes)
@@ -0,0 +1,32 @@
+import threading
+from collections import Counter
+
+_lock = threading.Lock()
+_counters = Counter()
+_flushed = Counter()
+
+
+def incr(name, value=1):
+    """Увеличивает счётчик процесса (попадания кэша, пересчёты и т.п.)."""
+    with _lock:
+        _counters[name] += value
+
+
+def snapshot():
+    """Счётчики текущего процесса с момента его запуска."""
+    with _lock:
+        return dict(_counters)
+
+
+def take_delta():
+    """Прирост счётчиков с прошлого вызова — для сводки по процессам."""
+    with _lock:
+        delta = _counters - _flushed
+        _flushed.update(delta)
+        return dict(delta)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _flushed.clear()
@@ -0,0 +1,131 @@
+import hashlib
+import os
+import posixpath
+import tempfile
+
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils.deconstruct import deconstructible
+
+from .models import StoredFile
+
+CHUNK_SIZE = 64 * 1024
+
+
+def content_hash(content):
+    digest = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks(CHUNK_SIZE):
+        digest.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return digest.hexdigest()
+
+
+def sharded_name(directory, digest, extension):
+    """posts/ab/cd/abcd….jpg: по 256 подкаталогов на двух уровнях."""
+    return posixpath.join(
+        directory, digest[:2], digest[2:4], digest + extension.lower())
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранит файл под SHA-256 его содержимого.
+
+    Повторная загрузка тех же байтов не создаёт копию, а добавляет ссылку
+    в StoredFile; delete() убирает ссылку и стирает файл, когда ссылок
+    не осталось. Файлы, загруженные до перехода на это хранилище, в
+    StoredFile не записаны: delete() их не трогает, их убирает сборщик
+    осиротевших файлов.
+    """
+
+    def get_available_name(self, name, max_length=None):
+        # Имя задаёт содержимое, совпадение имён — это и есть дедупликация.
+        return name
+
+    def _save(self, name, content):
+        directory = posixpath.dirname(name)
+        extension = os.path.splitext(name)[1]
+        # Загрузчик мог посчитать хэш, пока принимал файл.
+        digest = getattr(content, 'content_hash', None)
+        name = sharded_name(
+            directory, digest or content_hash(content), extension)
+        # Сначала ссылка: с ней remove_unreferenced уже не сотрёт файл
+        # между проверкой и возвратом имени.
+        self.acquire(name, content.size)
+        if not self.exists(name):
+            if hasattr(content, 'temporary_file_path'):
+                self._move(name, content.temporary_file_path())
+            else:
+                self._write(name, content)
+        return name
+
+    def _prepare_directory(self, path):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        if self.directory_permissions_mode is not None:
+            os.chmod(directory, self.directory_permissions_mode)
+
+    def _move(self, name, temp_path):
+        """Переносит уже записанный на диск файл: на том же диске это
+        переименование, а не копирование."""
+        path = self.path(name)
+        self._prepare_directory(path)
+        file_move_safe(temp_path, path, allow_overwrite=True)
+        if self.file_permissions_mode is not None:
+            os.chmod(path, self.file_permissions_mode)
+
+    def _write(self, name, content):
+        """Пишет во временный файл рядом и атомарно переименовывает:
+        параллельная загрузка тех же байтов просто перезапишет копию."""
+        path = self.path(name)
+        self._prepare_directory(path)
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path), suffix='.part')
+        try:
+            with os.fdopen(handle, 'wb') as file:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def acquire(self, name, size):
+        """Добавляет ссылку на файл."""
+        updated = StoredFile.objects.filter(name=name).update(
+            references=F('references') + 1)
+        if updated:
+            return
+        try:
+            with transaction.atomic():
+                StoredFile.objects.create(name=name, size=size, references=1)
+        except IntegrityError:
+            StoredFile.objects.filter(name=name).update(
+                references=F('references') + 1)
+
+    def delete(self, name):
+        """Убирает ссылку; сам файл стирается после коммита, если ссылок
+        больше нет."""
+        updated = StoredFile.objects.filter(
+            name=name, references__gt=0).update(
+            references=F('references') - 1)
+        if updated:
+            transaction.on_commit(lambda: self.remove_unreferenced(name))
+
+    def remove_unreferenced(self, name):
+        # Файл стирается в той же транзакции, что и запись: acquire() для
+        # этого имени ждёт её и затем записывает файл заново.
+        with transaction.atomic():
+            deleted, _ = StoredFile.objects.filter(
+                name=name, references=0).delete()
+            if deleted:
+                super().delete(name)
+
+
+content_storage = ContentAddressedStorage()
@@ -0,0 +1,41 @@
+from django import template
+from django.conf import settings
+from django.template.defaulttags import url
+from django.utils.html import format_html
+
+register = template.Library()
+
+
+class PersonalNode(template.Node):
+    def __init__(self, url_node, nodelist):
+        self.url_node = url_node
+        self.nodelist = nodelist
+
+    def render(self, context):
+        src = self.url_node.render(context)
+        fallback = self.nodelist.render(context)
+        if settings.FRAGMENTS_ESI:
+            return format_html(
+                '<div><esi:include src="{}"/>'
+                '<esi:remove>{}</esi:remove></div>',
+                src, fallback,
+            )
+        return format_html(
+            '<div data-fragment="{}">{}</div>', src, fallback)
+
+
+@register.tag
+def personal(parser, token):
+    """Место для персонального фрагмента внутри общей для всех страницы.
+
+    {% personal 'posts:fragment_follow' author.username %}
+      запасное содержимое для гостя
+    {% endpersonal %}
+
+    Аргументы те же, что у {% url %}. Фрагмент вставляет ESI на краю
+    (FRAGMENTS_ESI) или скрипт из base.html.
+    """
+    url_node = url(parser, token)
+    nodelist = parser.parse(('endpersonal',))
+    parser.delete_first_token()
+    return PersonalNode(url_node, nodelist)
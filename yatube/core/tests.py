@@ -1,4 +1,23 @@
-from django.test import TestCase
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import time
+from io import StringIO
+from unittest import mock
+
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from core import purge, stats
+from core.cache import get_or_compute, lock_key
+from core.models import StoredFile
+from core.purge_receiver import PurgeReceiver
+from core.storage import ContentAddressedStorage
+from core.tiered_cache import LocalStore, TieredCache
 
 
 class ViewTestClass(TestCase):
@@ -7,3 +26,357 @@ class ViewTestClass(TestCase):
         response = self.client.get('/nonexist-page/')
         self.assertEqual(response.status_code, 404)
         self.assertTemplateUsed(response, 'core/404.html')
+
+
+class TieredCacheTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        self.location = os.path.join(self.directory, 'cache.sqlite3')
+        self.cache = self.worker()
+        stats.reset()
+
+    def worker(self, **options):
+        """Кэш отдельного воркера: общий L2, собственный L1."""
+        cache = TieredCache(self.location, {'OPTIONS': options})
+        cache.store = LocalStore()
+        return cache
+
+    def test_basic_operations(self):
+        """Кэш ведёт себя как обычный бэкенд Django."""
+        self.assertIsNone(self.cache.get('key'))
+        self.cache.set('key', {'value': 1})
+        self.assertEqual(self.cache.get('key'), {'value': 1})
+        self.assertFalse(self.cache.add('key', 2))
+        self.assertTrue(self.cache.add('other', 2))
+        self.cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(
+            self.cache.get_many(['a', 'b', 'c']), {'a': 1, 'b': 2})
+        self.cache.delete('a')
+        self.assertFalse(self.cache.has_key('a'))
+        self.assertEqual(self.cache.incr('b'), 3)
+        self.cache.clear()
+        self.assertIsNone(self.cache.get('b'))
+
+    def test_expired_entries(self):
+        """Просроченные записи не отдаются ни из L1, ни из L2."""
+        self.cache.set('key', 'value', 0.05)
+        self.assertEqual(self.cache.get('key'), 'value')
+        time.sleep(0.1)
+        self.assertIsNone(self.cache.get('key'))
+        self.assertTrue(self.cache.add('key', 'new'))
+        self.assertEqual(self.worker().get('key'), 'new')
+
+    def test_l2_shared_between_workers(self):
+        """Запись одного воркера видна другому через L2."""
+        self.cache.set('key', 'value')
+        other = self.worker()
+        self.assertEqual(other.get('key'), 'value')
+        self.assertEqual(other.get('key'), 'value')
+        counters = stats.snapshot()
+        self.assertEqual(counters['cache.l2.hits'], 1)
+        self.assertEqual(counters['cache.l1.hits'], 1)
+
+    def test_invalidation_reaches_other_workers(self):
+        """Изменение ключа вытесняет его из L1 остальных воркеров."""
+        other = self.worker()
+        self.cache.set('key', 'old')
+        self.assertEqual(other.get('key'), 'old')
+        self.cache.set('key', 'new')
+        self.assertEqual(other.get('key'), 'new')
+        self.cache.delete('key')
+        self.assertIsNone(other.get('key'))
+        other.set('key', 'again')
+        self.cache.clear()
+        self.assertIsNone(other.get('key'))
+
+    def test_own_writes_stay_in_l1(self):
+        """Собственная запись не вытесняет значение из L1 воркера."""
+        self.cache.set('key', 'value')
+        self.cache.get('key')
+        self.assertEqual(stats.snapshot().get('cache.l2.hits', 0), 0)
+        self.assertEqual(stats.snapshot()['cache.l1.hits'], 1)
+
+    def test_pruned_journal_drops_l1(self):
+        """Если журнал успели почистить, L1 сбрасывается целиком."""
+        other = self.worker(JOURNAL_TTL=0)
+        self.cache.set('key', 'old')
+        other.get('key')
+        self.cache.set('key', 'new')
+        self.cache.set('unrelated', 1)
+        other.cull()
+        other.set('marker', 1)
+        self.assertEqual(other.get('key'), 'new')
+
+    def test_l1_is_bounded(self):
+        """L1 вытесняет давно не читанные ключи."""
+        cache = self.worker(L1_MAX_ENTRIES=2)
+        cache.set_many({'a': 1, 'b': 2})
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(list(cache.store.entries), [
+            cache.make_key('a'), cache.make_key('c')])
+        self.assertEqual(cache.get('b'), 2)
+
+    def test_l2_is_culled(self):
+        """L2 не разрастается больше MAX_ENTRIES."""
+        cache = self.worker(MAX_ENTRIES=10, CULL_EVERY=1)
+        for num in range(20):
+            cache.set(f'key{num}', num)
+        count = cache.connection.execute(
+            'SELECT COUNT(*) FROM cache_entry').fetchone()[0]
+        self.assertLessEqual(count, 10)
+
+    def test_stats_collected_across_workers(self):
+        """Статистика процессов сводится в L2 и видна командой."""
+        self.cache.set('key', 'value')
+        self.cache.get('key')
+        self.worker().get('missing')
+        counters = self.cache.collected_stats()
+        self.assertEqual(counters['cache.l1.hits'], 1)
+        self.assertEqual(counters['cache.l2.misses'], 1)
+        out = StringIO()
+        with mock.patch(
+                'core.management.commands.cache_stats.cache', self.cache):
+            call_command('cache_stats', stdout=out)
+        self.assertIn('cache.l2.misses: 1', out.getvalue())
+        self.assertIn('L1: доля попаданий', out.getvalue())
+
+
+class GetOrComputeTest(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+        stats.reset()
+        self.calls = 0
+
+    def compute(self):
+        self.calls += 1
+        return self.calls
+
+    def test_fresh_value_reused(self):
+        """Свежее значение не пересчитывается."""
+        self.assertEqual(get_or_compute('key', self.compute, 60), 1)
+        self.assertEqual(get_or_compute('key', self.compute, 60), 1)
+        self.assertEqual(stats.snapshot()['cache.swr.recomputes'], 1)
+
+    def test_stale_served_while_other_recomputes(self):
+        """Пока один пересчитывает, остальные получают старое значение."""
+        get_or_compute('key', self.compute, 0)
+        cache.add(lock_key('key'), 1)
+        self.assertEqual(get_or_compute('key', self.compute, 0), 1)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(stats.snapshot()['cache.swr.stale'], 1)
+        cache.delete(lock_key('key'))
+        self.assertEqual(get_or_compute('key', self.compute, 0), 2)
+
+    def test_background_refresh(self):
+        """С background устаревшее значение отдаётся сразу, а пересчёт
+        уходит в фоновый поток."""
+        get_or_compute('key', self.compute, 0)
+        with mock.patch('core.cache.refresh_in_background') as refresh:
+            value = get_or_compute('key', self.compute, 0, background=True)
+        self.assertEqual(value, 1)
+        refresh.assert_called_once()
+
+    def test_miss_waits_for_single_flight(self):
+        """При промахе запрос ждёт того, кто уже считает значение."""
+        cache.add(lock_key('key'), 1)
+        threading.Timer(
+            0.1, cache.set, ['key', ('computed', time.time() + 60)]).start()
+        self.assertEqual(get_or_compute('key', self.compute, 60), 'computed')
+        self.assertEqual(self.calls, 0)
+        self.assertEqual(stats.snapshot()['cache.swr.waits'], 1)
+
+    @mock.patch('core.cache.WAIT_TIMEOUT', 0.1)
+    def test_miss_computes_after_wait_timeout(self):
+        """Не дождавшись чужого пересчёта, запрос считает сам."""
+        cache.add(lock_key('key'), 1)
+        self.assertEqual(get_or_compute('key', self.compute, 60), 1)
+        self.assertTrue(cache.get(lock_key('key')))
+
+
+class MediaServeTest(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, ignore_errors=True)
+        os.makedirs(os.path.join(self.directory, 'posts'))
+        self.content = bytes(range(256)) * 4
+        for name in ('posts/small.gif', 'posts/' + '0' * 32 + '.jpg'):
+            with open(os.path.join(self.directory, name), 'wb') as file:
+                file.write(self.content)
+        settings = override_settings(MEDIA_ROOT=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def body(self, response):
+        return b''.join(response.streaming_content)
+
+    def test_full_file(self):
+        """Файл отдаётся целиком с валидаторами и Accept-Ranges."""
+        response = self.client.get('/media/posts/small.gif')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.body(response), self.content)
+        self.assertEqual(response['Content-Type'], 'image/gif')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertTrue(response['ETag'].startswith('"'))
+        self.assertNotIn('immutable', response['Cache-Control'])
+
+    def test_hashed_name_is_immutable(self):
+        """Файл с хэшем в имени кэшируется навсегда, хэш служит ETag."""
+        response = self.client.get('/media/posts/' + '0' * 32 + '.jpg')
+        self.assertIn('immutable', response['Cache-Control'])
+        self.assertEqual(response['ETag'], '"%s"' % ('0' * 32))
+
+    def test_not_modified(self):
+        """Совпавший ETag даёт 304 без тела."""
+        etag = self.client.get('/media/posts/small.gif')['ETag']
+        response = self.client.get(
+            '/media/posts/small.gif', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_ranges(self):
+        """Диапазоны, суффиксы и недостижимые диапазоны."""
+        size = len(self.content)
+        cases = (
+            ('bytes=0-9', 206, f'bytes 0-9/{size}', self.content[:10]),
+            ('bytes=1000-', 206, f'bytes 1000-{size - 1}/{size}',
+             self.content[1000:]),
+            ('bytes=-4', 206, f'bytes {size - 4}-{size - 1}/{size}',
+             self.content[-4:]),
+            (f'bytes={size}-', 416, f'bytes */{size}', None),
+        )
+        for header, status, content_range, body in cases:
+            with self.subTest(header=header):
+                response = self.client.get(
+                    '/media/posts/small.gif', HTTP_RANGE=header)
+                self.assertEqual(response.status_code, status)
+                self.assertEqual(response['Content-Range'], content_range)
+                if body is not None:
+                    self.assertEqual(self.body(response), body)
+
+    def test_if_range_mismatch(self):
+        """Устаревший If-Range — файл целиком, а не кусок."""
+        response = self.client.get(
+            '/media/posts/small.gif',
+            HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"stale"')
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(
+        MEDIA_ACCEL='x-accel-redirect', MEDIA_ACCEL_PREFIX='/protected/')
+    def test_accel_redirect(self):
+        """С nginx Django отдаёт только заголовки."""
+        response = self.client.get('/media/posts/small.gif')
+        self.assertEqual(
+            response['X-Accel-Redirect'], '/protected/posts/small.gif')
+        self.assertEqual(response.content, b'')
+
+    def test_outside_allowed_directories(self):
+        """Файлы вне разрешённых каталогов и выход за MEDIA_ROOT — 404."""
+        for url in ('/media/other.txt', '/media/posts/../../etc/passwd',
+                    '/media/posts/missing.gif'):
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertEqual(response.status_code, 404)
+
+
+@mock.patch('core.storage.transaction.on_commit', lambda callback: callback())
+class ContentAddressedStorageTest(TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        self.storage = ContentAddressedStorage(location=directory)
+
+    def test_sharded_name(self):
+        """Имя файла — хэш содержимого в двух уровнях подкаталогов."""
+        name = self.storage.save('posts/photo.JPG', ContentFile(b'photo'))
+        digest = hashlib.sha256(b'photo').hexdigest()
+        self.assertEqual(
+            name, f'posts/{digest[:2]}/{digest[2:4]}/{digest}.jpg')
+        self.assertTrue(self.storage.exists(name))
+
+    def test_same_content_stored_once(self):
+        """Одинаковые загрузки — один файл и счётчик ссылок."""
+        first = self.storage.save('posts/a.gif', ContentFile(b'same'))
+        second = self.storage.save('posts/b.gif', ContentFile(b'same'))
+        self.assertEqual(first, second)
+        self.assertEqual(len(os.listdir(os.path.dirname(
+            self.storage.path(first)))), 1)
+        self.assertEqual(StoredFile.objects.get(name=first).references, 2)
+
+    def test_delete_keeps_shared_file(self):
+        """Файл стирается только вместе с последней ссылкой."""
+        name = self.storage.save('posts/a.gif', ContentFile(b'same'))
+        self.storage.save('posts/b.gif', ContentFile(b'same'))
+        self.storage.delete(name)
+        self.assertTrue(self.storage.exists(name))
+        self.storage.delete(name)
+        self.assertFalse(self.storage.exists(name))
+        self.assertFalse(StoredFile.objects.filter(name=name).exists())
+
+    def test_reupload_races_with_removal(self):
+        """Удаление последней ссылки, закоммиченное посреди новой загрузки
+        тех же байтов, не оставляет её без файла."""
+        name = self.storage.save('posts/a.gif', ContentFile(b'same'))
+        pending = []
+        with mock.patch('core.storage.transaction.on_commit', pending.append):
+            self.storage.delete(name)
+        exists = self.storage.exists
+
+        def racing(checked):
+            found = exists(checked)
+            while pending:
+                pending.pop()()
+            return found
+
+        with mock.patch.object(self.storage, 'exists', racing):
+            self.assertEqual(
+                self.storage.save('posts/b.gif', ContentFile(b'same')), name)
+        self.assertTrue(os.path.exists(self.storage.path(name)))
+        self.assertEqual(StoredFile.objects.get(name=name).references, 1)
+
+    def test_untracked_file_is_kept(self):
+        """Файлы без записи о ссылках delete() не трогает."""
+        os.makedirs(self.storage.path('posts'))
+        with open(self.storage.path('posts/old.gif'), 'wb') as file:
+            file.write(b'old')
+        self.storage.delete('posts/old.gif')
+        self.assertTrue(self.storage.exists('posts/old.gif'))
+
+
+class PurgeTest(SimpleTestCase):
+    def setUp(self):
+        self.receiver = PurgeReceiver().start()
+        self.addCleanup(self.receiver.stop)
+
+    def purge(self, *keys):
+        purge.purge(*keys)
+        purge.dispatcher.wait()
+
+    def test_keys_batched(self):
+        """Ключи соседних изменений уходят одним запросом."""
+        with override_settings(PURGE_URL=self.receiver.url):
+            purge.purge('index', 'post:1')
+            purge.purge('post:1', 'profile:2')
+            purge.dispatcher.wait()
+        self.assertEqual(
+            self.receiver.requests,
+            [('PURGE', ['index', 'post:1', 'profile:2'])])
+
+    @override_settings(PURGE_BATCH_SIZE=2, PURGE_METHOD='BAN')
+    def test_batch_size(self):
+        """Длинный список ключей делится на запросы по PURGE_BATCH_SIZE."""
+        with override_settings(PURGE_URL=self.receiver.url):
+            self.purge('a', 'b', 'c')
+        self.assertEqual(
+            self.receiver.requests, [('BAN', ['a', 'b']), ('BAN', ['c'])])
+
+    def test_disabled_without_url(self):
+        """Без PURGE_URL запросы не отправляются."""
+        self.purge('index')
+        self.assertEqual(self.receiver.requests, [])
+
+    @override_settings(PURGE_URL='http://127.0.0.1:9/', PURGE_TIMEOUT=0.5)
+    def test_unreachable_endpoint(self):
+        """Недоступный прокси не ломает запись, ошибка уходит в лог."""
+        with self.assertLogs('core.purge', 'ERROR'):
+            self.purge('index')
@@ -0,0 +1,344 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache.backends.base import DEFAULT_TIMEOUT, BaseCache
+
+from . import stats
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS cache_entry ('
+    ' key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL)',
+    'CREATE INDEX IF NOT EXISTS cache_entry_expires ON cache_entry (expires)',
+    'CREATE TABLE IF NOT EXISTS cache_invalidation ('
+    ' seq INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, created REAL)',
+    'CREATE TABLE IF NOT EXISTS cache_stat ('
+    ' name TEXT PRIMARY KEY, value INTEGER NOT NULL)',
+)
+
+# Как LocMemCache: один L1 на процесс и LOCATION, общий для всех потоков.
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class LocalStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # key -> (value, expires, seq записи, после которой значение верно)
+        self.entries = OrderedDict()
+        self.seen_seq = None
+        self.last_sync = 0
+        self.last_stats_flush = time.monotonic()
+        self.writes = 0
+
+
+class TieredCache(BaseCache):
+    """Двухуровневый кэш: LRU в памяти процесса (L1) поверх общего
+    для всех воркеров хоста SQLite-файла (L2).
+
+    Каждая запись в L2 добавляет строку в журнал инвалидаций; перед
+    чтением процесс дочитывает журнал и выбрасывает из своего L1
+    изменённые другими процессами ключи.
+
+    OPTIONS:
+        L1_MAX_ENTRIES — размер L1 (1000);
+        MAX_ENTRIES — размер L2 (30000);
+        SYNC_INTERVAL — как часто сверяться с журналом, в секундах (0);
+        JOURNAL_TTL — сколько хранить журнал инвалидаций, в секундах (300);
+        STATS_INTERVAL — как часто сводить статистику в L2, в секундах (10).
+    """
+
+    def __init__(self, location, params):
+        super().__init__(params)
+        options = params.get('OPTIONS', {})
+        self.path = location
+        self.l1_max_entries = int(options.get('L1_MAX_ENTRIES', 1000))
+        self.max_entries = int(options.get('MAX_ENTRIES', 30000))
+        self.sync_interval = float(options.get('SYNC_INTERVAL', 0))
+        self.journal_ttl = float(options.get('JOURNAL_TTL', 300))
+        self.stats_interval = float(options.get('STATS_INTERVAL', 10))
+        self.cull_every = int(options.get('CULL_EVERY', 100))
+        with _stores_lock:
+            self.store = _stores.setdefault(location, LocalStore())
+        self._connection = None
+
+    @property
+    def connection(self):
+        if self._connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(
+                self.path, timeout=10, isolation_level=None,
+                check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            for statement in SCHEMA:
+                connection.execute(statement)
+            self._connection = connection
+        return self._connection
+
+    def close(self, **kwargs):
+        self.flush_stats()
+
+    # Журнал инвалидаций.
+
+    def sync(self):
+        store = self.store
+        now = time.monotonic()
+        if store.seen_seq is not None and (
+                now - store.last_sync < self.sync_interval):
+            return
+        if store.seen_seq is None:
+            row = self.connection.execute(
+                'SELECT MAX(seq) FROM cache_invalidation').fetchone()
+            with store.lock:
+                if store.seen_seq is None:
+                    store.seen_seq = row[0] or 0
+                    store.last_sync = now
+            return
+        rows = self.connection.execute(
+            'SELECT seq, key FROM cache_invalidation WHERE seq > ? '
+            'ORDER BY seq', (store.seen_seq,)
+        ).fetchall()
+        with store.lock:
+            if rows and rows[0][0] > store.seen_seq + 1:
+                # Часть журнала уже вычищена: не знаем, что пропустили.
+                store.entries.clear()
+            for seq, key in rows:
+                if key is None:
+                    store.entries.clear()
+                    continue
+                entry = store.entries.get(key)
+                if entry is not None and entry[2] < seq:
+                    del store.entries[key]
+                    stats.incr('cache.l1.invalidations')
+            if rows:
+                store.seen_seq = max(store.seen_seq, rows[-1][0])
+            store.last_sync = now
+        if now - store.last_stats_flush >= self.stats_interval:
+            self.flush_stats()
+
+    def invalidate(self, key):
+        cursor = self.connection.execute(
+            'INSERT INTO cache_invalidation (key, created) VALUES (?, ?)',
+            (key, time.time()))
+        return cursor.lastrowid
+
+    # L1.
+
+    def l1_get(self, key):
+        store = self.store
+        with store.lock:
+            entry = store.entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] is not None and entry[1] <= time.time():
+                del store.entries[key]
+                return None
+            store.entries.move_to_end(key)
+            return entry
+
+    def l1_set(self, key, value, expires, seq):
+        store = self.store
+        with store.lock:
+            store.entries[key] = (value, expires, seq)
+            store.entries.move_to_end(key)
+            while len(store.entries) > self.l1_max_entries:
+                store.entries.popitem(last=False)
+
+    def l1_delete(self, key):
+        with self.store.lock:
+            self.store.entries.pop(key, None)
+
+    # API кэша Django.
+
+    def get(self, key, default=None, version=None):
+        return self.get_many([key], version=version).get(key, default)
+
+    def get_many(self, keys, version=None):
+        keys = {self.make_key(key, version=version): key for key in keys}
+        for key in keys:
+            self.validate_key(key)
+        self.sync()
+        found, missing = {}, []
+        for key, original in keys.items():
+            entry = self.l1_get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[original] = pickle.loads(entry[0])
+        stats.incr('cache.l1.hits', len(found))
+        stats.incr('cache.l1.misses', len(missing))
+        if not missing:
+            return found
+        now = time.time()
+        rows = self.connection.execute(
+            'SELECT key, value, expires FROM cache_entry WHERE key IN (%s)'
+            % ', '.join('?' * len(missing)), missing
+        ).fetchall()
+        hits = 0
+        for key, value, expires in rows:
+            if expires is not None and expires <= now:
+                continue
+            hits += 1
+            self.l1_set(key, value, expires, self.store.seen_seq)
+            found[keys[key]] = pickle.loads(value)
+        stats.incr('cache.l2.hits', hits)
+        stats.incr('cache.l2.misses', len(missing) - hits)
+        return found
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        self.set_many({key: value}, timeout=timeout, version=version)
+
+    def set_many(self, data, timeout=DEFAULT_TIMEOUT, version=None):
+        expires = self.get_backend_timeout(timeout)
+        rows = []
+        for key, value in data.items():
+            key = self.make_key(key, version=version)
+            self.validate_key(key)
+            rows.append((key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)))
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            written = []
+            for key, value in rows:
+                connection.execute(
+                    'INSERT OR REPLACE INTO cache_entry (key, value, expires) '
+                    'VALUES (?, ?, ?)', (key, value, expires))
+                written.append((key, value, self.invalidate(key)))
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        for key, value, seq in written:
+            self.l1_set(key, value, expires, seq)
+        self.after_write(len(rows))
+        return []
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        expires = self.get_backend_timeout(timeout)
+        value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            cursor = connection.execute(
+                'INSERT INTO cache_entry (key, value, expires) '
+                'VALUES (?, ?, ?) ON CONFLICT (key) DO UPDATE SET '
+                'value = excluded.value, expires = excluded.expires '
+                'WHERE cache_entry.expires IS NOT NULL '
+                'AND cache_entry.expires <= ?',
+                (key, value, expires, time.time()))
+            added = cursor.rowcount > 0
+            seq = self.invalidate(key) if added else None
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        if added:
+            self.l1_set(key, value, expires, seq)
+            self.after_write(1)
+        return added
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        cursor = self.connection.execute(
+            'UPDATE cache_entry SET expires = ? WHERE key = ? '
+            'AND (expires IS NULL OR expires > ?)',
+            (self.get_backend_timeout(timeout), key, time.time()))
+        if cursor.rowcount:
+            self.invalidate(key)
+            self.l1_delete(key)
+        return cursor.rowcount > 0
+
+    def delete(self, key, version=None):
+        self.delete_many([key], version=version)
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_key(key, version=version) for key in keys]
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key in keys:
+                self.validate_key(key)
+                connection.execute(
+                    'DELETE FROM cache_entry WHERE key = ?', (key,))
+                self.invalidate(key)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        for key in keys:
+            self.l1_delete(key)
+
+    def has_key(self, key, version=None):
+        return self.get(key, self, version=version) is not self
+
+    def clear(self):
+        connection = self.connection
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('DELETE FROM cache_entry')
+            self.invalidate(None)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        with self.store.lock:
+            self.store.entries.clear()
+
+    # Обслуживание.
+
+    def after_write(self, count):
+        store = self.store
+        with store.lock:
+            store.writes += count
+            due = store.writes >= self.cull_every
+            if due:
+                store.writes = 0
+        if due:
+            self.cull()
+
+    def cull(self):
+        now = time.time()
+        connection = self.connection
+        connection.execute(
+            'DELETE FROM cache_entry WHERE expires IS NOT NULL '
+            'AND expires <= ?', (now,))
+        connection.execute(
+            'DELETE FROM cache_invalidation WHERE created < ?',
+            (now - self.journal_ttl,))
+        count = connection.execute(
+            'SELECT COUNT(*) FROM cache_entry').fetchone()[0]
+        if count > self.max_entries:
+            # Как у FileBasedCache: при переполнении убираем треть записей,
+            # начиная с тех, что истекают раньше.
+            connection.execute(
+                'DELETE FROM cache_entry WHERE key IN ('
+                ' SELECT key FROM cache_entry'
+                ' ORDER BY expires IS NULL, expires LIMIT ?)',
+                (count // 3,))
+            self.invalidate(None)
+
+    def flush_stats(self):
+        """Складывает статистику процесса в общую таблицу L2."""
+        self.store.last_stats_flush = time.monotonic()
+        delta = stats.take_delta()
+        if not delta:
+            return
+        self.connection.executemany(
+            'INSERT INTO cache_stat (name, value) VALUES (?, ?) '
+            'ON CONFLICT (name) DO UPDATE SET value = value + excluded.value',
+            delta.items())
+
+    def collected_stats(self):
+        """Статистика всех процессов, которые работают с этим L2."""
+        self.flush_stats()
+        return dict(self.connection.execute(
+            'SELECT name, value FROM cache_stat ORDER BY name').fetchall())
@@ -0,0 +1,11 @@
+from itertools import islice
+
+
+def batches(iterable, size):
+    """Списки по size элементов из iterable; последний может быть короче."""
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
@@ -1,9 +1,18 @@
 from django.contrib import admin
 
 from .models import Comment, Group, Post, Follow
+from .paginators import EstimatedCountPaginator
+from .search import matching_posts
 
 
-class PostAdmin(admin.ModelAdmin):
+class FastChangeListMixin:
+    """Список без полного COUNT(*): число строк оценивается,
+    а общее число записей при поиске не показывается."""
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
+class PostAdmin(FastChangeListMixin, admin.ModelAdmin):
     list_display = (
         'pk',
         'text',
@@ -12,10 +21,34 @@ class PostAdmin(admin.ModelAdmin):
         'group',
     )
     list_editable = ('group',)
-    search_fields = ('text', 'author',)
+    list_select_related = ('author', 'group')
+    search_fields = ('text', 'author__username__prefix')
     list_filter = ('pub_date',)
     empty_value_display = '-пусто-'
 
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        formfield = super().formfield_for_foreignkey(
+            db_field, request, **kwargs)
+        if db_field.name == 'group':
+            # Выбор группы есть в каждой строке списка: варианты читаются
+            # один раз на запрос, а не на каждую строку.
+            if not hasattr(request, 'group_choices'):
+                request.group_choices = tuple(iter(formfield.choices))
+            formfield.choices = request.group_choices
+        return formfield
+
+    def get_search_fields(self, request):
+        # Текст ищется не LIKE, а по полнотекстовому индексу ниже.
+        return tuple(
+            field for field in self.search_fields if field != 'text')
+
+    def get_search_results(self, request, queryset, search_term):
+        found, use_distinct = super().get_search_results(
+            request, queryset, search_term)
+        if search_term.strip():
+            found |= queryset.filter(pk__in=matching_posts(search_term))
+        return found, use_distinct
+
 
 class GroupAdmin(admin.ModelAdmin):
     list_display = (
@@ -27,22 +60,25 @@ class GroupAdmin(admin.ModelAdmin):
     empty_value_display = '-пусто-'
 
 
-class CommentAdmin(admin.ModelAdmin):
+class CommentAdmin(FastChangeListMixin, admin.ModelAdmin):
     list_display = (
         'post',
         'author',
         'text',
         'created',
     )
-    search_fields = ('text',)
+    list_select_related = ('post', 'author')
+    search_fields = ('text', 'author__username__prefix')
     empty_value_display = '-пусто-'
 
 
-class FollowAdmin(admin.ModelAdmin):
+class FollowAdmin(FastChangeListMixin, admin.ModelAdmin):
     list_display = (
         'user',
         'author',
     )
+    list_select_related = ('user', 'author')
+    search_fields = ('user__username__prefix', 'author__username__prefix')
     empty_value_display = '-пусто-'
 
 
@@ -0,0 +1,37 @@
+from django.conf import settings
+from core.cache import generation_token, get_or_compute
+
+from .paginators import CursorPaginator
+
+FIRST_PAGE_TIMEOUT = 60 * 60 * 6
+
+
+def comments_paginator(post):
+    """Комментарии поста по курсору на (created, id), новые сверху."""
+    return CursorPaginator(
+        post.comments.select_related('author'),
+        settings.PAGINATOR_COMMENTS,
+        ordering=('-created', '-id'),
+        count=post.comments_count,
+    )
+
+
+def first_page(post):
+    """Первая страница комментариев, закэшированная по поколению поста.
+
+    Возвращает пару (комментарии, курсор следующей страницы).
+    """
+    key = f'comments:{post.pk}:{generation_token(f"post:{post.pk}")}'
+
+    def compute():
+        page = comments_paginator(post).get_page(None)
+        return list(page), page.next_cursor
+
+    return get_or_compute(key, compute, FIRST_PAGE_TIMEOUT)
+
+
+def get_page(post, cursor):
+    if not cursor:
+        return first_page(post)
+    page = comments_paginator(post).get_page(cursor)
+    return list(page), page.next_cursor
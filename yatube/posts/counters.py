@@ -0,0 +1,118 @@
+from django.db.models import Count, F, IntegerField, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from core import query_cache
+
+from .models import Comment, Follow, Group, Post, User, UserStats
+
+
+def bump(queryset, field, delta):
+    """Атомарно сдвигает счётчик в базе, не читая его в Python."""
+    return queryset.update(**{field: F(field) + delta})
+
+
+def bump_user(user_id, field, delta):
+    # Строки UserStats может не быть: get_stats() досчитает её при чтении.
+    bump(UserStats.objects.filter(user_id=user_id), field, delta)
+    query_cache.rows_changed(UserStats, user_id)
+
+
+def bump_group(group_id, delta):
+    if group_id is not None:
+        bump(Group.objects.filter(pk=group_id), 'posts_count', delta)
+        query_cache.rows_changed(Group, group_id)
+
+
+def post_saved(post, created):
+    if created:
+        bump_user(post.author_id, 'posts_count', 1)
+        bump_group(post.group_id, 1)
+        return
+    author_id = post.loaded_value('author_id')
+    if author_id != post.author_id:
+        bump_user(author_id, 'posts_count', -1)
+        bump_user(post.author_id, 'posts_count', 1)
+    group_id = post.loaded_value('group_id')
+    if group_id != post.group_id:
+        bump_group(group_id, -1)
+        bump_group(post.group_id, 1)
+
+
+def post_deleted(post):
+    bump_user(post.author_id, 'posts_count', -1)
+    bump_group(post.group_id, -1)
+
+
+def comment_changed(comment, delta):
+    bump(Post.objects.filter(pk=comment.post_id), 'comments_count', delta)
+    query_cache.rows_changed(Post, comment.post_id)
+
+
+def follow_changed(follow, delta):
+    bump_user(follow.author_id, 'followers_count', delta)
+    bump_user(follow.user_id, 'following_count', delta)
+
+
+def get_stats(user):
+    try:
+        return user.stats
+    except UserStats.DoesNotExist:
+        return reconcile_user(user.pk)
+
+
+def count_of(model, field):
+    """Подзапрос COUNT(*) строк model, ссылающихся на внешнюю строку."""
+    rows = model.objects.filter(
+        **{field: OuterRef('pk')}
+    ).order_by().values(field).annotate(total=Count('pk')).values('total')
+    return Coalesce(Subquery(rows, output_field=IntegerField()), 0)
+
+
+COUNTERS = (
+    (Group, 'posts_count', Post, 'group'),
+    (Post, 'comments_count', Comment, 'post'),
+    (UserStats, 'posts_count', Post, 'author'),
+    (UserStats, 'followers_count', Follow, 'author'),
+    (UserStats, 'following_count', Follow, 'user'),
+)
+
+
+def reconcile():
+    """Чинит расхождения всех счётчиков пачкой UPDATE-запросов.
+
+    Возвращает число исправленных строк по каждому счётчику.
+    """
+    UserStats.objects.bulk_create(
+        (
+            UserStats(user_id=user_id)
+            for user_id in User.objects.filter(
+                stats__isnull=True).values_list('pk', flat=True)
+        ),
+        batch_size=500,
+        ignore_conflicts=True,
+    )
+    repaired = {}
+    for model, field, source, source_field in COUNTERS:
+        actual = count_of(source, source_field)
+        drifted = model.objects.annotate(actual=actual).exclude(
+            **{field: F('actual')})
+        repaired[f'{model.__name__}.{field}'] = model.objects.filter(
+            pk__in=drifted.values('pk')
+        ).update(**{field: actual})
+    for model in {model for model, *_ in COUNTERS}:
+        query_cache.table_changed(model)
+    return repaired
+
+
+def reconcile_user(user_id):
+    stats, _ = UserStats.objects.update_or_create(
+        user_id=user_id,
+        defaults={
+            'posts_count': Post.objects.filter(author_id=user_id).count(),
+            'followers_count': Follow.objects.filter(
+                author_id=user_id).count(),
+            'following_count': Follow.objects.filter(
+                user_id=user_id).count(),
+        },
+    )
+    return stats
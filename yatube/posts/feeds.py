@@ -0,0 +1,42 @@
+from core.cache import bump_generations
+from core.purge import purge
+
+
+def invalidate(*scopes):
+    """Сдвигает поколения областей и сбрасывает страницы с этими
+    суррогатными ключами во внешнем кэше."""
+    bump_generations(*scopes)
+    purge(*scopes)
+
+
+def post_scopes(post):
+    """Области кэша лент, в которых виден пост (до и после правки)."""
+    scopes = {'index', f'post:{post.pk}'}
+    for author_id in (post.author_id, post.loaded_value('author_id')):
+        scopes.add(f'profile:{author_id}')
+    for group_id in (post.group_id, post.loaded_value('group_id')):
+        if group_id is not None:
+            scopes.add(f'group:{group_id}')
+    return scopes
+
+
+def post_changed(post):
+    invalidate(*post_scopes(post))
+
+
+def group_changed(group):
+    invalidate('index', f'group:{group.pk}')
+
+
+def user_changed(user):
+    invalidate('index', f'profile:{user.pk}')
+
+
+def comment_changed(comment):
+    invalidate(f'post:{comment.post_id}')
+
+
+def follow_changed(follow):
+    # Счётчики подписок выводятся в профилях обоих пользователей.
+    invalidate(
+        f'profile:{follow.author_id}', f'profile:{follow.user_id}')
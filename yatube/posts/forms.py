@@ -11,6 +11,21 @@ class PostForm(forms.ModelForm):
         model = Post
         fields = ('text', 'group', 'image')
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Картинку, отклонённую ещё при приёме, Pillow не открываем.
+        image = self.files.get('image')
+        self.upload_error = getattr(image, 'upload_error', None)
+        if self.upload_error:
+            self.files = self.files.copy()
+            self.files.pop('image')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.upload_error:
+            self.add_error('image', self.upload_error)
+        return cleaned_data
+
 
 class CommentForm(forms.ModelForm):
     class Meta:
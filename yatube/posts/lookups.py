@@ -0,0 +1,33 @@
+from django.db.models import CharField, Lookup, TextField
+
+# Больше любого символа: верхняя граница диапазона строк с префиксом.
+MAX_CHAR = '\U0010ffff'
+
+
+@CharField.register_lookup
+class Prefix(Lookup):
+    """Начало строки как диапазон value <= field < value + MAX_CHAR.
+
+    В отличие от LIKE 'value%' такое условие использует обычный индекс
+    по полю (например, уникальный индекс username). Регистр учитывается.
+    """
+    lookup_name = 'prefix'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        params = lhs_params + [self.rhs] + lhs_params + [self.rhs + MAX_CHAR]
+        return f'{lhs} >= %s AND {lhs} < %s', params
+
+
+class FullTextField(TextField):
+    """Столбец виртуальной таблицы FTS5."""
+
+
+@FullTextField.register_lookup
+class Match(Lookup):
+    lookup_name = 'match'
+
+    def as_sql(self, compiler, connection):
+        lhs, lhs_params = self.process_lhs(compiler, connection)
+        rhs, rhs_params = self.process_rhs(compiler, connection)
+        return f'{lhs} MATCH {rhs}', lhs_params + rhs_params
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+
+from posts.orphans import BATCH_SIZE, MIN_AGE, collect
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаляет картинки, на которые не ссылается ни один пост, '
+        'их миниатюры, устаревшие записи sorl-thumbnail и брошенные загрузки'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Только посчитать, ничего не удаляя'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE,
+            help='Сколько файлов или записей проверять за один запрос'
+        )
+        parser.add_argument(
+            '--min-age', type=int, default=MIN_AGE,
+            help='Не трогать файлы моложе стольких секунд'
+        )
+
+    def handle(self, *args, **options):
+        stats = collect(
+            dry_run=options['dry_run'],
+            batch_size=options['batch_size'],
+            min_age=options['min_age'],
+        )
+        verb = 'Будет удалено' if options['dry_run'] else 'Удалено'
+        self.stdout.write(
+            f'{verb}: картинок {stats["images"]}, '
+            f'миниатюр {stats["thumbnails"]}, '
+            f'записей sorl {stats["kv entries"]}, '
+            f'брошенных загрузок {stats["uploads"]}, '
+            f'{stats["bytes"] / 2 ** 20:.1f} МБ'
+        )
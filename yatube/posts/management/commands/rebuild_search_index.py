@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from posts.search import BATCH_SIZE, rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересобирает полнотекстовый индекс постов'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE,
+            help='Сколько постов индексировать за один запрос'
+        )
+
+    def handle(self, *args, **options):
+        indexed = rebuild(options['batch_size'])
+        self.stdout.write(f'Проиндексировано постов: {indexed}')
@@ -0,0 +1,141 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from posts.models import Post
+from posts.thumbnail_workers import init_worker, regenerate
+
+BATCH_SIZE = 20
+CHECKPOINT = os.path.join(
+    settings.BASE_DIR, 'cache', 'regenerate_thumbnails.json')
+
+
+def run_inline(function, *args):
+    future = Future()
+    future.set_result(function(*args))
+    return future
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересоздаёт миниатюры картинок всех постов на нескольких ядрах; '
+        'после прерывания продолжает с места остановки'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Число процессов; 0 — всё в текущем процессе'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=BATCH_SIZE,
+            help='Сколько постов отдавать процессу за раз'
+        )
+        parser.add_argument(
+            '--rate', type=float, default=0,
+            help='Не больше стольких картинок в секунду; 0 — без ограничений'
+        )
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Удалить и создать заново даже готовые миниатюры'
+        )
+        parser.add_argument(
+            '--checkpoint', default=CHECKPOINT,
+            help='Файл, в котором хранится прогресс'
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Начать сначала, не глядя на сохранённый прогресс'
+        )
+
+    def handle(self, *args, **options):
+        self.checkpoint = options['checkpoint']
+        last_pk = 0 if options['restart'] else self.load_checkpoint()
+        if last_pk:
+            self.stdout.write(f'Продолжаю после поста {last_pk}')
+        workers = options['workers']
+        executor = None
+        if workers:
+            # spawn, а не fork: процессы не наследуют соединения с базой.
+            executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker,
+            )
+        submit = executor.submit if executor else run_inline
+        self.started = time.monotonic()
+        self.done = 0
+        submitted = 0
+        # Пачки в порядке отправки: прогресс сохраняется только до первой
+        # незавершённой, чтобы после прерывания ничего не пропустить.
+        in_flight = deque()
+        try:
+            for batch in self.batches(last_pk, options['batch_size']):
+                self.throttle(submitted, options['rate'])
+                future = submit(regenerate, batch, options['force'])
+                in_flight.append((batch[-1], future))
+                submitted += len(batch)
+                if len(in_flight) > max(workers, 1) * 2:
+                    in_flight[0][1].result()
+                self.drain(in_flight)
+            for _, future in in_flight:
+                future.result()
+            self.drain(in_flight)
+        finally:
+            if executor:
+                executor.shutdown()
+        if os.path.exists(self.checkpoint):
+            os.remove(self.checkpoint)
+        self.stdout.write(f'Готово: {self.done} картинок, {self.speed()}')
+
+    def batches(self, last_pk, batch_size):
+        posts = Post.objects.exclude(image='').order_by('pk')
+        while True:
+            batch = list(
+                posts.filter(pk__gt=last_pk)
+                .values_list('pk', flat=True)[:batch_size]
+            )
+            if not batch:
+                return
+            last_pk = batch[-1]
+            yield batch
+
+    def throttle(self, submitted, rate):
+        if rate:
+            delay = self.started + submitted / rate - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+
+    def drain(self, in_flight):
+        last_pk = None
+        while in_flight and in_flight[0][1].done():
+            last_pk, future = in_flight.popleft()
+            self.done += future.result()
+        if last_pk is not None:
+            self.save_checkpoint(last_pk)
+            self.stdout.write(
+                f'До поста {last_pk}: {self.done} картинок, {self.speed()}')
+
+    def speed(self):
+        elapsed = time.monotonic() - self.started
+        return f'{self.done / elapsed if elapsed else 0:.1f} в секунду'
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint) as file:
+                return json.load(file)['last_pk']
+        except (OSError, ValueError, KeyError):
+            return 0
+
+    def save_checkpoint(self, last_pk):
+        os.makedirs(os.path.dirname(self.checkpoint), exist_ok=True)
+        temp_path = f'{self.checkpoint}.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump({'last_pk': last_pk}, file)
+        os.replace(temp_path, self.checkpoint)
@@ -0,0 +1,23 @@
+# Generated by Django 2.2.16 on 2026-10-18 02:40
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0017_auto_20261018_0225'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            sql=[
+                "CREATE VIRTUAL TABLE posts_post_fts USING fts5("
+                "text, tokenize='unicode61 remove_diacritics 2', "
+                "prefix='2 3 4')",
+                "INSERT INTO posts_post_fts (rowid, text) "
+                "SELECT id, text FROM posts_post",
+            ],
+            reverse_sql=['DROP TABLE posts_post_fts'],
+        ),
+    ]
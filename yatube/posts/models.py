@@ -1,10 +1,42 @@
 from django.db import models
 from django.contrib.auth import get_user_model
 
+from core.storage import content_storage
+
+from .lookups import FullTextField
+
 User = get_user_model()
 
 
-class Group(models.Model):
+class CounterFieldsMixin:
+    """Счётчики меняются только атомарным UPDATE со сдвигом F(),
+    поэтому UPDATE из обычного save() их не перезаписывает, а новая
+    строка начинает их с нуля. Так же в UPDATE пропускаются
+    background_fields, которые пишут фоновые задачи."""
+    counter_fields = ()
+    background_fields = ()
+
+    def _do_update(self, base_qs, using, pk_val, values, update_fields,
+                   forced_update):
+        # Поля убираются только из UPDATE: если строки нет, save() как
+        # обычно вставит объект целиком, а явный update_fields пишет всё.
+        if update_fields is None:
+            skipped = set(self.counter_fields) | set(self.background_fields)
+            values = [
+                value for value in values if value[0].name not in skipped]
+        return super()._do_update(
+            base_qs, using, pk_val, values, update_fields, forced_update)
+
+    def _do_insert(self, manager, using, fields, update_pk, raw):
+        if not raw:
+            # На новую строку ещё ничего не ссылается, в том числе на копию
+            # через pk = None или на заново вставленную удалённую строку.
+            for name in self.counter_fields:
+                setattr(self, name, self._meta.get_field(name).get_default())
+        return super()._do_insert(manager, using, fields, update_pk, raw)
+
+
+class Group(CounterFieldsMixin, models.Model):
     title = models.CharField(
         max_length=200,
         help_text='Введите название группы',
@@ -17,12 +49,18 @@ class Group(models.Model):
     description = models.TextField(
         help_text='Введите описание группы',
         verbose_name='Описание группы')
+    posts_count = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество постов')
+
+    counter_fields = ('posts_count', )
 
     def __str__(self):
         return self.title
 
 
-class Post(models.Model):
+class Post(CounterFieldsMixin, models.Model):
     text = models.TextField(
         help_text='Введите текст поста',
         verbose_name='Текст поста')
@@ -46,19 +84,69 @@ class Post(models.Model):
         verbose_name='Группа')
     image = models.ImageField(
         upload_to='posts/',
+        storage=content_storage,
         blank=True,
         help_text='Загрузите картинку',
         verbose_name='Картинка'
     )
+    comments_count = models.IntegerField(
+        default=0,
+        editable=False,
+        verbose_name='Количество комментариев'
+    )
+    image_variants = models.TextField(
+        blank=True,
+        default='',
+        editable=False,
+        verbose_name='Варианты картинки (JSON)'
+    )
+
+    counter_fields = ('comments_count', )
+    # image_variants заполняет фоновая задача через UPDATE, save() из
+    # формы не должен затирать его устаревшим значением.
+    background_fields = ('image_variants', )
 
     class Meta:
         ordering = ('-pub_date', )
+        indexes = (
+            models.Index(
+                fields=('-pub_date', '-id', ),
+                name='post_feed_idx'
+            ),
+            models.Index(
+                fields=('author', '-pub_date', '-id', ),
+                name='post_author_feed_idx'
+            ),
+            models.Index(
+                fields=('group', '-pub_date', '-id', ),
+                name='post_group_feed_idx'
+            ),
+        )
         verbose_name_plural = 'Даты',
         verbose_name = 'Дата'
 
     def __str__(self):
         return self.text[:15]
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Нужны счётчикам и кэшу, чтобы заметить смену автора или группы.
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self._loaded_values = {
+            field.attname: getattr(self, field.attname)
+            for field in self._meta.concrete_fields
+        }
+
+    def loaded_value(self, attname):
+        """Значение поля на момент загрузки из базы или прошлого save()."""
+        loaded = getattr(self, '_loaded_values', {})
+        return loaded.get(attname, getattr(self, attname))
+
 
 class Comment(models.Model):
     post = models.ForeignKey(
@@ -85,6 +173,12 @@ class Comment(models.Model):
 
     class Meta:
         ordering = ('-created', )
+        indexes = (
+            models.Index(
+                fields=('post', '-created', '-id', ),
+                name='comment_post_idx'
+            ),
+        )
         verbose_name_plural = 'Даты',
         verbose_name = 'Дата'
 
@@ -103,6 +197,10 @@ class Follow(models.Model):
         on_delete=models.CASCADE,
         related_name='following'
     )
+    in_timeline = models.BooleanField(
+        default=True,
+        verbose_name='Посты автора разложены по ленте подписчика'
+    )
 
     class Meta:
         constraints = (
@@ -111,6 +209,90 @@ class Follow(models.Model):
                 name='unique_follow'
             ),
         )
+        indexes = (
+            models.Index(
+                fields=('author', 'user', ),
+                name='follow_author_user_idx'
+            ),
+        )
 
     def __str__(self):
         return self.user
+
+
+class UserStats(models.Model):
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name='stats'
+    )
+    posts_count = models.IntegerField(
+        default=0,
+        verbose_name='Количество постов'
+    )
+    followers_count = models.IntegerField(
+        default=0,
+        verbose_name='Количество подписчиков'
+    )
+    following_count = models.IntegerField(
+        default=0,
+        verbose_name='Количество подписок'
+    )
+
+    def __str__(self):
+        return str(self.user_id)
+
+
+class TimelineEntry(models.Model):
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='timeline'
+    )
+    post = models.ForeignKey(
+        Post,
+        on_delete=models.CASCADE,
+        related_name='timeline_entries'
+    )
+    author = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+        related_name='+'
+    )
+    pub_date = models.DateTimeField()
+
+    class Meta:
+        constraints = (
+            models.UniqueConstraint(
+                fields=('user', 'post', ),
+                name='unique_timeline_entry'
+            ),
+        )
+        indexes = (
+            models.Index(
+                fields=('user', '-pub_date', '-post', ),
+                name='timeline_feed_idx'
+            ),
+            models.Index(
+                fields=('user', 'author', ),
+                name='timeline_author_idx'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.user_id}: {self.post_id}'
+
+
+class PostSearchIndex(models.Model):
+    """Строка полнотекстового индекса постов; rowid равен id поста.
+
+    Таблицу создаёт миграция как виртуальную таблицу FTS5, модель нужна
+    для подзапросов вида text__match.
+    """
+    rowid = models.IntegerField(primary_key=True)
+    text = FullTextField()
+
+    class Meta:
+        managed = False
+        db_table = 'posts_post_fts'
@@ -0,0 +1,193 @@
+import os
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from sorl.thumbnail import default
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix, del_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import KVStore as CachedDbStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core.models import StoredFile
+from core.storage import content_storage
+from core.utils import batches
+
+from .models import Post
+from .uploads import UPLOADS, remove
+
+# SQLite не принимает больше 999 параметров в одном запросе.
+BATCH_SIZE = 500
+# Файл мог только что загрузиться, а пост ещё не сохранён, или миниатюра
+# уже записана, а запись о ней в хранилище sorl ещё нет.
+MIN_AGE = 60 * 60
+
+# Брошенные загрузки и сессии докачки.
+UPLOAD_TTL = 24 * 60 * 60
+
+IMAGES = 'posts'
+THUMBNAILS = 'cache'
+
+
+def walk_files(directory, min_age):
+    """Имена файлов каталога MEDIA_ROOT старше min_age секунд.
+
+    Обход идёт через os.scandir со стеком каталогов, так что в памяти
+    не бывает полного списка файлов.
+    """
+    root = settings.MEDIA_ROOT
+    deadline = time.time() - min_age
+    stack = [os.path.join(root, directory)]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    if stat.st_mtime < deadline:
+                        name = os.path.relpath(entry.path, root)
+                        yield name.replace(os.sep, '/'), stat.st_size
+
+
+def source_files(name):
+    """Исходник в обоих хранилищах: ключи sorl зависят от хранилища,
+    а картинки до хранилища по хэшу сохранялись в default_storage."""
+    return (ImageFile(name, content_storage), ImageFile(name, default_storage))
+
+
+def remove_image(name):
+    """Удаляет картинку, если на неё так и нет ссылок в StoredFile.
+
+    Загрузка тех же байтов не переписывает файл, а только добавляет
+    ссылку, поэтому старый по mtime файл мог снова понадобиться.
+    """
+    with transaction.atomic():
+        stored = (
+            StoredFile.objects.select_for_update().filter(name=name).first()
+        )
+        if stored is not None and stored.references:
+            return False
+        for image_file in source_files(name):
+            default.kvstore.delete(image_file)
+        if stored is not None:
+            stored.delete()
+        os.remove(os.path.join(settings.MEDIA_ROOT, name))
+    return True
+
+
+def sweep_images(stats, dry_run, batch_size, min_age):
+    """Картинки, на которые не ссылается ни один пост, вместе с их
+    миниатюрами."""
+    files = walk_files(IMAGES, min_age)
+    for batch in batches(files, batch_size):
+        sizes = dict(batch)
+        used = set(
+            Post.objects.filter(image__in=sizes).values_list(
+                'image', flat=True)
+        )
+        held = set(
+            StoredFile.objects.filter(
+                name__in=sizes, references__gt=0).values_list(
+                'name', flat=True)
+        )
+        for name, size in sizes.items():
+            if name in used or name in held:
+                continue
+            if not dry_run and not remove_image(name):
+                continue
+            stats['images'] += 1
+            stats['bytes'] += size
+
+
+def kv_rows(batch_size):
+    """Записи хранилища sorl пачками по возрастанию ключа."""
+    last_key = ''
+    while True:
+        rows = list(
+            KVStoreModel.objects.filter(key__gt=last_key)
+            .order_by('key').values_list('key', 'value')[:batch_size]
+        )
+        if not rows:
+            return
+        last_key = rows[-1][0]
+        yield rows
+
+
+def sweep_kvstore(stats, dry_run, batch_size):
+    """Записи sorl о пропавших файлах и списки миниатюр без исходника."""
+    images = add_prefix('', 'image')
+    thumbnails = add_prefix('', 'thumbnails')
+    for rows in kv_rows(batch_size):
+        sources = {
+            key: add_prefix(del_prefix(key), 'image')
+            for key, value in rows if key.startswith(thumbnails)
+        }
+        alive = set(
+            KVStoreModel.objects.filter(
+                key__in=set(sources.values())).values_list('key', flat=True)
+        )
+        for key, value in rows:
+            if key.startswith(images):
+                image_file = deserialize_image_file(value)
+                stale = not image_file.exists()
+            else:
+                image_file = None
+                stale = key in sources and sources[key] not in alive
+            if not stale:
+                continue
+            stats['kv entries'] += 1
+            if dry_run:
+                continue
+            if image_file is not None:
+                default.kvstore.delete(image_file)
+            else:
+                default.kvstore._delete_raw(key)
+
+
+def sweep_thumbnails(stats, dry_run, batch_size, min_age):
+    """Файлы миниатюр, о которых не знает хранилище sorl."""
+    files = walk_files(THUMBNAILS, min_age)
+    for batch in batches(files, batch_size):
+        keys = {
+            add_prefix(ImageFile(name, default.storage).key): (name, size)
+            for name, size in batch
+        }
+        known = set(
+            KVStoreModel.objects.filter(key__in=keys).values_list(
+                'key', flat=True)
+        )
+        for key, (name, size) in keys.items():
+            if key in known:
+                continue
+            stats['thumbnails'] += 1
+            stats['bytes'] += size
+            if not dry_run:
+                default.storage.delete(name)
+
+
+def sweep_uploads(stats, dry_run):
+    for name, size in walk_files(UPLOADS, UPLOAD_TTL):
+        stats['uploads'] += 1
+        stats['bytes'] += size
+        if not dry_run:
+            remove(os.path.join(settings.MEDIA_ROOT, name))
+
+
+def collect(dry_run=False, batch_size=BATCH_SIZE, min_age=MIN_AGE):
+    """Mark-and-sweep медиафайлов: удаляет картинки без постов, их
+    миниатюры, устаревшие записи sorl и брошенные загрузки. Возвращает
+    счётчики удалённого (или того, что было бы удалено при dry_run)."""
+    stats = Counter()
+    sweep_images(stats, dry_run, batch_size, min_age)
+    sweep_uploads(stats, dry_run)
+    if isinstance(default.kvstore, CachedDbStore):
+        sweep_kvstore(stats, dry_run, batch_size)
+        sweep_thumbnails(stats, dry_run, batch_size, min_age)
+    return stats
@@ -0,0 +1,244 @@
+import base64
+import binascii
+import json
+
+from django.core.cache import cache
+from django.core.paginator import Page, Paginator
+from django.db.models import Max, Q
+from django.shortcuts import redirect
+from django.utils.dateparse import parse_datetime
+from django.utils.functional import cached_property
+
+from core.cache import get_or_compute
+
+# Свежесть страницы в get_cached_page: содержимое ключ и так меняет с
+# поколением, время ограничивает лишь то, что поколения не отслеживают.
+PAGE_TIMEOUT = 60
+# Поля ключа с датой: в курсоре они записаны в ISO 8601.
+DATE_FIELDS = ('pub_date', 'created')
+
+
+class CursorPaginator(Paginator):
+    """Постраничный вывод по ключу (keyset) вместо OFFSET.
+
+    Страница адресуется непрозрачным курсором с ключом крайней записи
+    соседней страницы, поэтому запрос стоит одинаково на любой глубине
+    и не требует COUNT(*).
+
+    Число записей для «страница N из M» берётся из поддерживаемого
+    счётчика (count), из кэша по count_key или из дешёвой оценки;
+    точный COUNT(*) не выполняется.
+    """
+    ordering = ('-pub_date', '-id')
+    count_timeout = 300
+
+    def __init__(self, object_list, per_page, ordering=None, count=None,
+                 count_key=None):
+        super().__init__(object_list, per_page)
+        if ordering is not None:
+            self.ordering = tuple(ordering)
+        self.fields = tuple(field.lstrip('-') for field in self.ordering)
+        self.descending = self.ordering[0].startswith('-')
+        self.known_count = count
+        self.count_key = count_key
+        self.count_is_exact = count is not None
+
+    @cached_property
+    def count(self):
+        if self.known_count is not None:
+            return self.known_count
+        if self.count_key is None:
+            return self.estimate_count()
+        count = cache.get(self.count_key)
+        if count is None:
+            count = self.estimate_count()
+            cache.set(self.count_key, count, self.count_timeout)
+        return count
+
+    def estimate_count(self):
+        """Оценка сверху для всей таблицы: наибольший первичный ключ.
+
+        Один шаг по индексу первичного ключа; для выборок с фильтром
+        число записей нужно передавать через count.
+        """
+        return self.object_list.aggregate(last=Max('pk'))['last'] or 0
+
+    def get_page(self, cursor):
+        position = self.decode_cursor(cursor)
+        if position is None:
+            number, reverse, values = 1, False, None
+        else:
+            number, reverse, values = position
+        rows = self.fetch(values, reverse, self.per_page + 1)
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            if not has_more:
+                # Дошли до начала ленты: отдаём полную первую страницу.
+                return self.get_page(None)
+            rows.reverse()
+            has_previous, has_next = True, True
+        else:
+            has_previous, has_next = values is not None, has_more
+        page = Page(rows, number, self)
+        page.cursor = cursor if position is not None else ''
+        page.next_cursor = None
+        page.previous_cursor = None
+        if rows and has_next:
+            page.next_cursor = self.encode_cursor(
+                number + 1, False, self.key(rows[-1]))
+        if rows and has_previous:
+            page.previous_cursor = self.encode_cursor(
+                max(number - 1, 1), True, self.key(rows[0]))
+        return page
+
+    def get_cached_page(self, cursor, key, prepare=None,
+                        timeout=PAGE_TIMEOUT):
+        """get_page через кэш со stale-while-revalidate (get_or_compute).
+
+        key должен меняться вместе с содержимым ленты, например по
+        поколению её области кэша. prepare(rows) дополняет записи перед
+        сохранением в кэш, как thumbnails.attach. Устаревшая страница
+        пересчитывается в фоне: она зависит только от key и курсора.
+        """
+        if self.decode_cursor(cursor) is None:
+            cursor = ''
+
+        def compute():
+            page = self.get_page(cursor)
+            rows = list(page)
+            if prepare is not None:
+                prepare(rows)
+            return (rows, page.number, page.cursor, page.next_cursor,
+                    page.previous_cursor)
+
+        rows, number, *cursors = get_or_compute(
+            f'{key}:{cursor}', compute, timeout, background=True)
+        page = Page(rows, number, self)
+        page.cursor, page.next_cursor, page.previous_cursor = cursors
+        return page
+
+    def fetch(self, values, reverse, limit):
+        queryset = self.object_list
+        if values is not None:
+            queryset = queryset.filter(self.after(values, reverse))
+        return list(queryset.order_by(*self.order(reverse))[:limit])
+
+    def order(self, reverse=False, fields=None):
+        descending = self.descending != reverse
+        return tuple(
+            ('-' if descending else '') + field
+            for field in (fields or self.fields)
+        )
+
+    def after(self, values, reverse=False, fields=None):
+        """Условие «строго после ключа values» в порядке выдачи."""
+        fields = fields or self.fields
+        lookup = 'lt' if self.descending != reverse else 'gt'
+        condition = Q()
+        for index, field in enumerate(fields):
+            step = Q(**{f'{field}__{lookup}': values[index]})
+            for previous, value in zip(fields[:index], values):
+                step &= Q(**{previous: value})
+            condition |= step
+        # Нестрогая граница по первому полю даёт планировщику диапазон
+        # по индексу вместо перебора веток OR.
+        return Q(**{f'{fields[0]}__{lookup}e': values[0]}) & condition
+
+    def key(self, obj):
+        return [getattr(obj, field) for field in self.fields]
+
+    def cursor_for_page(self, number):
+        """Курсор, равный старой ссылке ?page=number.
+
+        Для перевода старых ссылок один раз платим OFFSET; дальше
+        листание идёт по курсорам.
+        """
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            return None
+        if number <= 1:
+            return None
+        offset = (number - 1) * self.per_page - 1
+        rows = list(
+            self.object_list.order_by(*self.order())
+            .values_list(*self.fields)[offset:offset + 1]
+        )
+        if not rows:
+            return None
+        return self.encode_cursor(number, False, list(rows[0]))
+
+    def encode_cursor(self, number, reverse, values):
+        payload = json.dumps(
+            [number, reverse, values],
+            default=lambda value: value.isoformat(),
+            separators=(',', ':'),
+        )
+        token = base64.urlsafe_b64encode(payload.encode())
+        return token.decode().rstrip('=')
+
+    def decode_cursor(self, cursor):
+        if not cursor:
+            return None
+        try:
+            payload = base64.urlsafe_b64decode(
+                cursor + '=' * (-len(cursor) % 4))
+            number, reverse, values = json.loads(payload.decode())
+        except (binascii.Error, UnicodeError, TypeError, ValueError):
+            return None
+        if (
+            not isinstance(number, int) or number < 1
+            or not isinstance(values, list)
+            or len(values) != len(self.fields)
+        ):
+            return None
+        try:
+            values = [
+                self.coerce(field, value)
+                for field, value in zip(self.fields, values)
+            ]
+        except (TypeError, ValueError):
+            return None
+        return number, bool(reverse), values
+
+    def coerce(self, field, value):
+        """Значение ключа из курсора в тип поля; курсор подделывают."""
+        if field in DATE_FIELDS:
+            parsed = parse_datetime(value) if isinstance(value, str) else None
+            if parsed is None:
+                raise ValueError(value)
+            return parsed
+        if isinstance(value, bool):
+            raise TypeError(value)
+        return int(value)
+
+
+class EstimatedCountPaginator(Paginator):
+    """Постраничный вывод по номерам без COUNT(*) по всей таблице.
+
+    Для выборки без фильтров число строк оценивается сверху наибольшим
+    первичным ключом; отфильтрованная выборка считается как обычно.
+    """
+
+    @cached_property
+    def count(self):
+        if self.object_list.query.where:
+            return super().count
+        return self.object_list.aggregate(last=Max('pk'))['last'] or 0
+
+
+def legacy_page_redirect(request, paginator):
+    """Переводит старую ссылку ?page=N на эквивалентный курсор.
+
+    Перенаправление временное: курсор указывает на позицию в текущих
+    данных и с новыми постами перестаёт соответствовать номеру страницы.
+    """
+    query = request.GET.copy()
+    cursor = paginator.cursor_for_page(query.pop('page')[-1])
+    if cursor:
+        query['cursor'] = cursor
+    url = request.path
+    if query:
+        url = f'{url}?{query.urlencode()}'
+    return redirect(url)
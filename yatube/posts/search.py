@@ -0,0 +1,268 @@
+import hashlib
+import re
+
+from django.db import connection
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .models import Post, PostSearchIndex
+from .paginators import CursorPaginator
+
+TABLE = 'posts_post_fts'
+BATCH_SIZE = 500
+SNIPPET_WORDS = 16
+# Метки подсветки, которых не бывает в тексте поста: snippet() вставляет
+# их как есть, а HTML из текста нужно экранировать.
+MARK_START, MARK_END = '\x02', '\x03'
+
+WORD = re.compile(r'\w+')
+CYRILLIC = re.compile('[а-я]')
+
+# Стеммер Snowball для русского языка.
+VOWELS = 'аеиоуыэюя'
+PERFECTIVE_GERUND = (
+    ('в', 'вши', 'вшись'),
+    ('ив', 'ивши', 'ившись', 'ыв', 'ывши', 'ывшись'),
+)
+ADJECTIVE = ((), (
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем',
+    'им', 'ым', 'ом', 'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю',
+    'ая', 'яя', 'ою', 'ею',
+))
+PARTICIPLE = (('ем', 'нн', 'вш', 'ющ', 'щ'), ('ивш', 'ывш', 'ующ'))
+REFLEXIVE = ((), ('ся', 'сь'))
+VERB = (
+    (
+        'ла', 'на', 'ете', 'йте', 'ли', 'й', 'л', 'ем', 'н', 'ло', 'но',
+        'ет', 'ют', 'ны', 'ть', 'ешь', 'нно',
+    ),
+    (
+        'ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ей',
+        'уй', 'ил', 'ыл', 'им', 'ым', 'ен', 'ило', 'ыло', 'ено', 'ят',
+        'ует', 'уют', 'ит', 'ыт', 'ены', 'ить', 'ыть', 'ишь', 'ую', 'ю',
+    ),
+)
+NOUN = ((), (
+    'а', 'ев', 'ов', 'ие', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии',
+    'и', 'ией', 'ей', 'ой', 'ий', 'й', 'иям', 'ям', 'ием', 'ем', 'ам',
+    'ом', 'о', 'у', 'ах', 'иях', 'ях', 'ы', 'ь', 'ию', 'ью', 'ю', 'ия',
+    'ья', 'я',
+))
+SUPERLATIVE = ('ейше', 'ейш')
+DERIVATIONAL = ('ость', 'ост')
+
+
+def _regions(word):
+    """Начала областей RV и R2 по правилам Snowball."""
+    rv = r1 = r2 = len(word)
+    for index, letter in enumerate(word):
+        if letter in VOWELS:
+            rv = index + 1
+            break
+    for index in range(1, len(word)):
+        if word[index - 1] in VOWELS and word[index] not in VOWELS:
+            r1 = index + 1
+            break
+    for index in range(r1 + 1, len(word)):
+        if word[index - 1] in VOWELS and word[index] not in VOWELS:
+            r2 = index + 1
+            break
+    return rv, r2
+
+
+def _strip(word, rv, endings):
+    """Отрезает самое длинное окончание из endings внутри RV.
+
+    Окончания первой группы должны идти после «а» или «я», которые
+    остаются в слове.
+    """
+    after_a, plain = endings
+    candidates = [(ending, True) for ending in after_a]
+    candidates += [(ending, False) for ending in plain]
+    candidates.sort(key=lambda candidate: -len(candidate[0]))
+    for ending, needs_a in candidates:
+        start = len(word) - len(ending)
+        if not word.endswith(ending) or start < rv:
+            continue
+        if needs_a and (start - 1 < rv or word[start - 1] not in 'ая'):
+            continue
+        return word[:start]
+    return None
+
+
+def _strip_inflection(word, rv):
+    """Шаг 1: окончания деепричастий, иначе возвратные и прочие."""
+    stripped = _strip(word, rv, PERFECTIVE_GERUND)
+    if stripped is not None:
+        return stripped
+    word = _strip(word, rv, REFLEXIVE) or word
+    stripped = _strip(word, rv, ADJECTIVE)
+    if stripped is not None:
+        return _strip(stripped, rv, PARTICIPLE) or stripped
+    return _strip(word, rv, VERB) or _strip(word, rv, NOUN) or word
+
+
+def _tidy_up(word, rv):
+    """Шаг 4: превосходная степень, двойное «н» и мягкий знак."""
+    for ending in SUPERLATIVE:
+        if word.endswith(ending) and len(word) - len(ending) >= rv:
+            word = word[:-len(ending)]
+            break
+    if word.endswith('нн') and len(word) - 2 >= rv:
+        return word[:-1]
+    if word.endswith('ь') and len(word) - 1 >= rv:
+        return word[:-1]
+    return word
+
+
+def stem(word):
+    """Основа русского слова (Snowball); остальные слова как есть."""
+    word = word.lower().replace('ё', 'е')
+    if not CYRILLIC.search(word):
+        return word
+    rv, r2 = _regions(word)
+    word = _strip_inflection(word, rv)
+    if word.endswith('и') and len(word) - 1 >= rv:
+        word = word[:-1]
+    # Шаг 3: словообразовательные суффиксы в R2.
+    for ending in DERIVATIONAL:
+        if word.endswith(ending) and len(word) - len(ending) >= r2:
+            word = word[:-len(ending)]
+            break
+    return _tidy_up(word, rv)
+
+
+def build_query(text):
+    """Запрос FTS5: каждое слово как префикс его основы.
+
+    Индекс хранит исходный текст, поэтому подсветка показывает слова
+    как они написаны, а «посты» и «постов» находятся по основе «пост».
+    """
+    terms = []
+    for word in WORD.findall(text.lower()):
+        base = stem(word)
+        if CYRILLIC.search(base):
+            terms.append(f'"{base}"*')
+        else:
+            terms.append(f'"{base}"')
+    return ' '.join(terms)
+
+
+def matching_posts(text):
+    """Подзапрос id постов, найденных по тексту, для pk__in."""
+    match = build_query(text)
+    if not match:
+        return PostSearchIndex.objects.none().values('rowid')
+    return PostSearchIndex.objects.filter(text__match=match).values('rowid')
+
+
+def index_post(post):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [post.pk])
+        cursor.execute(
+            f'INSERT INTO {TABLE} (rowid, text) VALUES (%s, %s)',
+            [post.pk, post.text])
+
+
+def unindex_post(post):
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE} WHERE rowid = %s', [post.pk])
+
+
+def rebuild(batch_size=BATCH_SIZE):
+    """Пересобирает индекс пачками по первичному ключу."""
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {TABLE}')
+    last_pk, indexed = 0, 0
+    while True:
+        rows = list(
+            Post.objects.filter(pk__gt=last_pk)
+            .order_by('pk').values_list('pk', 'text')[:batch_size]
+        )
+        if not rows:
+            break
+        with connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {TABLE} (rowid, text) VALUES (%s, %s)', rows)
+        last_pk = rows[-1][0]
+        indexed += len(rows)
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {TABLE} ({TABLE}) VALUES ('optimize')")
+    return indexed
+
+
+def highlight(snippet):
+    return mark_safe(
+        escape(snippet)
+        .replace(MARK_START, '<mark>')
+        .replace(MARK_END, '</mark>')
+    )
+
+
+class SearchPaginator(CursorPaginator):
+    """Результаты поиска по релевантности (bm25), затем по id.
+
+    Курсор хранит ранг и id крайнего результата, так что следующая
+    страница не пересчитывает предыдущие.
+    """
+    ordering = ('rank', 'id')
+
+    def __init__(self, query, per_page):
+        self.match = build_query(query)
+        digest = hashlib.md5(self.match.encode()).hexdigest()
+        super().__init__(
+            Post.objects.none(), per_page, count_key=f'count:search:{digest}')
+        # Число совпадений считается по индексу точно, без оценки.
+        self.count_is_exact = True
+
+    def coerce(self, field, value):
+        if field == 'rank':
+            return float(value)
+        return super().coerce(field, value)
+
+    def fetch(self, values, reverse, limit):
+        if not self.match:
+            return []
+        lookup, direction = ('<', 'DESC') if reverse else ('>', 'ASC')
+        sql = (
+            f'SELECT rowid, rank, snippet({TABLE}, 0, %s, %s, %s, %s) '
+            f'FROM {TABLE} WHERE {TABLE} MATCH %s'
+        )
+        params = [MARK_START, MARK_END, '…', SNIPPET_WORDS, self.match]
+        if values is not None:
+            sql += (
+                f' AND (rank {lookup} %s OR (rank = %s AND rowid {lookup} %s))'
+            )
+            params += [values[0], values[0], values[1]]
+        sql += f' ORDER BY rank {direction}, rowid {direction} LIMIT %s'
+        params.append(limit)
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+        posts = Post.objects.select_related('author', 'group').in_bulk(
+            [row[0] for row in rows])
+        results = []
+        for pk, rank, snippet in rows:
+            post = posts.get(pk)
+            if post is None:
+                continue
+            post.rank = rank
+            post.snippet = highlight(snippet)
+            results.append(post)
+        return results
+
+    def key(self, obj):
+        return [obj.rank, obj.pk]
+
+    def estimate_count(self):
+        return self.match_count()
+
+    def match_count(self):
+        """COUNT совпадений в индексе FTS."""
+        if not self.match:
+            return 0
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'SELECT COUNT(*) FROM {TABLE} WHERE {TABLE} MATCH %s',
+                [self.match])
+            return cursor.fetchone()[0]
@@ -0,0 +1,145 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+
+from core import query_cache
+
+from . import counters, feeds, search, thumbnails, timeline
+from .models import Comment, Follow, Group, Post, User, UserStats
+
+query_cache.watch(Post, Group, User, UserStats)
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Post)
+def count_post(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        counters.post_saved(instance, created)
+
+
+@receiver(post_delete, sender=Post)
+def uncount_post(sender, instance, **kwargs):
+    counters.post_deleted(instance)
+
+
+@receiver(post_save, sender=Comment)
+def count_comment(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.comment_changed(instance, 1)
+
+
+@receiver(post_delete, sender=Comment)
+def uncount_comment(sender, instance, **kwargs):
+    counters.comment_changed(instance, -1)
+
+
+@receiver(post_save, sender=Follow)
+def count_follow(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        counters.follow_changed(instance, 1)
+
+
+@receiver(post_delete, sender=Follow)
+def uncount_follow(sender, instance, **kwargs):
+    counters.follow_changed(instance, -1)
+
+
+@receiver(post_save, sender=Post)
+def fan_out_post(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timeline.fan_out(instance)
+
+
+@receiver(post_save, sender=Follow)
+def backfill_timeline(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        timeline.backfill(instance)
+
+
+@receiver(post_delete, sender=Follow)
+def prune_timeline(sender, instance, **kwargs):
+    timeline.prune(instance)
+
+
+@receiver(post_save, sender=Post)
+def index_post(sender, instance, update_fields=None, raw=False, **kwargs):
+    if raw or (update_fields is not None and 'text' not in update_fields):
+        return
+    search.index_post(instance)
+
+
+@receiver(post_delete, sender=Post)
+def unindex_post(sender, instance, **kwargs):
+    search.unindex_post(instance)
+
+
+@receiver(post_save, sender=Post)
+def make_thumbnails(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    if created or instance.image != instance.loaded_value('image'):
+        thumbnails.image_changed(instance)
+
+
+@receiver(pre_save, sender=Post)
+def note_image_upload(sender, instance, raw=False, **kwargs):
+    # Файл сохраняется в хранилище позже, уже при записи поля.
+    instance._image_uploaded = bool(instance.image) and not (
+        instance.image._committed)
+
+
+@receiver(post_save, sender=Post)
+def release_old_image(sender, instance, created, raw=False, **kwargs):
+    old_name = str(instance.loaded_value('image') or '')
+    if raw or created or not old_name:
+        return
+    # Те же байты загружены заново: хранилище взяло вторую ссылку на
+    # старое имя, одну из них отпускаем.
+    if old_name != instance.image.name or instance._image_uploaded:
+        instance.image.storage.delete(old_name)
+
+
+@receiver(post_delete, sender=Post)
+def release_image(sender, instance, **kwargs):
+    if instance.image:
+        instance.image.storage.delete(instance.image.name)
+
+
+@receiver(post_save, sender=Post)
+@receiver(post_delete, sender=Post)
+def invalidate_post_feeds(sender, instance, raw=False, **kwargs):
+    if not raw:
+        feeds.post_changed(instance)
+
+
+@receiver(post_save, sender=Group)
+@receiver(post_delete, sender=Group)
+def invalidate_group_feeds(sender, instance, raw=False, **kwargs):
+    if not raw:
+        feeds.group_changed(instance)
+
+
+@receiver(post_save, sender=User)
+def invalidate_user_feeds(sender, instance, update_fields=None, raw=False,
+                          **kwargs):
+    # Вход на сайт сохраняет только last_login и ленты не меняет.
+    if not raw and update_fields != frozenset({'last_login'}):
+        feeds.user_changed(instance)
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def invalidate_comment_pages(sender, instance, raw=False, **kwargs):
+    if not raw:
+        feeds.comment_changed(instance)
+
+
+@receiver(post_save, sender=Follow)
+@receiver(post_delete, sender=Follow)
+def invalidate_follow_pages(sender, instance, raw=False, **kwargs):
+    if not raw:
+        feeds.follow_changed(instance)
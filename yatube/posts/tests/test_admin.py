@@ -0,0 +1,72 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import Client, TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from posts.models import Comment, Follow, Group, Post
+from posts.tests.utils import QueryBudgetMixin
+
+User = get_user_model()
+
+
+class AdminChangeListTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = User.objects.create_superuser(
+            username='admin', email='admin@test.ru', password='pass')
+        cls.reader = User.objects.create_user(username='reader')
+        for num in range(30):
+            author = User.objects.create_user(username=f'writer{num}')
+            group = Group.objects.create(
+                title=f'Группа {num}', slug=f'group{num}', description='-')
+            post = Post.objects.create(
+                author=author, group=group, text=f'Запись номер {num}')
+            Comment.objects.create(
+                post=post, author=author, text=f'Комментарий {num}')
+            Follow.objects.create(user=cls.reader, author=author)
+        cls.target = User.objects.create_user(username='alice')
+        cls.post = Post.objects.create(
+            author=cls.target, text='Про редких попугаев')
+
+    def setUp(self):
+        self.client = Client()
+        self.client.force_login(self.admin)
+
+    def test_changelists_fit_query_budget(self):
+        """Списки в админке рендерятся за фиксированное число запросов."""
+        for model in ('post', 'comment', 'follow'):
+            with self.subTest(model=model):
+                url = reverse(f'admin:posts_{model}_changelist')
+                response = self.assertQueryBudget(self.client, url, 5)
+                self.assertEqual(response.status_code, 200)
+
+    def test_changelist_skips_full_count(self):
+        """Список без фильтров не считает COUNT(*) по таблице."""
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('admin:posts_post_changelist'))
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'COUNT(' in query['sql']])
+
+    def test_search_by_username_prefix(self):
+        """Автор ищется по началу имени пользователя через индекс."""
+        url = reverse('admin:posts_post_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, {'q': 'ali'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.post])
+        search = [
+            query['sql'] for query in queries.captured_queries
+            if 'auth_user' in query['sql'] and 'username' in query['sql']
+            and 'posts_post' in query['sql']]
+        self.assertTrue(search)
+        self.assertFalse([sql for sql in search if 'LIKE' in sql])
+        response = self.client.get(
+            reverse('admin:posts_follow_changelist'), {'q': 'writer1'})
+        self.assertEqual(len(response.context['cl'].result_list), 11)
+
+    def test_search_by_text(self):
+        """Текст поста ищется по полнотекстовому индексу."""
+        response = self.client.get(
+            reverse('admin:posts_post_changelist'), {'q': 'попугай'})
+        self.assertEqual(list(response.context['cl'].result_list), [self.post])
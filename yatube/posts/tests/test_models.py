@@ -1,7 +1,8 @@
 from django.contrib.auth import get_user_model
 from django.test import TestCase
 
-from ..models import Group, Post, User
+from ..counters import reconcile
+from ..models import Comment, Follow, Group, Post, User, UserStats
 
 User = get_user_model()
 
@@ -59,3 +60,90 @@ class GroupModelTest(TestCase):
         helptext_test = GroupModelTest.group
         help_text = helptext_test._meta.get_field('title').help_text
         self.assertEqual(help_text, 'Введите название группы')
+
+
+class CountersTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user(username='author')
+        self.reader = User.objects.create_user(username='reader')
+        self.group = Group.objects.create(
+            title='Группа', slug='group', description='Описание')
+        self.other_group = Group.objects.create(
+            title='Другая', slug='other', description='Описание')
+        self.post = Post.objects.create(
+            author=self.author, text='Текст', group=self.group)
+
+    def assertCounts(self, obj, **expected):
+        obj.refresh_from_db()
+        for field, value in expected.items():
+            with self.subTest(obj=obj, field=field):
+                self.assertEqual(getattr(obj, field), value)
+
+    def test_post_counters(self):
+        """Создание, перенос и удаление поста обновляют счётчики."""
+        self.assertCounts(self.author.stats, posts_count=1)
+        self.assertCounts(self.group, posts_count=1)
+        post = Post.objects.get(pk=self.post.pk)
+        post.group = self.other_group
+        post.save()
+        self.assertCounts(self.group, posts_count=0)
+        self.assertCounts(self.other_group, posts_count=1)
+        post.delete()
+        self.assertCounts(self.author.stats, posts_count=0)
+        self.assertCounts(self.other_group, posts_count=0)
+
+    def test_comment_and_follow_counters(self):
+        """Комментарии и подписки обновляют счётчики."""
+        comment = Comment.objects.create(
+            post=self.post, author=self.reader, text='Комментарий')
+        follow = Follow.objects.create(user=self.reader, author=self.author)
+        self.assertCounts(self.post, comments_count=1)
+        self.assertCounts(self.author.stats, followers_count=1)
+        self.assertCounts(self.reader.stats, following_count=1)
+        comment.delete()
+        follow.delete()
+        self.assertCounts(self.post, comments_count=0)
+        self.assertCounts(self.author.stats, followers_count=0)
+        self.assertCounts(self.reader.stats, following_count=0)
+
+    def test_save_does_not_overwrite_counter(self):
+        """Сохранение устаревшего объекта не затирает счётчик."""
+        stale = Post.objects.get(pk=self.post.pk)
+        Comment.objects.create(
+            post=self.post, author=self.reader, text='Комментарий')
+        stale.text = 'Новый текст'
+        stale.save()
+        self.assertCounts(self.post, comments_count=1, text='Новый текст')
+
+    def test_copy_and_reinsert(self):
+        """Копия через pk = None и сохранение удалённой строки вставляют
+        объект заново, счётчики новой строки начинаются с нуля."""
+        Comment.objects.create(
+            post=self.post, author=self.reader, text='Комментарий')
+        group = Group.objects.get(pk=self.group.pk)
+        group.pk = None
+        group.slug = 'copy'
+        group.save()
+        post = Post.objects.get(pk=self.post.pk)
+        post.pk = None
+        post.group = group
+        post.save()
+        self.assertNotEqual(post.pk, self.post.pk)
+        self.assertCounts(group, posts_count=1)
+        self.assertCounts(post, comments_count=0)
+        self.assertCounts(self.post, comments_count=1)
+        self.assertCounts(self.author.stats, posts_count=2)
+        deleted = Group.objects.get(pk=self.other_group.pk)
+        Group.objects.filter(pk=deleted.pk).delete()
+        deleted.save()
+        self.assertTrue(Group.objects.filter(pk=deleted.pk).exists())
+
+    def test_reconcile_repairs_drift(self):
+        """reconcile() чинит разошедшиеся счётчики."""
+        Group.objects.update(posts_count=42)
+        UserStats.objects.filter(user=self.reader).delete()
+        repaired = reconcile()
+        self.assertEqual(repaired['Group.posts_count'], 2)
+        self.assertCounts(self.group, posts_count=1)
+        self.assertCounts(self.other_group, posts_count=0)
+        self.assertTrue(UserStats.objects.filter(user=self.reader).exists())
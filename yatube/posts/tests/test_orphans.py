@@ -0,0 +1,111 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO, StringIO
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from PIL import Image
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core.storage import content_storage
+from posts import orphans, thumbnails
+from posts.models import Post
+
+User = get_user_model()
+
+
+@override_settings(THUMBNAIL_ASYNC=False)
+class OrphanedMediaTest(TestCase):
+    def setUp(self):
+        # Свой MEDIA_ROOT на тест: записи sorl откатываются, а файлы нет.
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+
+    def create_post(self, color):
+        buffer = BytesIO()
+        Image.new('RGB', (40, 20), color).save(buffer, 'PNG')
+        image = SimpleUploadedFile('image.png', buffer.getvalue())
+        # В TestCase on_commit не срабатывает: выполняем задачу сразу.
+        with mock.patch(
+            'posts.thumbnails.transaction.on_commit',
+            side_effect=lambda task: task(),
+        ):
+            return Post.objects.create(
+                author=self.author, text='С картинкой', image=image)
+
+    def path(self, name):
+        return os.path.join(settings.MEDIA_ROOT, name)
+
+    def thumbnail_path(self, post):
+        url = thumbnails.attach([post])[0].thumbnail.url
+        return self.path(url[len(settings.MEDIA_URL):])
+
+    def test_dry_run_keeps_files(self):
+        """Пробный прогон только считает осиротевшие файлы"""
+        post = self.create_post('red')
+        name = post.image.name
+        post.delete()
+        stats = orphans.collect(dry_run=True, min_age=0)
+        self.assertEqual(stats['images'], 1)
+        self.assertTrue(os.path.exists(self.path(name)))
+
+    def test_orphans_removed_with_thumbnails(self):
+        """Картинка без поста удаляется вместе с миниатюрами и записями
+        sorl, картинки живых постов остаются"""
+        kept = self.create_post('green')
+        post = self.create_post('red')
+        name = post.image.name
+        thumbnail = self.thumbnail_path(post)
+        kv_entries = KVStoreModel.objects.count()
+        post.delete()
+        stats = orphans.collect(batch_size=1, min_age=0)
+        self.assertEqual(stats['images'], 1)
+        self.assertFalse(os.path.exists(self.path(name)))
+        self.assertFalse(os.path.exists(thumbnail))
+        self.assertLess(KVStoreModel.objects.count(), kv_entries)
+        self.assertTrue(os.path.exists(self.path(kept.image.name)))
+        self.assertTrue(os.path.exists(self.thumbnail_path(kept)))
+
+    def test_referenced_files_kept(self):
+        """Картинка без поста, на которую снова взяли ссылку, остаётся:
+        повторная загрузка тех же байтов не обновляет mtime файла"""
+        post = self.create_post('red')
+        name = post.image.name
+        post.delete()
+        content_storage.acquire(name, post.image.size)
+        stats = orphans.collect(min_age=0)
+        self.assertEqual(stats['images'], 0)
+        self.assertTrue(os.path.exists(self.path(name)))
+        self.assertFalse(orphans.remove_image(name))
+        self.assertTrue(os.path.exists(self.path(name)))
+
+    def test_unknown_thumbnail_files_removed(self):
+        """Файл миниатюры без записи sorl удаляется"""
+        name = 'cache/00/00/unknown.jpg'
+        os.makedirs(os.path.dirname(self.path(name)))
+        with open(self.path(name), 'wb') as file:
+            file.write(b'jpeg')
+        stats = orphans.collect(min_age=0)
+        self.assertEqual(stats['thumbnails'], 1)
+        self.assertFalse(os.path.exists(self.path(name)))
+
+    def test_young_files_kept(self):
+        """Свежие файлы не трогаются: пост с ними мог ещё не сохраниться"""
+        post = self.create_post('red')
+        name = post.image.name
+        post.delete()
+        out = StringIO()
+        call_command('collect_orphaned_media', stdout=out)
+        self.assertIn('картинок 0', out.getvalue())
+        self.assertTrue(os.path.exists(self.path(name)))
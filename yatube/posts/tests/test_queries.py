@@ -0,0 +1,268 @@
+import re
+import shutil
+import tempfile
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import Client, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from core import query_cache, stats
+from core.query_cache import cached
+from posts.models import Comment, Follow, Group, Post
+from posts.tests.utils import QueryBudgetMixin
+
+User = get_user_model()
+
+FULL_SCAN = re.compile(r'\bSCAN (TABLE )?posts_\w+$')
+TEMP_SORT = 'USE TEMP B-TREE'
+
+
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Группа', slug='group', description='Описание')
+        Follow.objects.create(user=cls.reader, author=cls.author)
+        for num in range(25):
+            cls.post = Post.objects.create(
+                author=cls.author, text=f'Пост {num}', group=cls.group)
+            Comment.objects.create(
+                post=cls.post, author=cls.reader, text=f'Комментарий {num}')
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.client.force_login(self.reader)
+
+    def explain(self, sql):
+        # CaptureQueriesContext отдаёт SQL с уже подставленными значениями.
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assertIndexedQueries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+            next_cursor = getattr(
+                (response.context or {}).get('page_obj'), 'next_cursor', None)
+            if next_cursor:
+                self.client.get(url, {'cursor': next_cursor})
+        checked = 0
+        for query in queries.captured_queries:
+            sql = query['sql']
+            if not sql.startswith('SELECT') or 'posts_' not in sql:
+                continue
+            checked += 1
+            plan = self.explain(sql)
+            with self.subTest(url=url, sql=sql):
+                self.assertFalse(
+                    [step for step in plan if FULL_SCAN.search(step)],
+                    f'Полный просмотр таблицы: {plan}')
+                self.assertFalse(
+                    [step for step in plan if TEMP_SORT in step],
+                    f'Сортировка во временном B-дереве: {plan}')
+        self.assertTrue(checked, f'{url} не обращается к таблицам posts')
+
+    def test_feed_queries_use_indexes(self):
+        """Основные запросы страниц идут по индексам без сортировки."""
+        urls = (
+            reverse('posts:index'),
+            reverse('posts:group_list', args=[self.group.slug]),
+            reverse('posts:profile', args=[self.author.username]),
+            reverse('posts:post_detail', args=[self.post.pk]),
+            reverse('posts:follow_index'),
+        )
+        for url in urls:
+            self.assertIndexedQueries(url)
+
+    def test_follow_state_check_uses_index(self):
+        """Проверка подписки в profile_follow идёт по индексу."""
+        self.assertIndexedQueries(
+            reverse('posts:profile_follow', args=[self.author.username]))
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.reader = User.objects.create_user(username='reader')
+        cls.author = User.objects.create_user(username='author')
+        cls.group = Group.objects.create(
+            title='Группа', slug='group', description='Описание')
+        # У каждого поста свой автор и группа: так N+1 заметнее всего.
+        for num in range(settings.PAGINATOR_POSTS + 1):
+            author = User.objects.create_user(
+                username=f'author{num}', first_name='Имя', last_name=f'{num}')
+            group = Group.objects.create(
+                title=f'Группа {num}', slug=f'group{num}', description='-')
+            Follow.objects.create(user=cls.reader, author=author)
+            Post.objects.create(author=author, group=group, text='Текст')
+        for num in range(settings.PAGINATOR_POSTS + 1):
+            cls.post = Post.objects.create(
+                author=cls.author, group=cls.group, text=f'Пост {num}')
+            Comment.objects.create(
+                post=cls.post,
+                author=User.objects.create_user(username=f'commenter{num}'),
+                text='Комментарий',
+            )
+        Follow.objects.create(user=cls.reader, author=cls.author)
+
+    def setUp(self):
+        cache.clear()
+        self.client = Client()
+        self.client.force_login(self.reader)
+
+    def test_pages_fit_query_budget(self):
+        """Страницы укладываются в фиксированное число запросов."""
+        username = {'username': self.author.username}
+        post_id = {'post_id': self.post.pk}
+        # Кэш пуст: главная и лента подписок один раз оценивают число
+        # записей, дальше оценка берётся из кэша.
+        budgets = (
+            (reverse('posts:index'), 4),
+            (reverse('posts:group_list', args=[self.group.slug]), 4),
+            (reverse('posts:profile', kwargs=username), 4),
+            (reverse('posts:post_detail', kwargs=post_id), 4),
+            (reverse('posts:follow_index'), 5),
+            (reverse('posts:post_create'), 3),
+            (reverse('posts:post_edit', kwargs=post_id), 4),
+            (reverse('posts:profile_follow', kwargs=username), 4),
+        )
+        for url, budget in budgets:
+            with self.subTest(url=url):
+                self.assertQueryBudget(self.client, url, budget)
+
+    def test_write_views_fit_query_budget(self):
+        """Запись комментария и отписка укладываются в бюджет."""
+        self.assertQueryBudget(
+            self.client,
+            reverse('posts:add_comment', kwargs={'post_id': self.post.pk}),
+            budget=5, method='post', data={'text': 'Новый комментарий'})
+        self.assertQueryBudget(
+            self.client,
+            reverse('posts:profile_unfollow', args=[self.author.username]),
+            budget=8)
+
+    def test_partial_views_fit_query_budget(self):
+        """Поиск, подгрузка комментариев и фрагменты укладываются
+        в бюджет."""
+        budgets = (
+            (reverse('posts:search') + '?q=Пост', 3),
+            (reverse('posts:comments_more', args=[self.post.pk]), 2),
+            (reverse('posts:fragment_header'), 2),
+            (reverse('posts:fragment_post_actions', args=[self.post.pk]), 4),
+            (reverse(
+                'posts:fragment_follow', args=[self.author.username]), 4),
+        )
+        for url, budget in budgets:
+            with self.subTest(url=url):
+                self.assertQueryBudget(self.client, url, budget)
+
+    def test_upload_views_fit_query_budget(self):
+        """Начало загрузки и приём куска укладываются в бюджет."""
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        content = b'x' * 100
+        with override_settings(MEDIA_ROOT=media_root):
+            response = self.assertQueryBudget(
+                self.client, reverse('posts:upload_start'), budget=2,
+                method='post', data={'name': 'a.png', 'size': len(content)})
+            url = response.json()['url']
+            with self.assertMaxQueries(2, url):
+                response = self.client.put(
+                    url, content, content_type='application/octet-stream',
+                    HTTP_CONTENT_RANGE=f'bytes 0-99/{len(content)}')
+        self.assertTrue(response.json()['complete'])
+
+
+class QueryCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.reader = User.objects.create_user(username='reader')
+        cls.group = Group.objects.create(
+            title='Группа', slug='group', description='Описание')
+        cls.post = Post.objects.create(
+            author=cls.author, text='Пост', group=cls.group)
+        cls.other = Post.objects.create(author=cls.reader, text='Другой')
+
+    def setUp(self):
+        cache.clear()
+        stats.reset()
+
+    def test_repeated_lookup_hits_cache(self):
+        """Повторный запрос берётся из кэша, счётчики видят попадание"""
+        self.assertEqual(cached(Group.objects).get(slug='group'), self.group)
+        with self.assertNumQueries(0):
+            group = cached(Group.objects).get(slug='group')
+        self.assertEqual(group.title, 'Группа')
+        counters = stats.snapshot()
+        self.assertEqual(counters['query_cache.hits'], 1)
+        self.assertEqual(counters['query_cache.misses'], 1)
+
+    def test_save_invalidates_table(self):
+        """Запись в таблицу сбрасывает запросы к ней"""
+        cached(Group.objects).get(slug='group')
+        self.group.title = 'Новое название'
+        self.group.save()
+        with self.assertNumQueries(1):
+            group = cached(Group.objects).get(slug='group')
+        self.assertEqual(group.title, 'Новое название')
+
+    def test_pk_lookup_invalidated_by_row(self):
+        """Запрос по pk сбрасывает только своя строка, в том числе
+        обновлённая в обход save()"""
+        posts = cached(Post.objects.select_related('author__stats', 'group'))
+        posts.get(pk=self.post.pk)
+        self.other.text = 'Правка'
+        self.other.save()
+        with self.assertNumQueries(0):
+            posts.get(pk=self.post.pk)
+        Comment.objects.create(
+            post=self.post, author=self.reader, text='Комментарий')
+        post = posts.get(pk=self.post.pk)
+        self.assertEqual(post.comments_count, 1)
+
+    def test_related_rows_tracked(self):
+        """Изменение строки из select_related сбрасывает запрос"""
+        users = cached(User.objects.select_related('stats'))
+        self.assertEqual(
+            users.get(username='author').stats.followers_count, 0)
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.assertEqual(
+            users.get(username='author').stats.followers_count, 1)
+
+    def test_unwatched_tables_not_cached(self):
+        """Запросы к таблицам без watch() всегда идут в базу"""
+        for _ in range(2):
+            with self.assertNumQueries(1):
+                list(cached(Comment.objects.filter(post=self.post)))
+
+    def test_write_during_query_not_cached(self):
+        """Строки, прочитанные до чужой записи, не кэшируются под
+        поколением после неё"""
+        dependencies = query_cache.dependencies
+
+        def racing(*args):
+            # Запись попадает между запросом и чтением поколений.
+            Group.objects.filter(pk=self.group.pk).update(title='Новое')
+            query_cache.rows_changed(Group, self.group.pk)
+            return dependencies(*args)
+
+        with mock.patch('core.query_cache.dependencies', racing):
+            cached(Group.objects).get(slug='group')
+        group = cached(Group.objects).get(slug='group')
+        self.assertEqual(group.title, 'Новое')
+
+    def test_login_keeps_user_lookups(self):
+        """Вход на сайт не сбрасывает запросы к пользователям"""
+        cached(User.objects).get(username='author')
+        self.client.force_login(self.author)
+        with self.assertNumQueries(0):
+            cached(User.objects).get(username='author')
@@ -0,0 +1,117 @@
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+
+from posts.models import Post
+from posts.search import build_query, stem
+
+User = get_user_model()
+
+
+class StemTest(TestCase):
+    def test_russian_words(self):
+        """Формы слова сводятся к одной основе."""
+        cases = {
+            'посты': 'пост',
+            'постов': 'пост',
+            'книгами': 'книг',
+            'красивейший': 'красив',
+            'улыбнулась': 'улыбнул',
+            'ёлки': 'елк',
+        }
+        for word, base in cases.items():
+            with self.subTest(word=word):
+                self.assertEqual(stem(word), base)
+
+    def test_query_is_safe(self):
+        """Служебные символы FTS5 из запроса не попадают в MATCH."""
+        self.assertEqual(
+            build_query('Новые "посты" OR*'), '"нов"* "пост"* "or"')
+
+
+class SearchViewTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.best = Post.objects.create(
+            author=cls.author, text='Котики, котики и ещё раз котики')
+        cls.other = Post.objects.create(
+            author=cls.author, text='Про котика <b>и</b> собаку')
+        Post.objects.create(author=cls.author, text='Совсем о другом')
+
+    def setUp(self):
+        cache.clear()
+        self.url = reverse('posts:search')
+
+    def search(self, query, **params):
+        return self.client.get(self.url, {'q': query, **params})
+
+    def test_finds_word_forms(self):
+        """Поиск находит посты с другими формами слова."""
+        response = self.search('котиков')
+        self.assertEqual(
+            list(response.context['page_obj']), [self.best, self.other])
+
+    def test_snippet_is_highlighted_and_escaped(self):
+        """Найденные слова подсвечены, HTML из текста экранирован."""
+        response = self.search('собаки')
+        self.assertContains(response, '<mark>собаку</mark>')
+        self.assertContains(response, '&lt;b&gt;и&lt;/b&gt;')
+        self.assertNotContains(response, '<b>и</b>')
+
+    def test_empty_query(self):
+        """Пустой запрос показывает только форму поиска."""
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.context['page_obj'])
+
+    def test_nothing_found(self):
+        response = self.search('бегемот')
+        self.assertContains(response, 'ничего не найдено')
+
+    def test_pages_by_cursor(self):
+        """Результаты листаются курсором без пропусков и повторов."""
+        for num in range(12):
+            Post.objects.create(author=self.author, text=f'Котик номер {num}')
+        first = self.search('котик')
+        second = self.search(
+            'котик', cursor=first.context['page_obj'].next_cursor)
+        found = list(first.context['page_obj'])
+        found += list(second.context['page_obj'])
+        self.assertEqual(len(found), 14)
+        self.assertEqual(len(set(found)), 14)
+        self.assertIsNone(second.context['page_obj'].next_cursor)
+        self.assertContains(
+            first, 'q=%D0%BA%D0%BE%D1%82%D0%B8%D0%BA&amp;cursor=')
+        # Число совпадений точное: без «около».
+        self.assertContains(first, 'из 2')
+        self.assertNotContains(first, 'около')
+
+    def test_index_follows_edits_and_deletes(self):
+        """Правка и удаление поста сразу видны в поиске."""
+        post = Post.objects.get(pk=self.other.pk)
+        post.text = 'Теперь про попугаев'
+        post.save()
+        self.assertEqual(
+            list(self.search('попугай').context['page_obj']), [post])
+        self.assertEqual(
+            list(self.search('собака').context['page_obj']), [])
+        post.delete()
+        self.assertEqual(
+            list(self.search('попугай').context['page_obj']), [])
+
+    def test_rebuild_command(self):
+        """Команда пересобирает индекс пачками."""
+        with connection.cursor() as cursor:
+            cursor.execute('DELETE FROM posts_post_fts')
+        out = StringIO()
+        call_command('rebuild_search_index', batch_size=2, stdout=out)
+        self.assertIn('Проиндексировано постов: 3', out.getvalue())
+        self.assertEqual(
+            list(self.search('котики').context['page_obj']),
+            [self.best, self.other])
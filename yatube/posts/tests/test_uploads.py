@@ -0,0 +1,149 @@
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.handlers.wsgi import WSGIRequest
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from posts import uploads
+from posts.models import Post
+
+User = get_user_model()
+
+
+def png(width, height):
+    buffer = BytesIO()
+    Image.new('RGB', (width, height), 'red').save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(
+    POST_IMAGE_MAX_BYTES=4096, POST_IMAGE_MAX_PIXELS=10 ** 4,
+    THUMBNAIL_ASYNC=False)
+class UploadTest(TestCase):
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        media_settings = override_settings(MEDIA_ROOT=media_root)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.uploads = os.path.join(media_root, 'uploads')
+        cache.clear()
+        self.user = User.objects.create_user(username='author')
+        self.client.force_login(self.user)
+
+    def create(self, **data):
+        return self.client.post(
+            reverse('posts:post_create'), {'text': 'Пост', **data})
+
+    def leftover_uploads(self):
+        if not os.path.isdir(self.uploads):
+            return []
+        return os.listdir(self.uploads)
+
+    def test_image_moved_into_storage(self):
+        """Принятая картинка переносится в хранилище, не оставляя копий"""
+        content = png(40, 20)
+        self.create(image=SimpleUploadedFile('a.png', content))
+        post = Post.objects.get()
+        self.assertRegex(post.image.name, r'^posts/\w\w/\w\w/\w{64}\.png$')
+        with post.image.open('rb') as file:
+            self.assertEqual(file.read(), content)
+        self.assertEqual(self.leftover_uploads(), [])
+
+    def test_limits_checked_while_streaming(self):
+        """Слишком тяжёлая или слишком большая картинка отклоняется
+        с ошибкой формы"""
+        cases = (
+            (os.urandom(5000), 'МБ'),
+            (png(200, 100), 'мегапикселей'),
+        )
+        for content, message in cases:
+            with self.subTest(message=message):
+                response = self.create(
+                    image=SimpleUploadedFile('a.png', content))
+                self.assertEqual(response.status_code, 200)
+                self.assertIn(
+                    message, response.context['form'].errors['image'][0])
+                self.assertFalse(Post.objects.exists())
+                self.assertEqual(self.leftover_uploads(), [])
+
+    def test_rejected_upload_stops_reading(self):
+        """Отклонённая картинка обрывает разбор запроса: остаток тела
+        не читается, форма получает ошибку"""
+        cases = (
+            # Content-Length сразу больше допустимого.
+            (os.urandom(2 ** 20), 'МБ'),
+            # Размеры видны по заголовку, хвост файла уже не нужен.
+            (png(200, 100) + os.urandom(2 ** 14), 'мегапикселей'),
+        )
+        # Мелкие куски, иначе второе тело целиком уходит в первое чтение.
+        for content, message in cases:
+            with self.subTest(message=message), mock.patch.object(
+                    uploads.PostImageUploadHandler, 'chunk_size', 1024):
+                request = RequestFactory().post(reverse('posts:post_create'), {
+                    'text': 'Пост',
+                    'image': SimpleUploadedFile('a.png', content),
+                })
+                body = BytesIO(request.environ['wsgi.input'].read())
+                request = WSGIRequest({**request.environ, 'wsgi.input': body})
+                files = uploads.post_files(request)
+                self.assertEqual(request.POST['text'], 'Пост')
+                self.assertIn(message, files['image'].upload_error)
+                self.assertLess(body.tell(), len(body.getvalue()))
+                self.assertEqual(self.leftover_uploads(), [])
+
+    def put(self, url, data, start, total):
+        return self.client.put(
+            url, data, content_type='application/octet-stream',
+            HTTP_CONTENT_RANGE=f'bytes {start}-{start + len(data) - 1}/{total}'
+        )
+
+    def test_resumable_upload(self):
+        """Картинку можно докачать по частям и сослаться на неё в форме"""
+        content = png(40, 20)
+        half = len(content) // 2
+        session = self.client.post(
+            reverse('posts:upload_start'),
+            {'name': 'a.png', 'size': len(content)},
+        ).json()
+        url = session['url']
+        self.assertEqual(
+            self.put(url, content[:half], 0, len(content)).json()['offset'],
+            half)
+        conflict = self.put(url, content[:half], 0, len(content))
+        self.assertEqual(conflict.status_code, 409)
+        self.assertEqual(self.client.get(url).json()['offset'], half)
+        done = self.put(url, content[half:], half, len(content)).json()
+        self.assertTrue(done['complete'])
+        self.create(upload=session['id'])
+        post = Post.objects.get()
+        with post.image.open('rb') as file:
+            self.assertEqual(file.read(), content)
+        self.assertEqual(self.leftover_uploads(), [])
+
+    def test_session_limits(self):
+        """Сессия не открывается для слишком большого файла и без
+        положительного размера, чужая сессия не видна"""
+        response = self.client.post(
+            reverse('posts:upload_start'), {'name': 'a.png', 'size': 5000})
+        self.assertEqual(response.status_code, 413)
+        for size in ('', 'abc', '0', '-10'):
+            with self.subTest(size=size):
+                response = self.client.post(
+                    reverse('posts:upload_start'),
+                    {'name': 'a.png', 'size': size})
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.leftover_uploads(), [])
+        session = self.client.post(
+            reverse('posts:upload_start'), {'name': 'a.png', 'size': 10},
+        ).json()
+        self.client.force_login(User.objects.create_user(username='other'))
+        self.assertEqual(self.client.get(session['url']).status_code, 404)
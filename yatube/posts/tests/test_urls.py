@@ -1,4 +1,5 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.test import Client, TestCase
 from http import HTTPStatus
 
@@ -41,6 +42,9 @@ class PostURLTests(TestCase):
         cls.authorized_client.force_login(cls.user)
         cls.guest_client = Client()
 
+    def setUp(self):
+        cache.clear()
+
     def test_templates_url(self):
         templates_urls = {
             '/': 'posts/index.html',
@@ -1,15 +1,31 @@
+import base64
+import json
 import shutil
+import tempfile
+from io import BytesIO, StringIO
 import os
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import Client, TestCase
+from django.test import Client, TestCase, TransactionTestCase
 from django.urls import reverse
 from django import forms
 from django.conf import settings
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.http import http_date
+from PIL import Image
 
-from posts.models import Group, Post, Comment, Follow
+from posts.models import Group, Post, Comment, Follow, TimelineEntry
+from posts import thumbnails
+from core import purge
+from core.models import StoredFile
+from core.cache import generation_token
+from core.purge_receiver import PurgeReceiver
 
 User = get_user_model()
 
@@ -70,6 +86,7 @@ class PostPagesTests(TestCase):
         super().tearDownClass()
 
     def setUp(self):
+        cache.clear()
         self.authorized_client = Client()
         self.authorized_client.force_login(self.user)
         self.author = Client()
@@ -203,6 +220,7 @@ class PaginatorTests(TestCase):
             )
 
     def setUp(self):
+        cache.clear()
         self.authorized_client = Client()
         self.authorized_client.force_login(self.user)
         self.author = Client()
@@ -213,17 +231,71 @@ class PaginatorTests(TestCase):
         respone = self.authorized_client.get(reverse('posts:index'))
         self.assertEqual(len(respone.context['page_obj']), 10)
 
-    def test_second_post_index_paginator(self):
-        """На первой page_index количество постов должно быть 5"""
-        respone = self.authorized_client.get(reverse(
-            'posts:index') + '?page=2')
-        self.assertEqual(len(respone.context['page_obj']), 5)
-
     def test_second_post_index_paginator(self):
         """На второй page_index количество постов должно быть 5"""
-        respone = self.authorized_client.get(reverse(
-            'posts:index') + '?page=2')
+        respone = self.authorized_client.get(reverse('posts:index'))
+        respone = self.authorized_client.get(
+            reverse('posts:index'),
+            {'cursor': respone.context['page_obj'].next_cursor})
         self.assertEqual(len(respone.context['page_obj']), 5)
+        self.assertIsNone(respone.context['page_obj'].next_cursor)
+
+    def test_previous_cursor_returns_first_page(self):
+        """Курсор «Предыдущая» возвращает те же посты первой страницы"""
+        first = self.authorized_client.get(reverse('posts:index'))
+        second = self.authorized_client.get(
+            reverse('posts:index'),
+            {'cursor': first.context['page_obj'].next_cursor})
+        back = self.authorized_client.get(
+            reverse('posts:index'),
+            {'cursor': second.context['page_obj'].previous_cursor})
+        self.assertEqual(
+            list(back.context['page_obj']), list(first.context['page_obj']))
+        self.assertEqual(back.context['page_obj'].number, 1)
+
+    def test_pages_do_not_overlap(self):
+        """Страницы по курсору не теряют и не дублируют посты"""
+        first = self.authorized_client.get(reverse('posts:index'))
+        second = self.authorized_client.get(
+            reverse('posts:index'),
+            {'cursor': first.context['page_obj'].next_cursor})
+        posts = (
+            list(first.context['page_obj'])
+            + list(second.context['page_obj'])
+        )
+        self.assertEqual(
+            posts, list(Post.objects.order_by('-pub_date', '-id')))
+
+    def test_legacy_page_redirects_to_cursor(self):
+        """Старая ссылка ?page=2 перенаправляет на курсор второй страницы"""
+        response = self.authorized_client.get(
+            reverse('posts:index') + '?page=2')
+        self.assertEqual(response.status_code, 302)
+        self.assertIn('cursor=', response.url)
+        response = self.authorized_client.get(response.url)
+        self.assertEqual(len(response.context['page_obj']), 5)
+        self.assertEqual(response.context['page_obj'].number, 2)
+
+    def test_broken_cursor_shows_first_page(self):
+        """Испорченный курсор открывает первую страницу"""
+        respone = self.authorized_client.get(
+            reverse('posts:index'), {'cursor': 'broken!'})
+        self.assertEqual(len(respone.context['page_obj']), 10)
+
+    def test_cursor_with_bad_values_shows_first_page(self):
+        """Курсор с подменёнными значениями ключа открывает первую
+        страницу, а не падает"""
+        for payload in (b'[2,false,["abc",1]]', b'[2,false,[null,"x"]]',
+                        b'[2,false,["2021-13-40T00:00:00",1]]'):
+            cursor = base64.urlsafe_b64encode(payload).decode()
+            with self.subTest(payload=payload):
+                response = self.authorized_client.get(
+                    reverse('posts:index'), {'cursor': cursor})
+                self.assertEqual(len(response.context['page_obj']), 10)
+                response = self.authorized_client.get(
+                    reverse('posts:comments_more', args=[self.post.pk]),
+                    {'cursor': cursor})
+                self.assertEqual(response.status_code, 200)
 
     def test_group_list_paginator(self):
         """На первой group_list количество постов должно быть 10"""
@@ -237,6 +309,102 @@ class PaginatorTests(TestCase):
             'posts:profile', kwargs={'username': self.user.username}))
         self.assertEqual(len(respone.context['page_obj']), 10)
 
+    def test_counts_come_from_counters(self):
+        """Число страниц группы берётся из счётчика, без COUNT(*)"""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authorized_client.get(reverse(
+                'posts:group_list', kwargs={'slug': 'test_slug'}))
+        paginator = response.context['page_obj'].paginator
+        self.assertTrue(paginator.count_is_exact)
+        self.assertEqual(paginator.num_pages, 2)
+        self.assertContains(response, 'из 2')
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'COUNT(' in query['sql']])
+
+    def test_index_count_is_estimated_and_cached(self):
+        """Главная показывает оценку числа страниц и кэширует её"""
+        cache.clear()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.authorized_client.get(reverse('posts:index'))
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'COUNT(' in query['sql']])
+        paginator = response.context['page_obj'].paginator
+        self.assertFalse(paginator.count_is_exact)
+        self.assertGreaterEqual(paginator.count, 15)
+        self.assertContains(response, 'из около')
+        self.assertEqual(cache.get('count:index'), paginator.count)
+
+
+@override_settings(PAGINATOR_COMMENTS=20)
+class CommentPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='author')
+        cls.post = Post.objects.create(text='Пост', author=cls.author)
+        for num in range(25):
+            Comment.objects.create(
+                post=cls.post,
+                author=User.objects.create_user(username=f'reader{num}'),
+                text=f'Комментарий {num}',
+            )
+
+    def setUp(self):
+        cache.clear()
+        self.client.force_login(self.author)
+        self.detail_url = reverse(
+            'posts:post_detail', args=[self.post.pk])
+        self.more_url = reverse('posts:comments_more', args=[self.post.pk])
+
+    def test_first_page_is_limited(self):
+        """На странице поста первые 20 комментариев, новые сверху"""
+        response = self.client.get(self.detail_url)
+        comments = response.context['comments']
+        self.assertEqual(len(comments), 20)
+        self.assertEqual(comments[0].text, 'Комментарий 24')
+        self.assertContains(response, 'Показать ещё')
+
+    def test_load_more_returns_fragment(self):
+        """Подгрузка отдаёт оставшиеся комментарии фрагментом"""
+        response = self.client.get(self.detail_url)
+        response = self.client.get(
+            self.more_url, {'cursor': response.context['next_cursor']})
+        self.assertTemplateUsed(response, 'posts/includes/comments.html')
+        self.assertTemplateNotUsed(response, 'base.html')
+        self.assertEqual(len(response.context['comments']), 5)
+        self.assertIsNone(response.context['next_cursor'])
+        self.assertContains(response, 'Комментарий 0')
+        self.assertNotContains(response, 'Показать ещё')
+
+    def test_load_more_without_javascript(self):
+        """Без JS ссылка открывает страницу поста со следующими"""
+        response = self.client.get(self.detail_url)
+        response = self.client.get(
+            self.detail_url,
+            {'comments': response.context['next_cursor']})
+        self.assertEqual(len(response.context['comments']), 5)
+
+    def test_first_page_is_cached(self):
+        """Первая страница комментариев берётся из кэша до изменений"""
+        self.client.get(self.detail_url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(self.detail_url)
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'posts_comment' in query['sql']])
+        Comment.objects.create(
+            post=self.post, author=self.author, text='Свежий комментарий')
+        response = self.client.get(self.detail_url)
+        self.assertEqual(
+            response.context['comments'][0].text, 'Свежий комментарий')
+
+    def test_guest_can_load_more(self):
+        """Комментарии видны всем, подгрузка работает и для гостя"""
+        self.client.logout()
+        response = self.client.get(self.more_url)
+        self.assertEqual(response.status_code, 200)
+
 
 class CommentTest(TestCase):
     def setUp(self):
@@ -313,30 +481,153 @@ class CacheTest(TestCase):
             )
 
     def test_index_page_cache(self):
-        """Посты  хранятся в кэше и обновляются
-            каждые 20 сек"""
-        response_start = CacheTest.guest_client.get(
-            reverse('posts:index') + '?page=2'
+        """Лента хранится в кэше, пока посты не меняются"""
+        cache.clear()
+        response_start = CacheTest.guest_client.get(reverse('posts:index'))
+        # update() не шлёт сигналов: кэш об изменении не узнаёт.
+        Post.objects.filter(text='Текст поста № 13').update(text='Скрытый')
+        response_cache = CacheTest.guest_client.get(reverse('posts:index'))
+        cache.clear()
+        response_timeout = CacheTest.guest_client.get(reverse('posts:index'))
+        self.assertContains(response_start, 'Текст поста № 13')
+        self.assertContains(
+            response_cache, 'Текст поста № 13',
+            msg_prefix='Контент не был закеширован!')
+        self.assertContains(
+            response_timeout, 'Скрытый',
+            msg_prefix='При очистке кеша контент не изменился!')
+
+    def test_new_post_invalidates_feeds(self):
+        """Новый пост сразу виден в закешированных лентах"""
+        group = Group.objects.create(
+            title='Группа', slug='cache_group', description='Описание')
+        urls = (
+            reverse('posts:index'),
+            reverse('posts:group_list', args=[group.slug]),
+            reverse('posts:profile', args=[CacheTest.test_user.username]),
         )
+        for url in urls:
+            CacheTest.guest_client.get(url)
         Post.objects.create(
-            text='Новый пост',
-            author=CacheTest.test_user
-        )
-        response_cache = CacheTest.guest_client.get(
-            reverse('posts:index') + '?page=2'
-        )
+            text='Новый пост', author=CacheTest.test_user, group=group)
+        for url in urls:
+            with self.subTest(url=url):
+                self.assertContains(
+                    CacheTest.guest_client.get(url), 'Новый пост')
+
+    def test_post_edit_invalidates_old_group(self):
+        """Перенос поста в другую группу убирает его из старой"""
+        group = Group.objects.create(
+            title='Старая', slug='old_group', description='Описание')
+        other = Group.objects.create(
+            title='Новая', slug='new_group', description='Описание')
+        post = Post.objects.create(
+            text='Переезжающий пост', author=CacheTest.test_user, group=group)
+        url = reverse('posts:group_list', args=[group.slug])
+        self.assertContains(CacheTest.guest_client.get(url), post.text)
+        post = Post.objects.get(pk=post.pk)
+        post.group = other
+        post.save()
+        self.assertNotContains(CacheTest.guest_client.get(url), post.text)
+
+    def test_group_edit_invalidates_group_page(self):
+        """Изменение группы сразу видно на её странице"""
+        group = Group.objects.create(
+            title='Старое название', slug='renamed', description='Описание')
+        url = reverse('posts:group_list', args=[group.slug])
+        CacheTest.guest_client.get(url)
+        group.title = 'Новое название'
+        group.save()
+        self.assertContains(
+            CacheTest.guest_client.get(url), 'Новое название')
+
+    def test_guest_pages_served_whole(self):
+        """Гость повторно получает страницу из кэша без запросов к базе"""
         cache.clear()
-        response_timeout = CacheTest.guest_client.get(
-            reverse('posts:index') + '?page=2'
-        )
-        self.assertEqual(
-            response_start.content,
-            response_cache.content,
-            'Контент не был закеширован!')
-        self.assertNotEqual(
-            response_start.content,
-            response_timeout.content,
-            'При очистке кеша контент не изменился!')
+        url = reverse('posts:index')
+        first = CacheTest.guest_client.get(url)
+        with self.assertNumQueries(0):
+            second = CacheTest.guest_client.get(url)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['ETag'], first['ETag'])
+
+    def test_comment_purges_only_its_post(self):
+        """Комментарий обновляет страницу своего поста, а не чужие"""
+        cache.clear()
+        post, other = Post.objects.all()[:2]
+        url = reverse('posts:post_detail', args=[post.pk])
+        other_url = reverse('posts:post_detail', args=[other.pk])
+        CacheTest.guest_client.get(url)
+        CacheTest.guest_client.get(other_url)
+        Comment.objects.create(
+            post=post, author=CacheTest.test_user, text='Свежий комментарий')
+        with CaptureQueriesContext(connection) as queries:
+            CacheTest.guest_client.get(url)
+        self.assertTrue(queries.captured_queries, 'Страница не пересобрана')
+        with self.assertNumQueries(0):
+            CacheTest.guest_client.get(other_url)
+
+    @override_settings(PAGE_CACHE_VIEWS=())
+    def test_feed_page_computed_once(self):
+        """Страница ленты считается один раз на поколение, а новый пост
+        её пересчитывает"""
+        cache.clear()
+        url = reverse('posts:index')
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(url)
+        self.assertFalse([
+            query for query in queries.captured_queries
+            if 'FROM "posts_post"' in query['sql']])
+        post = Post.objects.create(
+            text='Свежая запись', author=CacheTest.test_user)
+        response = self.client.get(url)
+        self.assertEqual(response.context['page_obj'][0], post)
+
+    def test_logged_in_users_share_page(self):
+        """Вошедший пользователь получает ту же готовую страницу, что и
+        гость"""
+        cache.clear()
+        url = reverse('posts:index')
+        CacheTest.guest_client.get(url)
+        client = Client()
+        client.force_login(CacheTest.test_user)
+        with self.assertNumQueries(0):
+            response = client.get(url)
+        self.assertNotContains(response, CacheTest.test_user.username)
+
+    @override_settings(PAGE_CACHE_VIEWS=('posts:fragment_header',))
+    def test_personal_pages_not_cached(self):
+        """Страницы, прочитавшие сессию, собираются заново"""
+        cache.clear()
+        client = Client()
+        client.force_login(CacheTest.test_user)
+        url = reverse('posts:fragment_header')
+        client.get(url)
+        response = client.get(url)
+        self.assertIsNotNone(response.context)
+
+
+class GenerationCommitTest(TransactionTestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.post = Post.objects.create(
+            text='Старый текст', author=self.author)
+
+    def test_reader_before_commit(self):
+        """Закэшированное до коммита под новым поколением не переживает
+        коммит"""
+        scope = f'post:{self.post.pk}'
+        with transaction.atomic():
+            self.post.text = 'Новый текст'
+            self.post.save()
+            # Другой запрос ещё видит в базе старый текст и кладёт
+            # страницу в кэш под уже сдвинутым поколением.
+            stale = generation_token(scope)
+            cache.set(f'page:{stale}', 'Старый текст')
+        self.assertNotEqual(generation_token(scope), stale)
+        self.assertIsNone(cache.get(f'page:{generation_token(scope)}'))
 
 
 class FollowTest(TestCase):
@@ -408,3 +699,413 @@ class FollowTest(TestCase):
             self.authors_post not in response.context['page_obj'],
             'В ленте неподписанного пользователя есть записи автора'
         )
+
+
+class FragmentTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='Author')
+        self.reader = User.objects.create_user(username='Reader')
+        self.post = Post.objects.create(text='Запись', author=self.author)
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.reader_client = Client()
+        self.reader_client.force_login(self.reader)
+        self.author_client = Client()
+        self.author_client.force_login(self.author)
+
+    def test_shell_has_no_personal_data(self):
+        """Страница поста не зависит от того, кто её смотрит"""
+        url = reverse('posts:post_detail', args=[self.post.pk])
+        response = self.reader_client.get(url)
+        self.assertNotContains(response, 'Reader')
+        self.assertNotContains(response, 'csrfmiddlewaretoken')
+        self.assertContains(
+            response,
+            reverse('posts:fragment_post_actions', args=[self.post.pk]))
+        self.assertNotIn('Cookie', response.get('Vary', ''))
+
+    def test_header_fragment(self):
+        """Шапка вошедшего пользователя показывает его имя"""
+        url = reverse('posts:fragment_header')
+        self.assertContains(self.reader_client.get(url), 'Reader')
+        self.assertContains(self.client.get(url), 'Войти')
+
+    def test_post_actions_fragment(self):
+        """Правка доступна только автору, комментарий — всем вошедшим"""
+        url = reverse('posts:fragment_post_actions', args=[self.post.pk])
+        edit_url = reverse('posts:post_edit', args=[self.post.pk])
+        response = self.author_client.get(url)
+        self.assertContains(response, edit_url)
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        response = self.reader_client.get(url)
+        self.assertNotContains(response, edit_url)
+        self.assertContains(response, 'csrfmiddlewaretoken')
+        self.assertNotContains(self.client.get(url), 'csrfmiddlewaretoken')
+        self.assertIn('no-cache', response['Cache-Control'])
+
+    def test_follow_fragment(self):
+        """Подписчик видит кнопку отписки, автор — никакой"""
+        url = reverse('posts:fragment_follow', args=['Author'])
+        self.assertContains(self.reader_client.get(url), 'Отписаться')
+        self.assertNotContains(self.author_client.get(url), 'btn')
+
+    @override_settings(FRAGMENTS_ESI=True)
+    def test_esi_include(self):
+        """С FRAGMENTS_ESI фрагменты вставляет кэш на краю"""
+        response = self.client.get(
+            reverse('posts:profile', args=['Author']))
+        self.assertContains(
+            response,
+            '<esi:include src="%s"/>' % reverse(
+                'posts:fragment_follow', args=['Author']))
+
+
+class TimelineTest(TestCase):
+    def setUp(self):
+        self.reader = User.objects.create_user(username='Reader')
+        self.author = User.objects.create_user(username='Writer')
+        self.old_post = Post.objects.create(
+            text='Старая запись', author=self.author)
+        self.client_reader = Client()
+        self.client_reader.force_login(self.reader)
+
+    def follow_url(self, name):
+        return reverse(name, kwargs={'username': self.author.username})
+
+    def feed(self):
+        response = self.client_reader.get(reverse('posts:follow_index'))
+        return list(response.context['page_obj'])
+
+    def test_follow_backfills_and_post_fans_out(self):
+        """Подписка дописывает старые посты, новый пост попадает в ленту"""
+        self.client_reader.get(self.follow_url('posts:profile_follow'))
+        new_post = Post.objects.create(text='Новая', author=self.author)
+        self.assertEqual(
+            set(TimelineEntry.objects.filter(
+                user=self.reader).values_list('post_id', flat=True)),
+            {self.old_post.pk, new_post.pk})
+        self.assertEqual(self.feed(), [new_post, self.old_post])
+
+    def test_unfollow_prunes_timeline(self):
+        """Отписка убирает посты автора из ленты"""
+        self.client_reader.get(self.follow_url('posts:profile_follow'))
+        self.client_reader.get(self.follow_url('posts:profile_unfollow'))
+        self.assertFalse(
+            TimelineEntry.objects.filter(user=self.reader).exists())
+        self.assertEqual(self.feed(), [])
+
+    @override_settings(TIMELINE_FANOUT_LIMIT=1)
+    def test_hot_author_merged_on_read(self):
+        """Посты популярного автора подмешиваются при чтении ленты"""
+        other = User.objects.create_user(username='Other')
+        other_post = Post.objects.create(text='Обычный', author=other)
+        Follow.objects.create(user=self.reader, author=other)
+        Follow.objects.create(user=self.reader, author=self.author)
+        new_post = Post.objects.create(text='Новая', author=self.author)
+        self.assertFalse(TimelineEntry.objects.filter(
+            user=self.reader, author=self.author).exists())
+        self.assertEqual(
+            self.feed(), [new_post, other_post, self.old_post])
+
+    def test_rebuild_timelines_command(self):
+        """Команда rebuild_timelines восстанавливает ленту"""
+        Follow.objects.create(user=self.reader, author=self.author)
+        TimelineEntry.objects.all().delete()
+        call_command('rebuild_timelines', stdout=StringIO())
+        self.assertEqual(self.feed(), [self.old_post])
+
+
+class ConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(username='Author')
+        cls.group = Group.objects.create(
+            title='Группа', slug='etag_group', description='Описание')
+        cls.post = Post.objects.create(
+            text='Запись', author=cls.author, group=cls.group)
+
+    def setUp(self):
+        cache.clear()
+        self.urls = (
+            reverse('posts:index'),
+            reverse('posts:group_list', args=[self.group.slug]),
+            reverse('posts:profile', args=[self.author.username]),
+            reverse('posts:post_detail', args=[self.post.pk]),
+        )
+
+    def test_unchanged_page_returns_304(self):
+        """Повторный запрос с тем же ETag получает 304 без рендера"""
+        for url in self.urls:
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etag)
+                self.assertIsNone(response.context)
+
+    def test_if_modified_since_ignored(self):
+        """Страницы без Last-Modified: If-Modified-Since не даёт 304
+        даже после правки в ту же секунду"""
+        for url in self.urls:
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertNotIn('Last-Modified', response)
+                self.post.text = 'Правка'
+                self.post.save()
+                response = self.client.get(
+                    url, HTTP_IF_MODIFIED_SINCE=http_date())
+                self.assertEqual(response.status_code, 200)
+
+    def test_changes_invalidate_etag(self):
+        """Новый комментарий и новый пост меняют ETag страниц"""
+        etags = {url: self.client.get(url)['ETag'] for url in self.urls}
+        Comment.objects.create(
+            post=self.post, author=self.author, text='Комментарий')
+        Post.objects.create(text='Ещё запись', author=self.author,
+                            group=self.group)
+        for url, etag in etags.items():
+            with self.subTest(url=url):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+                self.assertEqual(response.status_code, 200)
+
+    def test_etag_shared_between_users(self):
+        """Страница одна для всех: ETag гостя подходит и вошедшему"""
+        url = reverse('posts:index')
+        etag = self.client.get(url)['ETag']
+        self.client.force_login(self.author)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+@mock.patch('core.purge.transaction.on_commit', lambda callback: callback())
+class SurrogateKeyTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='Author')
+        self.group = Group.objects.create(title='Группа', slug='group')
+        self.post = Post.objects.create(
+            text='Запись', author=self.author, group=self.group)
+        self.receiver = PurgeReceiver().start()
+        self.addCleanup(self.receiver.stop)
+        self.settings_override = override_settings(PURGE_URL=self.receiver.url)
+        self.settings_override.enable()
+        self.addCleanup(self.settings_override.disable)
+
+    def keys(self, url):
+        return set(self.client.get(url)['Surrogate-Key'].split())
+
+    def test_response_keys(self):
+        """Ответы помечены ключами постов, автора, группы и ленты"""
+        post_key = f'post:{self.post.pk}'
+        author_key = f'profile:{self.author.pk}'
+        group_key = f'group:{self.group.pk}'
+        self.assertEqual(
+            self.keys(reverse('posts:index')),
+            {'index', post_key, author_key})
+        self.assertEqual(
+            self.keys(reverse('posts:group_list', args=['group'])),
+            {group_key, post_key, author_key})
+        self.assertEqual(
+            self.keys(reverse('posts:post_detail', args=[self.post.pk])),
+            {post_key, author_key, group_key})
+
+    def test_changes_purge_keys(self):
+        """Правка поста и новый комментарий сбрасывают свои ключи"""
+        self.post.text = 'Новый текст'
+        self.post.save()
+        purge.dispatcher.wait()
+        self.assertLessEqual(
+            {'index', f'post:{self.post.pk}', f'group:{self.group.pk}'},
+            self.receiver.keys)
+        self.receiver.requests.clear()
+        Comment.objects.create(
+            post=self.post, author=self.author, text='Комментарий')
+        purge.dispatcher.wait()
+        self.assertEqual(self.receiver.keys, {f'post:{self.post.pk}'})
+
+
+@override_settings(THUMBNAIL_ASYNC=False)
+class ThumbnailTest(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.media_settings = override_settings(MEDIA_ROOT=cls.media_root)
+        cls.media_settings.enable()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.media_settings.disable()
+        shutil.rmtree(cls.media_root, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        cache.clear()
+        self.author = User.objects.create_user(username='author')
+        self.image = SimpleUploadedFile(
+            name='small.gif',
+            content=(
+                b'\x47\x49\x46\x38\x39\x61\x02\x00'
+                b'\x01\x00\x80\x00\x00\x00\x00\x00'
+                b'\xFF\xFF\xFF\x21\xF9\x04\x00\x00'
+                b'\x00\x00\x00\x2C\x00\x00\x00\x00'
+                b'\x02\x00\x01\x00\x00\x02\x02\x0C'
+                b'\x0A\x00\x3B'
+            ),
+            content_type='image/gif',
+        )
+
+    def create_post(self):
+        # В TestCase on_commit не срабатывает: выполняем задачу сразу.
+        with mock.patch(
+            'posts.thumbnails.transaction.on_commit',
+            side_effect=lambda task: task(),
+        ):
+            return Post.objects.create(
+                author=self.author, text='С картинкой', image=self.image)
+
+    def thumbnail(self, post):
+        return thumbnails.attach([post])[0].thumbnail
+
+    def media_path(self, url):
+        return os.path.join(
+            settings.MEDIA_ROOT, url[len(settings.MEDIA_URL):])
+
+    def test_thumbnails_made_on_save(self):
+        """Миниатюры создаются при сохранении поста, а не при просмотре"""
+        post = self.create_post()
+        thumbnail = self.thumbnail(post)
+        self.assertIsNotNone(thumbnail)
+        self.assertTrue(os.path.exists(self.media_path(thumbnail.url)))
+        response = self.client.get(reverse('posts:index'))
+        self.assertContains(response, f'src="{thumbnail.url}"')
+        post.refresh_from_db()
+        self.assertIn('"format": "jpeg"', post.image_variants)
+        self.assertContains(response, 'srcset="')
+
+    def test_small_image_not_upscaled(self):
+        """Варианты маленькой картинки не шире исходника и не повторяются"""
+        buffer = BytesIO()
+        Image.new('RGB', (104, 80), 'red').save(buffer, 'PNG')
+        self.image = SimpleUploadedFile('small.png', buffer.getvalue())
+        post = self.create_post()
+        post.refresh_from_db()
+        variants = json.loads(post.image_variants)
+        self.assertTrue(variants)
+        for variant in variants:
+            self.assertLessEqual(variant['width'], 104)
+        formats = [variant['format'] for variant in variants]
+        self.assertEqual(len(formats), len(set(formats)))
+
+    def test_variants_rendered_as_picture_sources(self):
+        """Варианты WebP идут в <source>, JPEG — в srcset картинки"""
+        post = Post(image='posts/a.jpg', image_variants=(
+            '[{"format": "webp", "width": 480, "height": 170,'
+            ' "name": "cache/a.webp"},'
+            ' {"format": "jpeg", "width": 480, "height": 170,'
+            ' "name": "cache/a.jpg"},'
+            ' {"format": "jpeg", "width": 960, "height": 339,'
+            ' "name": "cache/b.jpg"}]'
+        ))
+        thumbnails.attach([post])
+        self.assertEqual(
+            post.image_sources, [('image/webp', '/media/cache/a.webp 480w')])
+        self.assertEqual(
+            post.image_srcset,
+            '/media/cache/a.jpg 480w, /media/cache/b.jpg 960w')
+
+    def test_new_image_resets_variants(self):
+        """Смена картинки сбрасывает варианты старой до пересоздания"""
+        post = self.create_post()
+        post.refresh_from_db()
+        self.assertTrue(post.image_variants)
+        with mock.patch('posts.thumbnails.transaction.on_commit'):
+            post.image = 'posts/other.jpg'
+            post.save()
+        post.refresh_from_db()
+        self.assertEqual(post.image_variants, '')
+
+    def test_same_image_reupload_keeps_one_reference(self):
+        """Повторная загрузка той же картинки не добавляет ссылку на файл,
+        и с удалением поста ссылок не остаётся"""
+        post = self.create_post()
+        name = post.image.name
+        self.image.seek(0)
+        with mock.patch('posts.thumbnails.transaction.on_commit'):
+            post.image = self.image
+            post.save()
+        self.assertEqual(post.image.name, name)
+        self.assertEqual(StoredFile.objects.get(name=name).references, 1)
+        post.delete()
+        self.assertEqual(StoredFile.objects.get(name=name).references, 0)
+
+    def test_missing_thumbnail_shows_placeholder(self):
+        """Без готовой миниатюры страница выводит заглушку, не создавая её"""
+        with mock.patch('posts.thumbnails.transaction.on_commit'):
+            post = Post.objects.create(
+                author=self.author, text='С картинкой', image=self.image)
+        response = self.client.get(
+            reverse('posts:post_detail', args=[post.pk]))
+        self.assertContains(response, 'bg-light')
+        self.assertIsNone(self.thumbnail(post))
+
+    # Иначе второй раз страница отдаётся из кэша целиком, без рендера.
+    @override_settings(PAGE_CACHE_VIEWS=())
+    def test_page_thumbnails_resolved_in_one_query(self):
+        """Миниатюры всей страницы читаются одним запросом к sorl"""
+        for _ in range(3):
+            self.image.seek(0)
+            self.create_post()
+        cache.clear()
+        for expected in (1, 0):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(reverse('posts:index'))
+            lookups = [
+                query for query in queries.captured_queries
+                if 'thumbnail_kvstore' in query['sql']]
+            self.assertEqual(len(lookups), expected)
+        posts = list(response.context['page_obj'])
+        self.assertEqual(len(posts), 3)
+        for post in posts:
+            self.assertTrue(
+                os.path.exists(self.media_path(post.thumbnail.url)))
+
+    def test_edit_without_new_image_skips_generation(self):
+        """Правка текста не запускает обработку картинки заново"""
+        post = self.create_post()
+        with mock.patch('posts.thumbnails.schedule') as schedule:
+            post.text = 'Новый текст'
+            post.save()
+        schedule.assert_not_called()
+
+    def regenerate(self, *args):
+        checkpoint = os.path.join(settings.MEDIA_ROOT, 'progress.json')
+        out = StringIO()
+        call_command(
+            'regenerate_thumbnails', '--workers=0', '--batch-size=1',
+            f'--checkpoint={checkpoint}', *args, stdout=out)
+        return out.getvalue(), checkpoint
+
+    def test_regenerate_command(self):
+        """Команда пересоздаёт удалённые миниатюры"""
+        post = self.create_post()
+        path = self.media_path(self.thumbnail(post).url)
+        os.remove(path)
+        with mock.patch('posts.thumbnails.transaction.on_commit'):
+            output, checkpoint = self.regenerate('--force')
+        self.assertIn('Готово: 1 картинок', output)
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(checkpoint))
+
+    def test_regenerate_resumes_from_checkpoint(self):
+        """После прерывания обработанные посты не проходятся заново"""
+        first = self.create_post()
+        self.image.seek(0)
+        second = self.create_post()
+        checkpoint = os.path.join(settings.MEDIA_ROOT, 'progress.json')
+        with open(checkpoint, 'w') as file:
+            file.write(f'{{"last_pk": {first.pk}}}')
+        with mock.patch('posts.thumbnails.generate') as generate:
+            output, _ = self.regenerate()
+        self.assertEqual(
+            [call.args[0] for call in generate.call_args_list], [second])
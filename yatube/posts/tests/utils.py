@@ -0,0 +1,25 @@
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin:
+    """Проверки того, что страница укладывается в бюджет SQL-запросов."""
+
+    @contextmanager
+    def assertMaxQueries(self, budget, label=''):
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        if len(context) > budget:
+            queries = '\n'.join(
+                query['sql'] for query in context.captured_queries)
+            self.fail(
+                f'{label}: {len(context)} запросов при бюджете {budget}\n'
+                f'{queries}'
+            )
+
+    def assertQueryBudget(self, client, url, budget, method='get', data=None):
+        with self.assertMaxQueries(budget, url):
+            response = getattr(client, method)(url, data)
+        return response
@@ -0,0 +1,15 @@
+"""Точки входа процессов regenerate_thumbnails.
+
+Процессы запускаются через spawn: модуль импортируется до настройки
+Django, поэтому модели и миниатюры подключаются только внутри функций.
+"""
+import django
+
+
+def init_worker():
+    django.setup()
+
+
+def regenerate(post_ids, force=False):
+    from .thumbnails import regenerate
+    return regenerate(post_ids, force)
@@ -0,0 +1,238 @@
+import json
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import close_old_connections, transaction
+from PIL import Image
+from sorl.thumbnail import default, get_thumbnail
+from sorl.thumbnail.base import ThumbnailBackend
+from sorl.thumbnail.conf import defaults as sorl_defaults
+from sorl.thumbnail.conf import settings as sorl_settings
+from sorl.thumbnail.images import ImageFile, deserialize_image_file
+from sorl.thumbnail.kvstores.base import add_prefix
+from sorl.thumbnail.kvstores.cached_db_kvstore import EMPTY_VALUE
+from sorl.thumbnail.kvstores.cached_db_kvstore import KVStore as CachedDbStore
+from sorl.thumbnail.models import KVStore as KVStoreModel
+
+from core import query_cache
+
+from . import feeds
+from .models import Post
+
+logger = logging.getLogger(__name__)
+
+# Миниатюры, которые выводят шаблоны: имя -> (геометрия, опции sorl).
+GEOMETRIES = {
+    'card': ('960x339', {'crop': 'center', 'upscale': True}),
+}
+
+# Ширины вариантов для srcset с пропорциями карточки и форматы в порядке
+# предпочтения; JPEG остаётся запасным вариантом для любых браузеров.
+VARIANT_WIDTHS = (480, 960, 1440)
+VARIANT_RATIO = 339 / 960
+VARIANT_FORMATS = ('WEBP', 'JPEG')
+
+Thumbnail = namedtuple('Thumbnail', 'url width height')
+
+_executor = None
+
+
+class ThumbnailNames(ThumbnailBackend):
+    """Считает имя миниатюры так же, как sorl, но ничего не создаёт."""
+
+    def thumbnail_file(self, file_, geometry_string, **options):
+        source = ImageFile(file_)
+        if sorl_settings.THUMBNAIL_PRESERVE_FORMAT:
+            options.setdefault('format', self._get_format(source))
+        for key, value in self.default_options.items():
+            options.setdefault(key, value)
+        for key, attr in self.extra_options:
+            value = getattr(sorl_settings, attr)
+            if value != getattr(sorl_defaults, attr):
+                options.setdefault(key, value)
+        name = self._get_thumbnail_filename(source, geometry_string, options)
+        return ImageFile(name, default.storage)
+
+
+names = ThumbnailNames()
+
+
+def thumbnail_file(image, name):
+    geometry, options = GEOMETRIES[name]
+    return names.thumbnail_file(image, geometry, **options)
+
+
+def raw_values(keys):
+    """Записи хранилища sorl по ключам: один get_many к кэшу и один
+    запрос к таблице sorl для промахов."""
+    store = default.kvstore
+    if not keys:
+        return {}
+    if not isinstance(store, CachedDbStore):
+        return {key: store._get_raw(key) for key in keys}
+    found = store.cache.get_many(keys)
+    missing = [key for key in keys if key not in found]
+    if missing:
+        rows = dict(
+            KVStoreModel.objects.filter(
+                key__in=missing).values_list('key', 'value'))
+        # Как sorl, запоминаем и отсутствие записи, чтобы не ходить в базу.
+        store.cache.set_many(
+            {key: rows.get(key, EMPTY_VALUE) for key in missing},
+            sorl_settings.THUMBNAIL_CACHE_TIMEOUT,
+        )
+        found.update(rows)
+    return {
+        key: value for key, value in found.items()
+        if value is not None and value is not EMPTY_VALUE
+    }
+
+
+def variant_formats():
+    """Форматы, которые умеет сохранять установленный Pillow."""
+    Image.init()
+    return [fmt for fmt in VARIANT_FORMATS if fmt in Image.SAVE]
+
+
+def make_variants(post):
+    """Создаёт варианты картинки по ширинам и форматам.
+
+    Маленькие картинки не растягиваются, поэтому одинаковые по ширине
+    варианты не дублируются.
+    """
+    variants = []
+    for fmt in variant_formats():
+        widths = set()
+        for width in VARIANT_WIDTHS:
+            geometry = f'{width}x{round(width * VARIANT_RATIO)}'
+            image = get_thumbnail(
+                post.image, geometry, crop='center', upscale=False,
+                format=fmt)
+            if not image.exists() or image.width in widths:
+                continue
+            widths.add(image.width)
+            variants.append({
+                'format': fmt.lower(),
+                'width': image.width,
+                'height': image.height,
+                'name': image.name,
+            })
+    return variants
+
+
+def image_sources(post):
+    """Пары (MIME-тип, srcset) из post.image_variants, JPEG последним."""
+    if not post.image_variants:
+        return []
+    sources = {}
+    for variant in json.loads(post.image_variants):
+        url = default_storage.url(variant['name'])
+        sources.setdefault(variant['format'], []).append(
+            f'{url} {variant["width"]}w')
+    return [
+        (f'image/{fmt}', ', '.join(sources[fmt]))
+        for fmt in (fmt.lower() for fmt in VARIANT_FORMATS)
+        if fmt in sources
+    ]
+
+
+def attach(posts, name='card'):
+    """Кладёт в post.thumbnail адрес и размеры готовой миниатюры
+    (или None) сразу для всех постов страницы, а в post.image_sources
+    и post.image_srcset — варианты картинки для <picture>."""
+    posts = list(posts)
+    for post in posts:
+        sources = image_sources(post)
+        post.image_srcset = ''
+        if sources and sources[-1][0] == 'image/jpeg':
+            post.image_srcset = sources.pop()[1]
+        post.image_sources = sources
+    keys = {
+        post.pk: add_prefix(thumbnail_file(post.image, name).key)
+        for post in posts if post.image
+    }
+    values = raw_values(list(set(keys.values())))
+    for post in posts:
+        value = values.get(keys.get(post.pk))
+        post.thumbnail = None
+        if value:
+            image = deserialize_image_file(value)
+            post.thumbnail = Thumbnail(image.url, image.width, image.height)
+    return posts
+
+
+def generate(post):
+    """Создаёт все миниатюры и варианты картинки поста."""
+    for geometry, options in GEOMETRIES.values():
+        get_thumbnail(post.image, geometry, **options)
+    Post.objects.filter(pk=post.pk, image=post.image.name).update(
+        image_variants=json.dumps(make_variants(post)))
+    query_cache.rows_changed(Post, post.pk)
+    # В закэшированных фрагментах лент пока стоит заглушка.
+    feeds.post_changed(post)
+
+
+def generate_by_pk(post_id):
+    post = Post.objects.filter(pk=post_id).first()
+    if post is not None and post.image:
+        generate(post)
+
+
+def regenerate(post_ids, force=False):
+    """Пересоздаёт миниатюры пачки постов; с force сначала удаляет
+    готовые. Возвращает число обработанных картинок."""
+    done = 0
+    posts = Post.objects.filter(pk__in=post_ids).exclude(image='')
+    for post in posts:
+        try:
+            if force:
+                default.kvstore.delete_thumbnails(ImageFile(post.image))
+            generate(post)
+        except Exception:
+            logger.exception('Не удалось создать миниатюры поста %s', post.pk)
+        else:
+            done += 1
+    return done
+
+
+def run_in_background(post_id):
+    try:
+        generate_by_pk(post_id)
+    except Exception:
+        logger.exception('Не удалось создать миниатюры поста %s', post_id)
+    finally:
+        close_old_connections()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=settings.THUMBNAIL_WORKERS,
+            thread_name_prefix='thumbnails',
+        )
+    return _executor
+
+
+def image_changed(post):
+    """Сбрасывает варианты старой картинки и заказывает новые."""
+    if post.image_variants:
+        Post.objects.filter(pk=post.pk).update(image_variants='')
+        query_cache.rows_changed(Post, post.pk)
+        post.image_variants = ''
+    schedule(post)
+
+
+def schedule(post):
+    """Ставит создание миниатюр после коммита, вне запроса."""
+    if not post.image:
+        return
+    if settings.THUMBNAIL_ASYNC:
+        task = partial(get_executor().submit, run_in_background, post.pk)
+    else:
+        task = partial(generate_by_pk, post.pk)
+    transaction.on_commit(task)
@@ -0,0 +1,128 @@
+from django.conf import settings
+from django.db.models import Q, Sum
+
+from .models import Follow, Post, TimelineEntry, UserStats
+from .paginators import CursorPaginator
+
+BATCH_SIZE = 500
+
+
+def is_hot(author_id):
+    """Автор с большим числом подписчиков не раскладывается по лентам."""
+    return UserStats.objects.filter(
+        user_id=author_id,
+        followers_count__gte=settings.TIMELINE_FANOUT_LIMIT,
+    ).exists()
+
+
+def fan_out(post):
+    """Кладёт новый пост в ленты подписчиков автора."""
+    if is_hot(post.author_id):
+        # Популярного автора подмешиваем при чтении ленты.
+        Follow.objects.filter(
+            author_id=post.author_id, in_timeline=True
+        ).update(in_timeline=False)
+        return
+    followers = Follow.objects.filter(
+        author_id=post.author_id, in_timeline=True
+    ).values_list('user_id', flat=True)
+    TimelineEntry.objects.bulk_create(
+        (
+            TimelineEntry(
+                user_id=user_id,
+                post_id=post.pk,
+                author_id=post.author_id,
+                pub_date=post.pub_date,
+            )
+            for user_id in followers.iterator()
+        ),
+        batch_size=BATCH_SIZE,
+        ignore_conflicts=True,
+    )
+
+
+def backfill(follow):
+    """Дописывает в ленту подписчика уже опубликованные посты автора."""
+    hot = is_hot(follow.author_id)
+    if follow.in_timeline == hot:
+        Follow.objects.filter(pk=follow.pk).update(in_timeline=not hot)
+        follow.in_timeline = not hot
+    if hot:
+        return
+    posts = Post.objects.filter(
+        author_id=follow.author_id
+    ).order_by().values_list('pk', 'pub_date')
+    batch = []
+    for post_id, pub_date in posts.iterator():
+        batch.append(TimelineEntry(
+            user_id=follow.user_id,
+            post_id=post_id,
+            author_id=follow.author_id,
+            pub_date=pub_date,
+        ))
+        if len(batch) >= BATCH_SIZE:
+            TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+            batch = []
+    TimelineEntry.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def prune(follow):
+    """Убирает из ленты посты автора, от которого отписались."""
+    TimelineEntry.objects.filter(
+        user_id=follow.user_id, author_id=follow.author_id
+    ).delete()
+
+
+def rebuild(user):
+    """Собирает ленту пользователя заново по его подпискам."""
+    TimelineEntry.objects.filter(user=user).delete()
+    for follow in Follow.objects.filter(user=user):
+        backfill(follow)
+
+
+class TimelinePaginator(CursorPaginator):
+    """Лента подписок: диапазон из TimelineEntry плюс посты популярных
+    авторов, которые подмешиваются при чтении."""
+
+    def __init__(self, user, per_page):
+        self.user = user
+        self.merged_authors = list(
+            Follow.objects.filter(
+                user=user, in_timeline=False
+            ).values_list('author_id', flat=True)
+        )
+        posts = Post.objects.filter(
+            Q(timeline_entries__user=user)
+            | Q(author_id__in=self.merged_authors)
+        ).distinct()
+        super().__init__(
+            posts, per_page, count_key=f'count:follow:{user.pk}')
+
+    def estimate_count(self):
+        # Сумма постов авторов из подписок: без COUNT по ленте.
+        authors = Follow.objects.filter(user=self.user).values('author_id')
+        return UserStats.objects.filter(
+            user_id__in=authors
+        ).aggregate(total=Sum('posts_count'))['total'] or 0
+
+    def fetch(self, values, reverse, limit):
+        fields = ('pub_date', 'post_id')
+        entries = TimelineEntry.objects.filter(user=self.user)
+        if values is not None:
+            entries = entries.filter(self.after(values, reverse, fields))
+        entries = entries.select_related(
+            'post__author', 'post__group'
+        ).order_by(*self.order(reverse, fields))[:limit]
+        rows = [entry.post for entry in entries]
+        if not self.merged_authors:
+            return rows
+        posts = Post.objects.filter(
+            author_id__in=self.merged_authors
+        ).select_related('author', 'group')
+        if values is not None:
+            posts = posts.filter(self.after(values, reverse))
+        rows += posts.order_by(*self.order(reverse))[:limit]
+        unique = {post.pk: post for post in rows}.values()
+        return sorted(
+            unique, key=self.key, reverse=self.descending != reverse
+        )[:limit]
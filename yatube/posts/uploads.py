@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import re
+import tempfile
+import uuid
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler, StopFutureHandlers, StopUpload,
+)
+from PIL import Image
+
+FIELD_NAME = 'image'
+UPLOADS = 'uploads'
+# Первые байты файла, по которым Pillow узнаёт формат и размеры, не
+# декодируя картинку. EXIF в JPEG бывает до 64 КБ.
+HEADER_BYTES = 256 * 1024
+# Текстовые поля формы и заголовки частей multipart.
+FORM_OVERHEAD = 64 * 1024
+READ_CHUNK = 64 * 1024
+UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+class UploadRejected(Exception):
+    pass
+
+
+def too_big_message():
+    return (
+        f'Картинка больше '
+        f'{settings.POST_IMAGE_MAX_BYTES / 2 ** 20:.0f} МБ'
+    )
+
+
+def check_size(size):
+    if size > settings.POST_IMAGE_MAX_BYTES:
+        raise UploadRejected(too_big_message())
+
+
+def check_dimensions(width, height):
+    if width * height > settings.POST_IMAGE_MAX_PIXELS:
+        raise UploadRejected(
+            f'Картинка больше '
+            f'{settings.POST_IMAGE_MAX_PIXELS / 10 ** 6:.0f} мегапикселей'
+        )
+
+
+class ImageCheck:
+    """Проверяет размеры картинки по заголовку, пока файл ещё грузится."""
+
+    def __init__(self):
+        self.head = bytearray()
+        self.size = None
+
+    def feed(self, data):
+        if self.size is not None or len(self.head) >= HEADER_BYTES:
+            return
+        self.head += data[:HEADER_BYTES - len(self.head)]
+        try:
+            with Image.open(BytesIO(self.head)) as image:
+                self.size = image.size
+        except Image.DecompressionBombError:
+            self.size = (settings.POST_IMAGE_MAX_PIXELS + 1, 1)
+        except Exception:
+            # Заголовок ещё не пришёл целиком. Если его нет и в
+            # HEADER_BYTES, это не картинка.
+            if len(self.head) >= HEADER_BYTES:
+                raise UploadRejected('Файл не похож на картинку')
+            return
+        check_dimensions(*self.size)
+
+
+def upload_dir():
+    # Тот же диск, что и у хранилища: сохранение — переименование файла.
+    path = os.path.join(settings.MEDIA_ROOT, UPLOADS)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class StagedUpload(UploadedFile):
+    """Картинка, записанная при приёме прямо в MEDIA_ROOT/uploads.
+
+    Хранилище по хэшу берёт готовый content_hash и переносит файл на
+    место без копирования.
+    """
+
+    def __init__(self, path, name, content_type=None, size=None,
+                 charset=None, content_hash=None, delete_on_close=True):
+        super().__init__(
+            open(path, 'r+b'), name, content_type, size, charset)
+        self.path = path
+        self.content_hash = content_hash
+        self.delete_on_close = delete_on_close
+        self.digest = hashlib.sha256()
+
+    @classmethod
+    def create(cls, name, content_type, charset):
+        handle, path = tempfile.mkstemp(dir=upload_dir(), suffix='.upload')
+        os.close(handle)
+        return cls(path, name, content_type, 0, charset)
+
+    def append(self, data):
+        self.file.write(data)
+        self.digest.update(data)
+
+    def finish(self, size):
+        self.file.flush()
+        self.file.seek(0)
+        self.size = size
+        self.content_hash = self.digest.hexdigest()
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            if self.delete_on_close:
+                remove(self.path)
+
+
+class RejectedUpload(UploadedFile):
+    """Загрузка, отклонённая при приёме; PostForm показывает её ошибку."""
+
+    def __init__(self, name, upload_error):
+        super().__init__(BytesIO(), name, size=0)
+        self.upload_error = upload_error
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class PostImageUploadHandler(FileUploadHandler):
+    """Принимает картинку поста, проверяя её размер по мере загрузки.
+
+    Как только картинка оказывается слишком большой, разбор запроса
+    прерывается StopUpload без дочитывания тела, а форма получает
+    RejectedUpload из request.rejected_upload. Принятые куски сразу идут
+    в StagedUpload без промежуточного временного файла.
+    """
+
+    def __init__(self, request=None):
+        super().__init__(request)
+        self.upload = None
+        self.request_too_big = False
+
+    def handle_raw_input(self, input_data, META, content_length, boundary,
+                         encoding=None):
+        self.request_too_big = (
+            content_length > settings.POST_IMAGE_MAX_BYTES + FORM_OVERHEAD)
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        if field_name != FIELD_NAME:
+            self.upload = None
+            return
+        if self.request_too_big:
+            self.reject(too_big_message())
+        self.check = ImageCheck()
+        self.upload = StagedUpload.create(
+            self.file_name, self.content_type, self.charset)
+        raise StopFutureHandlers
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.upload is None:
+            return raw_data
+        try:
+            check_size(start + len(raw_data))
+            self.check.feed(raw_data)
+        except UploadRejected as error:
+            self.reject(str(error))
+        self.upload.append(raw_data)
+        return None
+
+    def file_complete(self, file_size):
+        if self.upload is None:
+            return None
+        upload, self.upload = self.upload, None
+        upload.finish(file_size)
+        return upload
+
+    def reject(self, message):
+        if self.upload is not None:
+            self.upload.close()
+            self.upload = None
+        self.request.rejected_upload = RejectedUpload(self.file_name, message)
+        # Остаток тела не читаем: клиенту ответят, не дожидаясь его.
+        raise StopUpload(connection_reset=True)
+
+
+# Докачка: клиент создаёт сессию, шлёт куски с Content-Range и после
+# обрыва узнаёт, с какого байта продолжить. Сессия — файл .part и
+# описание .json в MEDIA_ROOT/uploads.
+
+def session_paths(upload_id):
+    base = os.path.join(upload_dir(), upload_id)
+    return f'{base}.part', f'{base}.json'
+
+
+def start_session(user, name, size, content_type=''):
+    check_size(size)
+    upload_id = uuid.uuid4().hex
+    part_path, meta_path = session_paths(upload_id)
+    open(part_path, 'wb').close()
+    meta = {
+        'user': user.pk,
+        'name': os.path.basename(name),
+        'size': size,
+        'content_type': content_type,
+        'checked': False,
+    }
+    write_meta(meta_path, meta)
+    return upload_id, meta
+
+
+def write_meta(path, meta):
+    with open(f'{path}.tmp', 'w') as file:
+        json.dump(meta, file)
+    os.replace(f'{path}.tmp', path)
+
+
+def load_session(user, upload_id):
+    """Описание сессии пользователя или None."""
+    if not UPLOAD_ID.match(upload_id or ''):
+        return None
+    _, meta_path = session_paths(upload_id)
+    try:
+        with open(meta_path) as file:
+            meta = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if meta['user'] != user.pk:
+        return None
+    return meta
+
+
+def session_offset(upload_id):
+    part_path, _ = session_paths(upload_id)
+    return os.path.getsize(part_path)
+
+
+def append_chunk(upload_id, meta, stream, start, end):
+    """Дописывает кусок [start, end] из stream, не держа его в памяти.
+
+    Возвращает новое смещение; размер и заголовок картинки проверяются
+    по ходу, при ошибке сессия удаляется.
+    """
+    part_path, meta_path = session_paths(upload_id)
+    if end >= meta['size']:
+        raise UploadRejected('Кусок выходит за пределы файла')
+    remaining = end - start + 1
+    with open(part_path, 'r+b') as file:
+        file.seek(start)
+        while remaining > 0:
+            data = stream.read(min(READ_CHUNK, remaining))
+            if not data:
+                break
+            file.write(data)
+            remaining -= len(data)
+        file.truncate()
+        offset = file.tell()
+    if not meta['checked']:
+        try:
+            check_session(part_path)
+        except UploadRejected:
+            discard_session(upload_id)
+            raise
+        if offset >= min(HEADER_BYTES, meta['size']):
+            meta['checked'] = True
+            write_meta(meta_path, meta)
+    return offset
+
+
+def check_session(part_path):
+    # Файл меньше HEADER_BYTES без понятного заголовка пропускается:
+    # формат проверит форма.
+    with open(part_path, 'rb') as file:
+        ImageCheck().feed(file.read(HEADER_BYTES))
+
+
+def discard_session(upload_id):
+    for path in session_paths(upload_id):
+        remove(path)
+
+
+def post_files(request):
+    """request.FILES для PostForm; картинка, докачанная по частям,
+    подставляется в поле image по id сессии из поля upload."""
+    upload_id = request.POST.get('upload')
+    # Разбор тела, запущенный request.POST, мог отклонить картинку.
+    rejected = getattr(request, 'rejected_upload', None)
+    if rejected is not None:
+        files = request.FILES.copy()
+        files[FIELD_NAME] = rejected
+        return files
+    if not upload_id or FIELD_NAME in request.FILES:
+        return request.FILES or None
+    files = request.FILES.copy()
+    meta = load_session(request.user, upload_id)
+    if meta is None or session_offset(upload_id) != meta['size']:
+        files[FIELD_NAME] = RejectedUpload(
+            upload_id, 'Загрузка картинки не завершена')
+        return files
+    part_path, _ = session_paths(upload_id)
+    files[FIELD_NAME] = StagedUpload(
+        part_path, meta['name'], meta['content_type'], meta['size'],
+        delete_on_close=False)
+    return files
+
+
+def finish(request):
+    """Удаляет сессию докачки после того, как пост сохранён."""
+    upload_id = request.POST.get('upload')
+    if UPLOAD_ID.match(upload_id or ''):
+        discard_session(upload_id)
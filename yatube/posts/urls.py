@@ -10,8 +10,35 @@ urlpatterns = [
     path('profile/<str:username>/', views.profile, name='profile'),
     path('posts/<int:post_id>/', views.post_detail, name='post_detail'),
     path('create/', views.post_create, name='post_create'),
+    path('search/', views.search, name='search'),
     path('posts/<int:post_id>/edit/', views.post_edit, name='post_edit'),
+    path('uploads/', views.upload_start, name='upload_start'),
+    path(
+        'uploads/<slug:upload_id>/',
+        views.upload_chunk,
+        name='upload_chunk'
+    ),
     path('posts/<int:post_id>/comment', views.add_comment, name='add_comment'),
+    path(
+        'posts/<int:post_id>/comments/',
+        views.comments_more,
+        name='comments_more'
+    ),
+    path(
+        'fragments/header/',
+        views.fragment_header,
+        name='fragment_header'
+    ),
+    path(
+        'fragments/posts/<int:post_id>/actions/',
+        views.fragment_post_actions,
+        name='fragment_post_actions'
+    ),
+    path(
+        'fragments/profile/<str:username>/follow/',
+        views.fragment_follow,
+        name='fragment_follow'
+    ),
     path('follow/', views.follow_index, name='follow_index'),
     path(
         'profile/<str:username>/follow/',
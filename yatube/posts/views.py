@@ -1,83 +1,222 @@
-from django.core.paginator import Paginator
 from django.shortcuts import render, get_object_or_404, redirect, reverse
 from .models import Post, Group, User, Follow
 from django.contrib.auth.decorators import login_required
 from .forms import PostForm, CommentForm
+from . import comments as post_comments
+from .counters import get_stats
+from .paginators import CursorPaginator, legacy_page_redirect
+from .search import SearchPaginator
+from . import thumbnails, uploads
+from .timeline import TimelinePaginator
 from django.conf import settings
+from django.http import Http404, JsonResponse
+from django.utils.http import urlencode
+from django.views.decorators.cache import never_cache
+from django.views.decorators.http import require_http_methods, require_POST
+from core.conditional import CacheValidators
+from core.query_cache import cached
+
+
+def post_keys(posts):
+    """Суррогатные ключи постов на странице и их авторов."""
+    keys = set()
+    for post in posts:
+        keys.add(f'post:{post.pk}')
+        keys.add(f'profile:{post.author_id}')
+    return keys
 
 
 def index(request):
-    posts = Post.objects.all()
-    paginator = Paginator(posts, settings.PAGINATOR_POSTS)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    posts = Post.objects.select_related('author', 'group')
+    paginator = CursorPaginator(
+        posts, settings.PAGINATOR_POSTS, count_key='count:index')
+    if 'page' in request.GET:
+        return legacy_page_redirect(request, paginator)
+    validators = CacheValidators(request, 'index')
+    response = validators.not_modified()
+    if response:
+        return response
+    page_obj = paginator.get_cached_page(
+        request.GET.get('cursor'),
+        f'feed:index:{validators.token}',
+        prepare=thumbnails.attach,
+    )
+    validators.add_keys(*post_keys(page_obj))
     title = 'Последние обновления на сайте'
     context = {
         'page_obj': page_obj,
+        'feed_version': validators.token,
         'title': title,
         'posts': posts,
     }
-    return render(request, 'posts/index.html', context)
+    return validators.apply(render(request, 'posts/index.html', context))
 
 
 def group_posts(request, slug):
-    group = get_object_or_404(Group, slug=slug)
+    group = get_object_or_404(cached(Group.objects), slug=slug)
 
-    posts = group.posts.all()
-    paginator = Paginator(posts, settings.PAGINATOR_POSTS)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    posts = group.posts.select_related('author', 'group')
+    paginator = CursorPaginator(
+        posts, settings.PAGINATOR_POSTS, count=group.posts_count)
+    if 'page' in request.GET:
+        return legacy_page_redirect(request, paginator)
+    validators = CacheValidators(request, f'group:{group.pk}')
+    response = validators.not_modified()
+    if response:
+        return response
+    page_obj = paginator.get_cached_page(
+        request.GET.get('cursor'),
+        f'feed:group:{group.pk}:{validators.token}',
+        prepare=thumbnails.attach,
+    )
+    validators.add_keys(*post_keys(page_obj))
     context = {
         'page_obj': page_obj,
+        'feed_version': validators.token,
         'group': group,
         'posts': posts,
     }
-    return render(request, 'posts/group_list.html', context)
+    return validators.apply(
+        render(request, 'posts/group_list.html', context))
 
 
 def profile(request, username):
     template = 'posts/profile.html'
-    user = get_object_or_404(User, username=username)
-    posts = user.posts.all()
-    paginator = Paginator(posts, settings.PAGINATOR_POSTS)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    user = get_object_or_404(
+        cached(User.objects.select_related('stats')), username=username)
+    posts = user.posts.select_related('author', 'group')
+    stats = get_stats(user)
+    paginator = CursorPaginator(
+        posts, settings.PAGINATOR_POSTS, count=stats.posts_count)
+    if 'page' in request.GET:
+        return legacy_page_redirect(request, paginator)
+    validators = CacheValidators(request, f'profile:{user.pk}')
+    response = validators.not_modified()
+    if response:
+        return response
+    page_obj = paginator.get_cached_page(
+        request.GET.get('cursor'),
+        f'feed:profile:{user.pk}:{validators.token}',
+        prepare=thumbnails.attach,
+    )
+    validators.add_keys(*post_keys(page_obj))
     context = {
         'page_obj': page_obj,
-        'count_posts': user.posts.count(),
+        'feed_version': validators.token,
+        'count_posts': stats.posts_count,
+        'stats': stats,
         'username': user,
     }
-    return render(request, template, context)
+    return validators.apply(render(request, template, context))
+
+
+def search(request):
+    query = request.GET.get('q', '').strip()
+    validators = CacheValidators(request, 'index')
+    response = validators.not_modified()
+    if response:
+        return response
+    page_obj = None
+    if query:
+        paginator = SearchPaginator(query, settings.PAGINATOR_POSTS)
+        page_obj = paginator.get_page(request.GET.get('cursor'))
+        validators.add_keys(*post_keys(page_obj))
+    context = {
+        'page_obj': page_obj,
+        'query': query,
+        'page_query': urlencode({'q': query}) + '&',
+    }
+    return validators.apply(render(request, 'posts/search.html', context))
 
 
 def post_detail(request, post_id):
     template = 'posts/post_detail.html'
     post_detail = get_object_or_404(
-        Post.objects.select_related(
-            'author').select_related('group'), pk=post_id)
-    amount = post_detail.author.posts.count()
+        cached(Post.objects.select_related('author__stats', 'group')),
+        pk=post_id)
+    scopes = [f'post:{post_detail.pk}', f'profile:{post_detail.author_id}']
+    if post_detail.group_id is not None:
+        scopes.append(f'group:{post_detail.group_id}')
+    validators = CacheValidators(request, *scopes)
+    response = validators.not_modified()
+    if response:
+        return response
+    thumbnails.attach([post_detail])
+    amount = get_stats(post_detail.author).posts_count
     username = post_detail.author
-    comments = post_detail.comments.all()
+    comments, next_cursor = post_comments.get_page(
+        post_detail, request.GET.get('comments'))
     form = CommentForm()
     context = {
         'post_detail': post_detail,
         'amount': amount,
         'username': username,
         'comments': comments,
+        'next_cursor': next_cursor,
         'form': form,
     }
-    return render(request, template, context)
+    return validators.apply(render(request, template, context))
+
+
+# Персональные части страниц. Сами страницы одинаковы для всех и
+# кэшируются целиком, а эти фрагменты подгружаются отдельно.
+
+@never_cache
+def fragment_header(request):
+    return render(request, 'includes/user_menu.html')
+
+
+@never_cache
+def fragment_post_actions(request, post_id):
+    post = get_object_or_404(Post, pk=post_id)
+    context = {
+        'post_detail': post,
+        'form': CommentForm(),
+    }
+    return render(request, 'posts/fragments/post_actions.html', context)
+
+
+@never_cache
+def fragment_follow(request, username):
+    author = get_object_or_404(User, username=username)
+    following = (
+        request.user.is_authenticated
+        and author.following.filter(user=request.user).exists()
+    )
+    context = {
+        'author': author,
+        'following': following,
+    }
+    return render(request, 'posts/fragments/follow.html', context)
+
+
+def comments_more(request, post_id):
+    post = get_object_or_404(Post, pk=post_id)
+    validators = CacheValidators(request, f'post:{post.pk}')
+    response = validators.not_modified()
+    if response:
+        return response
+    comments, next_cursor = post_comments.get_page(
+        post, request.GET.get('cursor'))
+    context = {
+        'post_detail': post,
+        'comments': comments,
+        'next_cursor': next_cursor,
+    }
+    return validators.apply(
+        render(request, 'posts/includes/comments.html', context))
 
 
 @login_required
 def post_create(request):
     template = 'posts/create_post.html'
-    form = PostForm(request.POST or None, files=request.FILES or None)
+    form = PostForm(request.POST or None, files=uploads.post_files(request))
     if not form.is_valid():
         return render(request, template, {'form': form})
     post = form.save(commit=False)
     post.author = request.user
     post.save()
+    uploads.finish(request)
     return redirect('posts:profile', username=request.user.username)
 
 
@@ -89,10 +228,11 @@ def post_edit(request, post_id):
         return redirect('posts:post_edit', post_id)
     form = PostForm(
         request.POST or None,
-        files=request.FILES or None,
+        files=uploads.post_files(request),
         instance=post)
     if form.is_valid():
         form.save()
+        uploads.finish(request)
         return redirect('posts:post_detail', post_id)
     context = {
         'form': form,
@@ -102,6 +242,62 @@ def post_edit(request, post_id):
     return render(request, template, context)
 
 
+@login_required
+@require_POST
+def upload_start(request):
+    """Начинает докачиваемую загрузку картинки: ждёт name и size,
+    отвечает адресом, на который слать куски."""
+    try:
+        size = int(request.POST.get('size', ''))
+    except ValueError:
+        size = 0
+    if size <= 0:
+        return JsonResponse({'error': 'Не указан размер файла'}, status=400)
+    try:
+        upload_id, meta = uploads.start_session(
+            request.user, request.POST.get('name', ''), size,
+            request.POST.get('content_type', ''))
+    except uploads.UploadRejected as error:
+        return JsonResponse({'error': str(error)}, status=413)
+    return JsonResponse({
+        'id': upload_id,
+        'url': reverse('posts:upload_chunk', args=[upload_id]),
+        'offset': 0,
+        'size': meta['size'],
+    }, status=201)
+
+
+@login_required
+@require_http_methods(['GET', 'HEAD', 'PUT'])
+def upload_chunk(request, upload_id):
+    """GET — сколько байт уже принято, PUT с Content-Range — следующий
+    кусок. Кусок не с того места отклоняется с 409 и текущим смещением."""
+    meta = uploads.load_session(request.user, upload_id)
+    if meta is None:
+        raise Http404
+    offset = uploads.session_offset(upload_id)
+    if request.method == 'PUT':
+        match = uploads.CONTENT_RANGE.match(
+            request.META.get('HTTP_CONTENT_RANGE', ''))
+        if not match:
+            return JsonResponse(
+                {'error': 'Нужен заголовок Content-Range'}, status=400)
+        start, end, total = map(int, match.groups())
+        if start != offset or total != meta['size'] or end < start:
+            return JsonResponse(
+                {'offset': offset, 'size': meta['size']}, status=409)
+        try:
+            offset = uploads.append_chunk(
+                upload_id, meta, request, start, end)
+        except uploads.UploadRejected as error:
+            return JsonResponse({'error': str(error)}, status=413)
+    return JsonResponse({
+        'offset': offset,
+        'size': meta['size'],
+        'complete': offset == meta['size'],
+    })
+
+
 @login_required
 def add_comment(request, post_id):
     post = get_object_or_404(Post, pk=post_id)
@@ -116,15 +312,15 @@ def add_comment(request, post_id):
 
 @login_required
 def follow_index(request):
-    post_list = Post.objects.filter(author__following__user=request.user)
-    paginator = Paginator(post_list, settings.PAGINATOR_POSTS)
-    page_number = request.GET.get('page')
-    page_obj = paginator.get_page(page_number)
+    paginator = TimelinePaginator(request.user, settings.PAGINATOR_POSTS)
+    if 'page' in request.GET:
+        return legacy_page_redirect(request, paginator)
+    page_obj = paginator.get_page(request.GET.get('cursor'))
+    thumbnails.attach(page_obj)
     return render(
         request,
         'posts/follow.html',
         {
-            'page_number': page_number,
             'page_obj': page_obj,
             'paginator': paginator
         }
@@ -134,7 +330,7 @@ def follow_index(request):
 @login_required
 def profile_follow(request, username):
     author = get_object_or_404(
-        User,
+        cached(User.objects),
         username=username
     )
     if author.following.filter(user=request.user).exists():
@@ -156,7 +352,7 @@ def profile_follow(request, username):
 
 @login_required
 def profile_unfollow(request, username):
-    author = get_object_or_404(User, username=username)
+    author = get_object_or_404(cached(User.objects), username=username)
     delited_follow = get_object_or_404(
         Follow,
         user=request.user,
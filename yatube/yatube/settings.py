@@ -11,10 +11,15 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 """
 
 import os
+import sys
+import tempfile
 
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+# запуск тестов: manage.py test или pytest
+TESTING = sys.argv[1:2] == ['test'] or 'pytest' in sys.modules
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.2/howto/deployment/checklist/
@@ -55,6 +60,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'core.page_cache.AnonymousPageCacheMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -142,14 +148,75 @@ EMAIL_BACKEND = 'django.core.mail.backends.filebased.EmailBackend'
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, 'sent_emails')
 
 PAGINATOR_POSTS = 10
+PAGINATOR_COMMENTS = 20
+
+# посты авторов с таким числом подписчиков не раскладываются по лентам,
+# а подмешиваются в ленту подписок при чтении
+TIMELINE_FANOUT_LIMIT = 1000
 
 CSRF_FAILURE_VIEW = 'core.views.csrf_failure'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
-
+# какие каталоги MEDIA_ROOT отдаёт core.media.serve
+MEDIA_SERVE_PREFIXES = ('posts/', 'cache/')
+# отдача файлов веб-сервером: None, 'x-accel-redirect' (nginx, с internal
+# location на MEDIA_ACCEL_PREFIX) или 'x-sendfile' (Apache mod_xsendfile)
+MEDIA_ACCEL = None
+MEDIA_ACCEL_PREFIX = '/protected-media/'
+
+# Картинка поста проверяется ещё при приёме, см. posts.uploads.
+FILE_UPLOAD_HANDLERS = [
+    'posts.uploads.PostImageUploadHandler',
+    'django.core.files.uploadhandler.MemoryFileUploadHandler',
+    'django.core.files.uploadhandler.TemporaryFileUploadHandler',
+]
+POST_IMAGE_MAX_BYTES = 10 * 1024 * 1024
+POST_IMAGE_MAX_PIXELS = 40 * 10 ** 6
+
+# Страницы, которые все получают из кэша целиком, см. core.page_cache.
+PAGE_CACHE_VIEWS = (
+    'posts:index',
+    'posts:group_list',
+    'posts:profile',
+    'posts:post_detail',
+    'about:author',
+    'about:tech',
+)
+PAGE_CACHE_TIMEOUT = 60 * 10
+# Персональные части страниц: <esi:include> для кэша на краю вместо
+# подгрузки скриптом, см. core/templatetags/fragments.py.
+FRAGMENTS_ESI = False
+
+# Сброс страниц во внешнем кэше (Varnish, CDN) по суррогатным ключам
+# из заголовка Surrogate-Key, см. core.purge. Без адреса страницы там
+# живут до конца TTL.
+PURGE_URL = None
+PURGE_METHOD = 'PURGE'
+PURGE_BATCH_SIZE = 100
+PURGE_TIMEOUT = 2
+
+# Кэш результатов запросов к Post, Group и User, см. core.query_cache.
+QUERY_CACHE_TIMEOUT = 60 * 60
+
+# миниатюры картинок создаются после сохранения поста в фоновых потоках;
+# в тестах сразу после коммита, чтобы не писать в MEDIA_ROOT после теста
+THUMBNAIL_ASYNC = not TESTING
+THUMBNAIL_WORKERS = 2
+
+# L1 в памяти каждого воркера и общий для воркеров хоста L2 в SQLite;
+# тесты пишут свой L2 во временный каталог, не трогая кэш разработки
+CACHE_LOCATION = os.path.join(BASE_DIR, 'cache', 'cache.sqlite3')
+if TESTING:
+    CACHE_LOCATION = os.path.join(
+        tempfile.gettempdir(), 'yatube-test-cache.sqlite3')
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'BACKEND': 'core.tiered_cache.TieredCache',
+        'LOCATION': CACHE_LOCATION,
+        'OPTIONS': {
+            'L1_MAX_ENTRIES': 1000,
+            'MAX_ENTRIES': 30000,
+        },
     }
 }